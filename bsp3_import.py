@@ -1,12 +1,22 @@
-"""
-    TODO:
-        Use already loaded material if it exists
-        Import Normals
-"""
-import bpy
 from struct import *
 import os
-import bmesh
+import sys
+import mmap
+import json
+import re
+import time
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+import jm_profile
+
+try:
+    import bpy
+except ImportError:
+    # Outside of Blender - the parsing and mesh buffer code still works
+    bpy = None
 
 bl_info = {
     "name": "Import Q3 BSP",
@@ -18,6 +28,26 @@ bl_info = {
 }
 
 
+# Lump indices into the 17 chunk headers
+LUMP_ENTITIES = 0
+LUMP_TEXTURES = 1
+LUMP_PLANES = 2
+LUMP_NODES = 3
+LUMP_LEAFS = 4
+LUMP_LEAFFACES = 5
+LUMP_LEAFBRUSHES = 6
+LUMP_MODELS = 7
+LUMP_BRUSHES = 8
+LUMP_BRUSHSIDES = 9
+LUMP_VERTEXES = 10
+LUMP_MESHVERTS = 11
+LUMP_EFFECTS = 12
+LUMP_FACES = 13
+LUMP_LIGHTMAPS = 14
+LUMP_LIGHTVOLS = 15
+LUMP_VISDATA = 16
+
+
 def load_bsp_header(file_data, file_position):
     bsp_header = Struct("4si") #Followed by 17 chunks
     chunk_size = bsp_header.size
@@ -40,99 +70,102 @@ def load_headers(file_data, file_position):
     return chunk_headers, file_position
 
 
+# Little endian record layouts for the lumps we decode with numpy
+vert_dtype = np.dtype([
+    ('position', '<f4', (3,)),
+    ('texcoord', '<f4', (2,)),
+    ('lightmap', '<f4', (2,)),
+    ('normal', '<f4', (3,)),
+    ('color', 'u1', (4,)),
+])
+
+texture_dtype = np.dtype([
+    ('name', 'S64'),
+    ('flags', '<i4'),
+    ('contents', '<i4'),
+])
+
+face_dtype = np.dtype([
+    ('texture', '<i4'),
+    ('effect', '<i4'),
+    ('type', '<i4'),
+    ('vertex', '<i4'),
+    ('n_vertexes', '<i4'),
+    ('meshvert', '<i4'),
+    ('n_meshverts', '<i4'),
+    ('lm_index', '<i4'),
+    ('lm_start', '<i4', (2,)),
+    ('lm_size', '<i4', (2,)),
+    ('lm_origin', '<f4', (3,)),
+    ('lm_vecs', '<f4', (2, 3)),
+    ('normal', '<f4', (3,)),
+    ('size', '<i4', (2,)),
+])
+
+
+def load_lump(file_data, headers, lump_index, dtype):
+    """
+        View a whole lump as an array of records - no per record unpacking
+    """
+    lump_offset, lump_length = headers[lump_index]
+    record_count = int(lump_length / dtype.itemsize)
+
+    return np.frombuffer(file_data, dtype=dtype, count=record_count, offset=lump_offset)
+
+
 def load_verts(file_data, headers, scale_factor):
     """
         float[3]    position    Vertex position.
         float[2][2] texcoord    Vertex texture coordinates. 0=surface, 1=lightmap.
         float[3]    normal      Vertex normal.
         ubyte[4]    color       Vertex color. RGBA.
-    """
 
+        Returns a dict of column arrays, one row per vertex. Positions are
+        scaled in double precision to match the values the old per vertex
+        unpacking produced.
+    """
+    vert_data = load_lump(file_data, headers, LUMP_VERTEXES, vert_dtype)
 
-    def vert_from_pack(vert_data):
-        return (
-                (vert_data[0] * scale_factor, vert_data[1] * scale_factor, vert_data[2] * scale_factor,), #XYZ
-                (vert_data[3], vert_data[4],), #UV1
-                (vert_data[5], vert_data[6],), #UV2
-                (vert_data[7], vert_data[8], vert_data[9],), #Normal
-                (vert_data[10], vert_data[11], vert_data[12], vert_data[13],), #RGBA
-            )
-
-    vert_offset, vert_length = headers[10]
-    vert_chunk = Struct("3f2f2f3f4B") 
-    vert_size = vert_chunk.size
-    vert_count = int(vert_length / vert_size)
-
-    print ("Found {} vertices".format(vert_count))
-
-    vertices = []
-
-    for current_vert_idx in range(vert_count):
-        vert_file_position = vert_offset + current_vert_idx * vert_size
-        current_vert = vert_chunk.unpack(file_data[vert_file_position : vert_file_position+vert_size])
-        vertices.append(vert_from_pack(current_vert))
-
-    return vertices
+    return {
+        "position": vert_data['position'].astype(np.float64) * scale_factor,
+        "uv": vert_data['texcoord'],
+        "lightmap_uv": vert_data['lightmap'],
+        "normal": vert_data['normal'],
+        "color": vert_data['color'],
+    }
 
 
 def load_indices(file_data, headers):    
     """
         int index
     """
-    index_offset, index_length = headers[11]
-    
-    index_size = 4 #We can take liberties here
-    index_count = int(index_length / index_size)
-    index_chunk = Struct("{}i".format(index_count))
-
-    return index_chunk.unpack(file_data[index_offset:index_offset+index_length])
+    return load_lump(file_data, headers, LUMP_MESHVERTS, np.dtype('<i4'))
 
 
-def load_materials(file_data, headers, base_path):
+def load_materials(file_data, headers):
     """
         string[64]  name        Texture name.
         int         flags       Surface flags.
         int         contents    Content flags.
+
+        Returns a (name, flags, contents) tuple per shader - the image files
+        are looked up by a TextureCache.
     """
+    texture_data = load_lump(file_data, headers, LUMP_TEXTURES, texture_dtype)
 
+    names = [name.decode("utf-8").replace('\x00', '').strip() for name in texture_data['name']]
 
-    def load_material_texture(texture_file):
-        filename = os.path.join(base_path, texture_file + ".jpg")
-        try:
-            img = bpy.data.images.load(str(filename))
-            cTex = bpy.data.textures.new('ColorTex', type = 'IMAGE')
-            cTex.image = img
-            return cTex
-        except:
-            print ("Cannot load image {}".format(filename))
-        return None
+    return list(zip(names, texture_data['flags'].tolist(), texture_data['contents'].tolist()))
 
 
-    def material_from_pack(material):
-        """ 
-            Extract just the data we want from the full chunk
-        """
-        texture_file_name = material[0].decode("utf-8").replace('\x00', '').strip()
-        return (
-            texture_file_name,
-            load_material_texture(texture_file_name)
-        )
-    texture_offset, texture_length = headers[1]
-    texture_chunk = Struct("64sii") 
-    texture_size = texture_chunk.size
-    texture_count = int(texture_length / texture_size)
-
-    textures = []
-    for current_texture_idx in range(texture_count):
-        texture_file_position = texture_offset + current_texture_idx * texture_size
-        packed_texture = texture_chunk.unpack(file_data[texture_file_position : texture_file_position+texture_size])
-        current_texture = material_from_pack(packed_texture)
-        textures.append(current_texture)
-    
-    return textures
+def load_faces_data(file_data, headers):
+    """
+        The raw face records, see load_faces for the layout
+    """
+    return load_lump(file_data, headers, LUMP_FACES, face_dtype)
 
 
-def load_faces(file_data, headers, indices):
+def load_faces(file_data, headers, indices, swap_winding=False):
     """
         int         texture     Texture index.
         int         effect      Index into lump 12 (Effects), or -1.
@@ -148,229 +181,2683 @@ def load_faces(file_data, headers, indices):
         float[2][3] lm_vecs     World space lightmap s and t unit vectors.
         float[3]    normal      Surface normal.
         int[2]      size        Patch dimensions.
+
+        Returns the triangles of all polygon and mesh faces, see
+        assemble_triangles.
     """
+    face_data = load_faces_data(file_data, headers)
 
+    return assemble_triangles(face_data, indices, swap_winding)
 
-    def swap_winding(indices):
-        return (indices[0], indices[2], indices[1])
-    
 
-    def indices_from_face(face_data):
-        base_vertex = face_data[3]
-        base_index = face_data[5]
-        index_count = face_data[6]
+def assemble_triangles(face_data, indices, swap_winding=False):
+    """
+        Gather the meshverts of every polygon (type 1) and mesh (type 3) face
+        in one go. Returns a dict holding the (N,3) int32 'triangles' array
+        and the 'texture' and source 'face' index of each triangle.
+    """
+    face_index = np.flatnonzero((face_data['type'] == 1) | (face_data['type'] == 3))
+    faces = face_data[face_index]
+
+    # Whole triangles only
+    counts = faces['n_meshverts'].astype(np.int64) // 3 * 3
+    starts = np.cumsum(counts) - counts
 
-        faces_indices = [base_vertex + indices[base_index + current_index] 
-                            for current_index in range(index_count)]
+    # Position of every meshvert in the index lump, and the vertex it is relative to
+    meshverts = np.arange(int(counts.sum())) + np.repeat(faces['meshvert'] - starts, counts)
+    base_vertex = np.repeat(faces['vertex'], counts)
 
-        #Split into lists of 3 - ie triangles
-        faces = []
-        for current_face_idx in range(0, len(faces_indices), 3):
-            faces.append(faces_indices[current_face_idx:current_face_idx+3])
+    triangles = (indices[meshverts] + base_vertex).astype(np.int32).reshape(-1, 3)
+    texture = np.repeat(faces['texture'], counts // 3).astype(np.int32)
+    face = np.repeat(face_index, counts // 3).astype(np.int32)
 
-        return faces
+    if swap_winding:
+        triangles = triangles[:, [0, 2, 1]]
 
+    return {
+        "triangles": triangles,
+        "texture": texture,
+        "face": face,
+    }
+
+
+lightmap_size = 128
 
-    def face_from_pack(face_data):
-        """ 
-            Extract just the data we want from the full chunk
-        """
-        triangle_list = indices_from_face(face_data)
-        return [(face_data[0], triangles,) for triangles in triangle_list]
 
-    face_offset, face_length = headers[13]
-    face_chunk = Struct("iiiiiiii2i2i3f3f3f3f2i") 
-    face_size = face_chunk.size
-    face_count = int(face_length / face_size)
+def load_lightmaps(file_data, headers):
+    """
+        ubyte[128][128][3] map     Lightmap color data. RGB.
+
+        Returns every lightmap as one (N,128,128,3) uint8 array.
+    """
+    lightmap_dtype = np.dtype(('u1', (lightmap_size, lightmap_size, 3)))
+    return load_lump(file_data, headers, LUMP_LIGHTMAPS, lightmap_dtype)
 
-    faces = []
 
-    for current_face_idx in range(face_count):
-        face_file_position = face_offset + current_face_idx * face_size
-        current_face = face_chunk.unpack(file_data[face_file_position : face_file_position+face_size])
+def correct_lightmaps(lightmaps, overbright_bits=1, gamma=1.0):
+    """
+        Brighten the lightmaps like the Q3 renderer does, scaling over bright
+        texels back so their brightest channel is 255 to keep the hue, then
+        gamma correct. Returns floats in 0-1.
+    """
+    colour = lightmaps.astype(np.float32) * np.float32(2 ** overbright_bits)
 
-        #Check we are a valid face (Could use a filter later)
-        if current_face[2] != 1: continue #Only support meshes at the moment
+    brightest = colour.max(axis=-1, keepdims=True)
+    colour *= np.float32(255.0) / np.maximum(brightest, np.float32(255.0))
+    colour /= np.float32(255.0)
+    np.minimum(colour, np.float32(1.0), out=colour)
 
-        new_faces = face_from_pack(current_face)
-        faces.extend(new_faces)
+    if gamma != 1.0:
+        colour **= np.float32(1.0 / gamma)
 
-    return faces
+    return colour
 
 
-def apply_uvs(mesh, bsp_verts):
+def pack_lightmap_atlas(lightmaps):
     """
-        Apply the UVs available in the BSP data to a Blender mesh
+        Tile the lightmaps into one roughly square image, lightmap n at
+        column n % columns, row n / columns counting from the top.
+        Returns the (height, width, channels) atlas, columns and rows.
     """
+    lightmap_count = len(lightmaps)
+    columns = max(int(np.ceil(np.sqrt(lightmap_count))), 1)
+    rows = max(int(np.ceil(lightmap_count / float(columns))), 1)
 
-    mesh.uv_textures.new("UVs")
-    bm = bmesh.new()
-    bm.from_mesh(mesh)
+    tiles = np.zeros((rows * columns,) + lightmaps.shape[1:], dtype=lightmaps.dtype)
+    tiles[:lightmap_count] = lightmaps
 
-    if hasattr(bm.faces, "ensure_lookup_table"): 
-        bm.faces.ensure_lookup_table()
+    height, width, channels = lightmaps.shape[1:]
+    atlas = (tiles.reshape(rows, columns, height, width, channels)
+                  .transpose(0, 2, 1, 3, 4)
+                  .reshape(rows * height, columns * width, channels))
 
-    uv_layer = bm.loops.layers.uv[0]
+    return atlas, columns, rows
 
-    for face_idx, current_face in enumerate(bm.faces):
-        current_face.loops[0][uv_layer].uv = bsp_verts[current_face.loops[0].vert.index][1]
-        current_face.loops[1][uv_layer].uv = bsp_verts[current_face.loops[1].vert.index][1]
-        current_face.loops[2][uv_layer].uv = bsp_verts[current_face.loops[2].vert.index][1]
-    
-    bm.to_mesh(mesh)
 
+def remap_lightmap_uvs(lightmap_uv, face_data, lightmap_count, columns, rows):
+    """
+        Move each vertex's lightmap UVs into the atlas tile of the lightmap its
+        face uses. Vertices of faces without a lightmap are left alone.
+    """
+    faces = face_data[(face_data['lm_index'] >= 0) & (face_data['lm_index'] < lightmap_count)]
+
+    counts = faces['n_vertexes'].astype(np.int64)
+    starts = np.cumsum(counts) - counts
+    face_vertices = np.arange(int(counts.sum())) + np.repeat(faces['vertex'] - starts, counts)
+
+    vertex_lightmap = np.full(len(lightmap_uv), -1, dtype=np.int64)
+    vertex_lightmap[face_vertices] = np.repeat(faces['lm_index'], counts)
+
+    lit = vertex_lightmap >= 0
+    tile = np.column_stack((vertex_lightmap[lit] % columns, vertex_lightmap[lit] // columns))
+
+    remapped = np.array(lightmap_uv, dtype=np.float32)
+    remapped[lit] = (tile + remapped[lit]) / np.array((columns, rows), dtype=np.float32)
 
-def create_mesh_from_data(mesh_name, bsp_verts, bsp_faces, materials, scale_factor):
+    return remapped
+
+
+def create_lightmap_image(name, atlas):
     """
-        Creates a blender mesh from the raw data loaded from a BSP - and the materials
-        created from the BSP.
+        Blender image from an atlas laid out top row first, like an image file
     """
+    height, width = atlas.shape[:2]
 
+    pixels = np.ones((height, width, 4), dtype=np.float32)
+    pixels[:, :, :3] = atlas
 
-    def vertex_stream(vertices, stream_id):
-        for vertex in vertices:
-            yield vertex[stream_id]
+    # Blender images start at the bottom row
+    pixels = np.ascontiguousarray(pixels[::-1]).ravel()
 
-    # Create mesh and object
-    me = bpy.data.meshes.new(mesh_name+'Mesh')
-    ob = bpy.data.objects.new("LEVEL" + mesh_name, me)
-    ob.show_name = True
+    image = bpy.data.images.new(name, width, height)
+    if hasattr(image.pixels, "foreach_set"):
+        image.pixels.foreach_set(pixels)
+    else:
+        image.pixels[:] = pixels.tolist()
 
-    # Link object to scene
-    bpy.context.scene.objects.link(ob)
-    
-    # Create the vertex data
-    face_list = list(vertex_stream(bsp_faces, 1))
-    mesh_verts = list(vertex_stream(bsp_verts, 0))
+    # Generated images are lost on save unless packed
+    try:
+        image.pack(as_png=True)
+    except TypeError:
+        image.pack()
 
-    me.from_pydata(mesh_verts, [], face_list)
+    return image
 
-    # Update mesh with new data
-    me.update()
-    apply_uvs(me, bsp_verts)
 
-    # Add materials to mesh
-    for cmaterial in materials:
-        me.materials.append(cmaterial)
+leaf_dtype = np.dtype([
+    ('cluster', '<i4'),
+    ('area', '<i4'),
+    ('mins', '<i4', (3,)),
+    ('maxs', '<i4', (3,)),
+    ('leafface', '<i4'),
+    ('n_leaffaces', '<i4'),
+    ('leafbrush', '<i4'),
+    ('n_leafbrushes', '<i4'),
+])
 
-    # Apply material indexes to mesh faces
-    face_materials = list(vertex_stream(bsp_faces, 0))
 
-    for polygon_idx, current_polygon in enumerate(me.polygons):
-        current_polygon.material_index = face_materials[polygon_idx]
+def load_leafs(file_data, headers):
+    """
+        int         cluster         Visdata cluster index.
+        int         area            Areaportal area.
+        int[3]      mins            Integer bounding box min coord.
+        int[3]      maxs            Integer bounding box max coord.
+        int         leafface        First leafface for leaf.
+        int         n_leaffaces     Number of leaffaces for leaf.
+        int         leafbrush       First leafbrush for leaf.
+        int         n_leafbrushes   Number of leafbrushes for leaf.
+    """
+    return load_lump(file_data, headers, LUMP_LEAFS, leaf_dtype)
 
-    # Add additional properties to the new object
-    ob['scale_factor'] = scale_factor
 
-    return ob
+def load_leaffaces(file_data, headers):
+    """
+        int face
+    """
+    return load_lump(file_data, headers, LUMP_LEAFFACES, np.dtype('<i4'))
 
 
-def create_materials_from_data(textures):
+def load_visdata(file_data, headers):
     """
-        Create all of the materials used by the BSP level.
+        int         n_vecs      Number of vectors.
+        int         sz_vecs     Size of each vector, in bytes.
+        ubyte[]     vecs        Visibility data. One bit per cluster per vector.
+
+        Returns the PVS still packed, as an (n_vecs, sz_vecs) uint8 array, or
+        None for maps without visdata.
     """
+    vis_offset, vis_length = headers[LUMP_VISDATA]
+    vis_header = Struct("ii")
 
-    materials = []
+    if vis_length < vis_header.size:
+        return None
 
-    #Set colour to incremenet from 0 - 8
-    colour_inc = 1.0 / len(textures)
-    colour = 0
+    n_vecs, sz_vecs = vis_header.unpack(file_data[vis_offset:vis_offset + vis_header.size])
+    vecs = np.frombuffer(file_data, dtype=np.uint8, count=n_vecs * sz_vecs,
+                         offset=vis_offset + vis_header.size)
 
-    for current_material in textures:
-        mat = bpy.data.materials.new(current_material[0])
-        mat.diffuse_color = (0, colour, 0,)
-        mat.diffuse_shader = 'LAMBERT' 
-        mat.diffuse_intensity = 1.0 
-        mat.specular_color = (1, 1, 1,)
-        mat.specular_shader = 'COOKTORR'
-        mat.specular_intensity = 0.5
-        mat.alpha = 1
-        mat.ambient = 1
-        mat.use_shadeless = True
-
-        mtex = mat.texture_slots.add()
-        mtex.texture = current_material[1]
-        mtex.texture_coords = 'UV'
-        mtex.use_map_color_diffuse = True 
+    return vecs.reshape(n_vecs, sz_vecs)
 
-        materials.append(mat)
-        colour += colour_inc
-        
-    return materials
 
+def unpack_visibility(packed_rows, cluster_count):
+    """
+        Expand packed PVS rows into an (rows, cluster_count) bool array. Bit
+        c % 8 of byte c / 8 is cluster c.
+    """
+    bits = np.unpackbits(packed_rows, axis=1).reshape(len(packed_rows), -1, 8)[:, :, ::-1]
+    return bits.reshape(len(packed_rows), -1)[:, :cluster_count].astype(bool)
 
-def read_some_data(context, filepath, scale_factor):
 
-    f = open(filepath, 'rb')
-    data = f.read()
-    f.close()
+def pack_visibility(bits):
+    """
+        Pack an (rows, columns) bool array the way unpack_visibility reads
+        it - bit c % 8 of byte c / 8 is column c.
+    """
+    padding = -bits.shape[1] % 8
+    if padding:
+        bits = np.concatenate((bits, np.zeros((len(bits), padding), dtype=bool)), axis=1)
+    return np.packbits(bits.reshape(len(bits), -1, 8)[:, :, ::-1], axis=2).reshape(len(bits), -1)
 
-    # would normally load the data here
-    bsp_header, file_position = load_bsp_header(data, 0)
-    chunk_headers, file_position = load_headers(data, file_position)
-    
-    # Load all the data from the BSP file
-    verts = load_verts(data, chunk_headers, scale_factor)
-    indices = load_indices(data, chunk_headers)
-    faces = load_faces(data, chunk_headers, indices)
-    textures = load_materials(data, chunk_headers, os.path.dirname(filepath))
 
-    # Create our blender objects
-    materials = create_materials_from_data (textures)
-    create_mesh_from_data("NewLevel", verts, faces, materials, scale_factor)
+def group_visibility(packed, group_size, chunk_size=1024):
+    """
+        Merge consecutive runs of group_size clusters into groups and work out
+        which groups each group can see. A group sees another when any of its
+        clusters sees any of the other's.
 
-    return {'FINISHED'}
+        Returns the table still packed like visdata, one row per group - bit
+        h % 8 of byte h / 8 of row g is set when group g sees group h.
+    """
+    cluster_count = len(packed)
+    if cluster_count == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
 
+    group_starts = np.arange(0, cluster_count, group_size)
 
-# ImportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-from bpy_extras.io_utils import ImportHelper
-from bpy.props import FloatProperty, StringProperty
-from bpy.types import Operator
+    # OR the rows of each group while still packed
+    group_rows = np.bitwise_or.reduceat(packed, group_starts, axis=0)
 
+    # Unpack a chunk of rows at a time to keep huge maps in memory
+    rows = []
+    for first_row in range(0, len(group_rows), chunk_size):
+        bits = unpack_visibility(group_rows[first_row:first_row + chunk_size], cluster_count)
+        if group_size > 1:
+            bits = np.logical_or.reduceat(bits, group_starts, axis=1)
+        rows.append(pack_visibility(bits))
 
-class ImportSomeData(Operator, ImportHelper):
-    """Import a Quake 3 BSP level"""
-    bl_idname = "import_test.some_data"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Import a Quake3 BSP"
+    return np.concatenate(rows)
 
-    # ImportHelper mixin class uses this
-    filename_ext = ".bsp"
 
-    filter_glob = StringProperty(
-            default="*.bsp",
-            options={'HIDDEN'},
-            )
+def face_clusters(leafs, leaffaces, face_count):
+    """
+        Every cluster each face is in, as an (n, 2) array of unique (face,
+        cluster) rows sorted by face. Faces in no cluster have no rows, faces
+        spanning several clusters have one row per cluster.
+    """
+    leafs = leafs[leafs['cluster'] >= 0]
 
-    # List of operator properties, the attributes will be assigned
-    # to the class instance from the operator settings before calling.
-    scale_factor = FloatProperty(
-            name="Scale factor",
-            description="Scale Factor ",
-            default=0.02,
-            )
+    counts = leafs['n_leaffaces'].astype(np.int64)
+    starts = np.cumsum(counts) - counts
+    entries = np.arange(int(counts.sum())) + np.repeat(leafs['leafface'] - starts, counts)
 
+    faces = leaffaces[entries]
+    clusters = np.repeat(leafs['cluster'], counts)
 
-    def execute(self, context):
-        return read_some_data(context, self.filepath, self.scale_factor)
+    valid = (faces >= 0) & (faces < face_count)
+    faces = faces[valid]
+    clusters = clusters[valid]
 
+    # Sort by face then cluster and drop the leafs repeating a pair
+    order = np.lexsort((clusters, faces))
+    pairs = np.column_stack((faces[order], clusters[order])).astype(np.int32)
+    if len(pairs):
+        unique = np.ones(len(pairs), dtype=bool)
+        unique[1:] = (pairs[1:] != pairs[:-1]).any(axis=1)
+        pairs = pairs[unique]
 
-# Only needed if you want to add into a dynamic menu
-def menu_func_import(self, context):
-    self.layout.operator(ImportSomeData.bl_idname, text="Quake 3 BSP Import")
+    return pairs
 
 
-def register():
-    bpy.utils.register_class(ImportSomeData)
-    bpy.types.INFO_MT_file_import.append(menu_func_import)
+model_dtype = np.dtype([
+    ('mins', '<f4', (3,)),
+    ('maxs', '<f4', (3,)),
+    ('face', '<i4'),
+    ('n_faces', '<i4'),
+    ('brush', '<i4'),
+    ('n_brushes', '<i4'),
+])
 
 
-def unregister():
-    bpy.utils.unregister_class(ImportSomeData)
-    bpy.types.INFO_MT_file_import.remove(menu_func_import)
+def load_models(file_data, headers):
+    """
+        float[3]    mins        Bounding box min coord.
+        float[3]    maxs        Bounding box max coord.
+        int         face        First face for model.
+        int         n_faces     Number of faces for model.
+        int         brush       First brush for model.
+        int         n_brushes   Number of brushes for model.
+
+        Model 0 is the worldspawn, the rest are the inline brush models of
+        doors, platforms and the like.
+    """
+    return load_lump(file_data, headers, LUMP_MODELS, model_dtype)
 
 
-if __name__ == "__main__":
+def face_models(models, face_count):
+    """
+        The model each face belongs to, -1 for faces no model claims
+    """
+    counts = models['n_faces'].astype(np.int64)
+    starts = np.cumsum(counts) - counts
+    faces = np.arange(int(counts.sum())) + np.repeat(models['face'] - starts, counts)
+    model_index = np.repeat(np.arange(len(models), dtype=np.int32), counts)
+
+    valid = (faces >= 0) & (faces < face_count)
+
+    face_model = np.full(face_count, -1, dtype=np.int32)
+    face_model[faces[valid]] = model_index[valid]
+
+    return face_model
+
+
+def face_bounds(face_data, positions):
+    """
+        Bounding box of every face's vertices - for patches the control
+        points, which contain the curved surface. Faces without vertices get
+        an empty (inf, -inf) box.
+    """
+    counts = np.maximum(face_data['n_vertexes'].astype(np.int64), 0)
+    starts = np.cumsum(counts) - counts
+    face_vertices = np.arange(int(counts.sum())) + np.repeat(face_data['vertex'] - starts, counts)
+    points = positions[face_vertices]
+
+    mins = np.full((len(face_data), 3), np.inf)
+    maxs = np.full((len(face_data), 3), -np.inf)
+
+    has_vertices = counts > 0
+    if has_vertices.any():
+        mins[has_vertices] = np.minimum.reduceat(points, starts[has_vertices], axis=0)
+        maxs[has_vertices] = np.maximum.reduceat(points, starts[has_vertices], axis=0)
+
+    return mins, maxs
+
+
+def boxes_intersect(mins, maxs, region_mins, region_maxs):
+    """
+        Which of the (N,3) boxes mins - maxs touch the region box
+    """
+    return np.all((mins <= region_maxs) & (maxs >= region_mins), axis=1)
+
+
+def faces_in_region(face_data, positions, face_model, models, region):
+    """
+        Faces to import for region, a (mins, maxs) pair of corners. Worldspawn
+        faces are picked one by one by their bounds, inline models are kept
+        or dropped whole by theirs.
+    """
+    corners = np.asarray(region, dtype=np.float64)
+    region_mins = corners.min(axis=0)
+    region_maxs = corners.max(axis=0)
+
+    mins, maxs = face_bounds(face_data, positions)
+    selected = boxes_intersect(mins, maxs, region_mins, region_maxs)
+
+    model_selected = boxes_intersect(models['mins'], models['maxs'], region_mins, region_maxs)
+    inline = face_model > 0
+    selected[inline] = model_selected[face_model[inline]]
+
+    return selected
+
+
+def load_entities(file_data, headers):
+    """
+        char[length] ents    Entity descriptions, stored as a string.
+
+        Returns the whole lump as one string
+    """
+    lump_offset, lump_length = headers[LUMP_ENTITIES]
+    text = bytes(file_data[lump_offset:lump_offset + lump_length])
+
+    return text.decode("utf-8", "replace").rstrip('\x00')
+
+
+# One match per token - a "key" "value" pair or a brace
+entity_token = re.compile(r'"([^"]*)"\s*"([^"]*)"|([{}])')
+
+entity_number = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+entity_integer = re.compile(r'[-+]?\d+')
+
+
+def parse_entities(text):
+    """
+        Tokenize the entity lump in a single regex pass over the whole
+        string. Returns a list of entities, each a dict of its key / value
+        strings.
+    """
+    entities = []
+    entity = None
+
+    for key, value, brace in entity_token.findall(text):
+        if brace == '{':
+            entity = {}
+        elif brace == '}':
+            if entity is not None:
+                entities.append(entity)
+            entity = None
+        elif entity is not None:
+            entity[key] = value
+
+    return entities
+
+
+def entity_value(text):
+    """
+        A number as an int or float, a space separated vector as a tuple of
+        floats, anything else as the string.
+    """
+    parts = text.split()
+    if not parts or not all(entity_number.fullmatch(part) for part in parts):
+        return text
+
+    if len(parts) > 1:
+        return tuple(float(part) for part in parts)
+    if entity_integer.fullmatch(parts[0]):
+        return int(parts[0])
+    return float(parts[0])
+
+
+def entity_table(entities):
+    """
+        The entities as typed columns: classname, origin (N,3 - NaN where an
+        entity has none), angle (yaw in degrees) and properties, each
+        entity's typed key / values without its origin.
+    """
+    entity_count = len(entities)
+
+    classnames = []
+    properties = []
+    origin = np.full((entity_count, 3), np.nan)
+    angle = np.zeros(entity_count)
+
+    # Most values repeat across entities, only type each distinct one once
+    typed_values = {}
+
+    for index, entity in enumerate(entities):
+        classnames.append(entity.get('classname', ''))
+
+        typed = {}
+        for key, value in entity.items():
+            typed_value = typed_values.get(value)
+            if typed_value is None:
+                typed_value = typed_values[value] = entity_value(value)
+            typed[key] = typed_value
+
+        entity_origin = typed.pop('origin', None)
+        if isinstance(entity_origin, tuple) and len(entity_origin) == 3:
+            origin[index] = entity_origin
+
+        if isinstance(typed.get('angles'), tuple) and len(typed['angles']) == 3:
+            angle[index] = typed['angles'][1]
+        elif isinstance(typed.get('angle'), (int, float)):
+            angle[index] = typed['angle']
+
+        properties.append(typed)
+
+    return {
+        "classname": classnames,
+        "origin": origin,
+        "angle": angle,
+        "properties": properties,
+    }
+
+
+plane_dtype = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('dist', '<f4'),
+])
+
+brush_dtype = np.dtype([
+    ('brushside', '<i4'),
+    ('n_brushsides', '<i4'),
+    ('texture', '<i4'),
+])
+
+brushside_dtype = np.dtype([
+    ('plane', '<i4'),
+    ('texture', '<i4'),
+])
+
+# Texture content flags
+CONTENTS_SOLID = 0x1
+CONTENTS_PLAYERCLIP = 0x10000
+
+
+def load_planes(file_data, headers):
+    """
+        float[3]    normal      Plane normal.
+        float       dist        Distance from origin to plane along normal.
+    """
+    return load_lump(file_data, headers, LUMP_PLANES, plane_dtype)
+
+
+def load_brushes(file_data, headers):
+    """
+        int         brushside       First brushside for brush.
+        int         n_brushsides    Number of brushsides for brush.
+        int         texture         Texture index.
+    """
+    return load_lump(file_data, headers, LUMP_BRUSHES, brush_dtype)
+
+
+def load_brushsides(file_data, headers):
+    """
+        int         plane       Plane index.
+        int         texture     Texture index.
+    """
+    return load_lump(file_data, headers, LUMP_BRUSHSIDES, brushside_dtype)
+
+
+def collision_brushes(brushes, textures, models, contents_mask):
+    """
+        Index of every worldspawn brush whose texture has any of the
+        contents_mask flags. Inline model brushes move, they are left out.
+    """
+    contents = np.array([texture[2] for texture in textures] + [0], dtype=np.int64)
+
+    brush_texture = brushes['texture'].astype(np.int64)
+    brush_texture[(brush_texture < 0) | (brush_texture >= len(textures))] = len(textures)
+
+    selected = (contents[brush_texture] & contents_mask) != 0
+
+    if len(models):
+        world = np.zeros(len(brushes), dtype=bool)
+        world[models[0]['brush']:models[0]['brush'] + models[0]['n_brushes']] = True
+        selected &= world
+
+    return np.flatnonzero(selected)
+
+
+def brush_hulls(planes, brushes, brushsides, brush_index, epsilon=0.01, chunk_size=1 << 22):
+    """
+        Convex hull of each brush in brush_index by half-space intersection.
+        Brushes are bucketed by side count. For each bucket, every triple of
+        planes is intersected at once. The corners inside all of a brush's
+        planes are kept, and each side's corners, sorted by angle, become a
+        polygon facing out.
+
+        Returns a dict of 'position' (V,3), 'vertex_index' (L,) with
+        'loop_start' / 'loop_total' per polygon, and the 'brush' and
+        'texture' of each polygon.
+    """
+    brush_index = np.asarray(brush_index, dtype=np.int64)
+    side_counts = brushes['n_brushsides'][brush_index]
+
+    positions = []
+    polygon_loops = []
+    polygon_starts = []
+    polygon_totals = []
+    polygon_brushes = []
+    polygon_textures = []
+    vertex_count = 0
+    loop_count = 0
+
+    for side_count in np.unique(side_counts).tolist():
+        if side_count < 4:
+            continue
+
+        bucket = brush_index[side_counts == side_count]
+        triples = np.array([(i, j, k) for i in range(side_count)
+                            for j in range(i + 1, side_count)
+                            for k in range(j + 1, side_count)])
+
+        # Bound the (brushes, triples, sides) temporaries
+        rows = max(1, chunk_size // (len(triples) * side_count))
+
+        for first in range(0, len(bucket), rows):
+            chunk = bucket[first:first + rows]
+            sides = brushes['brushside'][chunk][:, None] + np.arange(side_count)
+            plane_index = brushsides['plane'][sides]
+
+            normals = planes['normal'][plane_index].astype(np.float64)
+            dists = planes['dist'][plane_index].astype(np.float64)
+
+            # Intersection point of three planes:
+            # (d1 (n2 x n3) + d2 (n3 x n1) + d3 (n1 x n2)) / n1 . (n2 x n3)
+            n1, n2, n3 = (normals[:, triples[:, axis]] for axis in range(3))
+            d1, d2, d3 = (dists[:, triples[:, axis], None] for axis in range(3))
+
+            c23 = np.cross(n2, n3)
+            det = np.einsum('bci,bci->bc', n1, c23)
+            corner = np.abs(det) > 1e-6
+
+            points = d1 * c23 + d2 * np.cross(n3, n1) + d3 * np.cross(n1, n2)
+            points /= np.where(corner, det, 1.0)[:, :, None]
+
+            distance = np.einsum('bci,bni->bcn', points, normals) - dists[:, None, :]
+            corner &= (distance <= epsilon).all(axis=2)
+
+            row, triple = np.nonzero(corner)
+            if len(row) == 0:
+                continue
+
+            # Corners where more than three planes meet come out several times
+            grid = np.round(points[row, triple] / epsilon).astype(np.int64)
+            first_corner, vertex = unique_rows(np.column_stack((row, grid)))
+            corner_row = row[first_corner]
+            corner_points = points[row, triple][first_corner]
+            on_plane = np.abs(distance[row, triple][first_corner]) <= epsilon
+
+            # One polygon per (brush, side) with three or more corners
+            corner_id, side = np.nonzero(on_plane)
+            polygon = corner_row[corner_id] * side_count + side
+            polygon_size = np.bincount(polygon, minlength=len(chunk) * side_count)
+            keep = polygon_size[polygon] >= 3
+            corner_id = corner_id[keep]
+            polygon = polygon[keep]
+
+            # Sort each polygon's corners counter clockwise around its normal
+            face_normal = normals.reshape(-1, 3)[polygon]
+            centre = np.zeros((len(chunk) * side_count, 3))
+            np.add.at(centre, polygon, corner_points[corner_id])
+            centre /= np.maximum(polygon_size, 1)[:, None]
+
+            axis = np.where(np.abs(face_normal[:, :1]) < 0.9, [[1.0, 0.0, 0.0]], [[0.0, 1.0, 0.0]])
+            u = np.cross(face_normal, axis)
+            v = np.cross(face_normal, u)
+            offset = corner_points[corner_id] - centre[polygon]
+            angle = np.arctan2(np.einsum('ij,ij->i', offset, v), np.einsum('ij,ij->i', offset, u))
+
+            order = np.lexsort((angle, polygon))
+            polygon = polygon[order]
+            loops = corner_id[order]
+
+            polygons, starts, totals = np.unique(polygon, return_index=True, return_counts=True)
+
+            positions.append(corner_points)
+            polygon_loops.append(loops + vertex_count)
+            polygon_starts.append(starts + loop_count)
+            polygon_totals.append(totals)
+            polygon_brushes.append(chunk[polygons // side_count])
+            polygon_textures.append(brushsides['texture'][sides.ravel()[polygons]])
+
+            vertex_count += len(corner_points)
+            loop_count += len(loops)
+
+    def joined(arrays, dtype, shape=(0,)):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(shape, dtype=dtype)
+
+    return {
+        "position": joined(positions, np.float64, (0, 3)),
+        "vertex_index": joined(polygon_loops, np.int32),
+        "loop_start": joined(polygon_starts, np.int32),
+        "loop_total": joined(polygon_totals, np.int32),
+        "brush": joined(polygon_brushes, np.int32),
+        "texture": joined(polygon_textures, np.int32),
+    }
+
+
+def hulls_in_region(hulls, region):
+    """
+        Only the polygons of brushes whose hull touches region, a (mins,
+        maxs) pair of corners, with the unused vertices dropped
+    """
+    corners = np.asarray(region, dtype=np.float64)
+
+    loop_polygon = np.repeat(np.arange(len(hulls['loop_start'])), hulls['loop_total'])
+    loop_brush = hulls['brush'][loop_polygon]
+    loop_points = hulls['position'][hulls['vertex_index']]
+
+    brushes, loop_slot = np.unique(loop_brush, return_inverse=True)
+    mins = np.full((len(brushes), 3), np.inf)
+    maxs = np.full((len(brushes), 3), -np.inf)
+    np.minimum.at(mins, loop_slot, loop_points)
+    np.maximum.at(maxs, loop_slot, loop_points)
+
+    brush_selected = boxes_intersect(mins, maxs, corners.min(axis=0), corners.max(axis=0))
+    selected = brush_selected[np.searchsorted(brushes, hulls['brush'])]
+
+    loops = np.repeat(selected, hulls['loop_total'])
+    used, vertex_index = np.unique(hulls['vertex_index'][loops], return_inverse=True)
+    totals = hulls['loop_total'][selected]
+
+    return {
+        "position": hulls['position'][used],
+        "vertex_index": vertex_index.ravel().astype(np.int32),
+        "loop_start": (np.cumsum(totals) - totals).astype(np.int32),
+        "loop_total": totals,
+        "brush": hulls['brush'][selected],
+        "texture": hulls['texture'][selected],
+    }
+
+
+def split_mesh(verts, faces, triangle_mask):
+    """
+        The triangles selected by triangle_mask, with only the vertices they
+        use, renumbered.
+    """
+    triangles = faces['triangles'][triangle_mask]
+    used, remapped = np.unique(triangles, return_inverse=True)
+
+    split_verts = dict((stream, verts[stream][used]) for stream in verts)
+    split_faces = dict((stream, faces[stream][triangle_mask]) for stream in faces)
+    split_faces['triangles'] = remapped.reshape(-1, 3).astype(np.int32)
+
+    return split_verts, split_faces
+
+
+def unique_rows(rows):
+    """
+        np.unique over whole rows of a 2D array. Returns the index of the
+        first occurrence of each unique row and the inverse mapping.
+    """
+    rows = np.ascontiguousarray(rows)
+    row_view = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(row_view, return_index=True, return_inverse=True)
+
+    return first, inverse.ravel()
+
+
+# Grid size of the vertex streams other than position when welding
+weld_stream_tolerances = {
+    "uv": 1.0 / 4096,
+    "lightmap_uv": 1.0 / 4096,
+    "normal": 1.0 / 1024,
+}
+
+
+def weld_vertices(verts, faces, tolerance):
+    """
+        Merge vertices that fall in the same cell of a tolerance sized grid
+        and also agree on their UVs, lightmap UVs, normal and colour, so UV
+        and hard edge seams survive. Triangles left with a repeated corner
+        are dropped.
+    """
+    keys = []
+    for stream in sorted(verts):
+        values = verts[stream].reshape(len(verts[stream]), -1)
+
+        if stream == 'position':
+            keys.append(np.floor(values / tolerance + 0.5).astype(np.int64))
+        elif values.dtype.kind == 'f':
+            keys.append(np.floor(values / weld_stream_tolerances.get(stream, 1e-6) + 0.5).astype(np.int64))
+        else:
+            keys.append(values.astype(np.int64))
+
+    first, inverse = unique_rows(np.column_stack(keys))
+
+    welded_verts = dict((stream, verts[stream][first]) for stream in verts)
+
+    triangles = inverse[faces['triangles']]
+    kept = ((triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &
+            (triangles[:, 2] != triangles[:, 0]))
+
+    welded_faces = dict((stream, faces[stream][kept]) for stream in faces)
+    welded_faces['triangles'] = triangles[kept].astype(np.int32)
+
+    return welded_verts, welded_faces
+
+
+def material_ranges(texture):
+    """
+        (texture, first triangle, triangle count) rows when each texture's
+        triangles are one contiguous run, otherwise None
+    """
+    if len(texture) == 0:
+        return None
+
+    starts = np.concatenate(([0], np.flatnonzero(texture[1:] != texture[:-1]) + 1))
+    if len(starts) != len(np.unique(texture)):
+        return None
+
+    counts = np.diff(np.append(starts, len(texture)))
+    return np.column_stack((texture[starts], starts, counts)).astype(np.int32)
+
+
+def batch_by_material(verts, faces):
+    """
+        Stable sort of the triangles by texture, so every material is one
+        contiguous range and one draw call. The vertices are renumbered in
+        order of first use.
+    """
+    order = np.argsort(faces['texture'], kind='stable')
+    batched_faces = dict((stream, faces[stream][order]) for stream in faces)
+
+    used, first_use = np.unique(batched_faces['triangles'].ravel(), return_index=True)
+    vertex_order = used[np.argsort(first_use)]
+
+    remap = np.zeros(len(verts['position']), dtype=np.int32)
+    remap[vertex_order] = np.arange(len(vertex_order), dtype=np.int32)
+
+    batched_faces['triangles'] = remap[batched_faces['triangles']]
+    batched_verts = dict((stream, verts[stream][vertex_order]) for stream in verts)
+
+    return batched_verts, batched_faces
+
+
+def weld_level(level, tolerance):
+    """
+        Copy of a scaled level with its vertices welded and its triangles
+        batched by material, see weld_vertices and batch_by_material
+    """
+    verts, faces = weld_vertices(level['verts'], level['faces'], tolerance)
+    verts, faces = batch_by_material(verts, faces)
+
+    welded = dict(level)
+    welded['verts'] = verts
+    welded['faces'] = faces
+    welded['material_ranges'] = material_ranges(faces['texture'])
+    welded['stats'] = dict(level['stats'], vertices=len(verts['position']), triangles=len(faces['triangles']))
+
+    return welded
+
+
+def tessellate_patches(face_data, verts, lod, swap_winding=False, stitch_tolerance=1e-4):
+    """
+        Tessellate every patch face (type 2) at lod segments per 3x3 control
+        grid. A face of size w x h holds ((w-1)/2) * ((h-1)/2) biquadratic
+        grids sharing their border control points - all grids of all patches
+        are evaluated together.
+
+        Returns a dict of vertex columns laid out like load_verts, plus
+        'triangles' (N,3) indexing those columns and the 'texture' and
+        source 'face' of each triangle.
+
+        Border samples that land within stitch_tolerance of each other are
+        merged, which closes seams between neighbouring grids and patches
+        that split their shared edge the same way. An edge split into a
+        different number of grids on each side still leaves T-junctions,
+        and small cracks along them.
+    """
+    patch_index = np.flatnonzero(face_data['type'] == 2)
+    patches = face_data[patch_index]
+
+    width = patches['size'][:, 0].astype(np.int64)
+    height = patches['size'][:, 1].astype(np.int64)
+    grids_x = (width - 1) // 2
+    grids_y = (height - 1) // 2
+    grid_counts = np.maximum(grids_x, 0) * np.maximum(grids_y, 0)
+    grid_count = int(grid_counts.sum())
+
+    # One row per 3x3 grid - which patch it came from and where in it it sits
+    grid_patch = np.repeat(np.arange(len(patches)), grid_counts)
+    grid_local = np.arange(grid_count) - np.repeat(np.cumsum(grid_counts) - grid_counts, grid_counts)
+    grid_x = grid_local % grids_x[grid_patch]
+    grid_y = grid_local // grids_x[grid_patch]
+
+    grid_width = width[grid_patch]
+    grid_base = patches['vertex'][grid_patch] + 2 * grid_y * grid_width + 2 * grid_x
+
+    # (grids, row, column) vertex indices of the control points
+    step = np.arange(3)
+    control = (grid_base[:, None, None]
+               + step[None, :, None] * grid_width[:, None, None]
+               + step[None, None, :])
+
+    # Quadratic bernstein basis at the lod + 1 samples along each edge, then
+    # the weight of each of the 9 control points for every sample of a grid
+    t = np.linspace(0.0, 1.0, lod + 1)
+    basis = np.column_stack(((1.0 - t) ** 2, 2.0 * t * (1.0 - t), t ** 2))
+    weights = (basis[:, None, :, None] * basis[None, :, None, :]).reshape((lod + 1) ** 2, 9)
+
+    control = control.reshape(-1, 9)
+
+    def evaluate(stream):
+        control_values = stream[control].astype(np.float64)
+        return np.einsum('sk,gkc->gsc', weights, control_values).reshape(-1, stream.shape[1])
+
+    position = evaluate(verts['position'])
+    uv = evaluate(verts['uv'])
+    lightmap_uv = evaluate(verts['lightmap_uv'])
+
+    normal = evaluate(verts['normal'])
+    normal_length = np.sqrt((normal ** 2).sum(axis=1))
+    normal /= np.where(normal_length > 0.0, normal_length, 1.0)[:, None]
+
+    color = np.clip(np.rint(evaluate(verts['color'])), 0, 255).astype(np.uint8)
+
+    # Two triangles per quad of each lod x lod grid
+    row = lod + 1
+    quad_a, quad_b = np.meshgrid(np.arange(lod), np.arange(lod), indexing='ij')
+    corner = (quad_a * row + quad_b).ravel()
+    grid_triangles = np.concatenate((
+        np.column_stack((corner, corner + 1, corner + row)),
+        np.column_stack((corner + 1, corner + row + 1, corner + row)),
+    ))
+
+    samples = row * row
+    triangles = (grid_triangles[None, :, :]
+                 + (np.arange(grid_count) * samples)[:, None, None]).reshape(-1, 3)
+    texture = np.repeat(patches['texture'][grid_patch], len(grid_triangles))
+    face = np.repeat(patch_index[grid_patch], len(grid_triangles))
+
+    # Stitch - grid borders evaluated from different patches (or in the
+    # opposite direction) can disagree in the last bits, snap them together.
+    # Only samples that already coincide are merged, see above.
+    border = np.zeros((row, row), dtype=bool)
+    border[[0, -1], :] = True
+    border[:, [0, -1]] = True
+    border = np.tile(border.ravel(), grid_count)
+
+    border_keys = np.rint(position[border] / stitch_tolerance).astype(np.int64)
+    first, inverse = unique_rows(border_keys)
+    position[border] = position[border][first][inverse]
+
+    # Samples shared by neighbouring grids of the same patch are now
+    # identical, weld them
+    first, inverse = unique_rows(np.concatenate((position, uv, lightmap_uv), axis=1))
+    triangles = inverse[triangles]
+
+    # Match the winding of the polygon faces, whose triangles face away
+    # from their vertex normals
+    corners = position[first][triangles]
+    face_normal = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    facing = (face_normal * normal[first][triangles].sum(axis=1)).sum(axis=1)
+    flip = (facing > 0.0) != swap_winding
+    triangles[flip] = triangles[flip][:, [0, 2, 1]]
+
+    return {
+        "position": position[first],
+        "uv": uv[first].astype(np.float32),
+        "lightmap_uv": lightmap_uv[first].astype(np.float32),
+        "normal": normal[first].astype(np.float32),
+        "color": color[first],
+        "triangles": triangles.astype(np.int32),
+        "texture": texture.astype(np.int32),
+        "face": face.astype(np.int32),
+    }
+
+
+def merge_patches(verts, faces, patches):
+    """
+        Append tessellated patch geometry to the level vertices and triangles
+    """
+    base_vertex = len(verts['position'])
+    merged_verts = dict((stream, np.concatenate((verts[stream], patches[stream])))
+                        for stream in verts)
+
+    merged_faces = {
+        "triangles": np.concatenate((faces['triangles'], patches['triangles'] + base_vertex)),
+        "texture": np.concatenate((faces['texture'], patches['texture'])),
+        "face": np.concatenate((faces['face'], patches['face'])),
+    }
+
+    return merged_verts, merged_faces
+
+
+def build_mesh_buffers(positions, triangles, face_materials, uvs, normals=None, colors=None,
+                       lightmap_uvs=None):
+    """
+        Flat arrays ready for foreach_set - one loop per triangle corner and
+        the UVs already expanded from per vertex to per loop. Normals, RGBA
+        colours and lightmap UVs are expanded the same way when given.
+    """
+    triangle_count = len(triangles)
+    loop_vertices = triangles.ravel()
+
+    buffers = {
+        "co": np.ascontiguousarray(positions, dtype=np.float32).ravel(),
+        "vertex_index": np.ascontiguousarray(loop_vertices, dtype=np.int32),
+        "loop_start": np.arange(0, triangle_count * 3, 3, dtype=np.int32),
+        "loop_total": np.full(triangle_count, 3, dtype=np.int32),
+        "material_index": np.ascontiguousarray(face_materials, dtype=np.int32),
+        "uv": np.ascontiguousarray(uvs[loop_vertices], dtype=np.float32).ravel(),
+    }
+
+    if normals is not None:
+        buffers['normal'] = np.ascontiguousarray(normals[loop_vertices], dtype=np.float32).reshape(-1, 3)
+
+    if colors is not None:
+        buffers['color'] = (colors[loop_vertices] / np.float32(255.0)).astype(np.float32)
+
+    if lightmap_uvs is not None:
+        buffers['lightmap_uv'] = np.ascontiguousarray(lightmap_uvs[loop_vertices], dtype=np.float32).ravel()
+
+    return buffers
+
+
+def add_uv_layer(mesh, name):
+    """
+        New UV layer across Blender versions, returns the layer holding the loop data
+    """
+    if hasattr(mesh, "uv_textures"):
+        mesh.uv_textures.new(name)
+    else:
+        mesh.uv_layers.new(name=name)
+
+    return mesh.uv_layers[name]
+
+
+def fill_mesh(mesh, buffers):
+    """
+        Fill an empty mesh from build_mesh_buffers output with bulk foreach_set
+        calls only.
+    """
+    vertex_count = len(buffers['co']) // 3
+    loop_count = len(buffers['vertex_index'])
+    polygon_count = len(buffers['loop_start'])
+
+    mesh.vertices.add(vertex_count)
+    mesh.vertices.foreach_set("co", buffers['co'])
+
+    mesh.loops.add(loop_count)
+    mesh.loops.foreach_set("vertex_index", buffers['vertex_index'])
+
+    mesh.polygons.add(polygon_count)
+    mesh.polygons.foreach_set("loop_start", buffers['loop_start'])
+    mesh.polygons.foreach_set("loop_total", buffers['loop_total'])
+    mesh.polygons.foreach_set("material_index", buffers['material_index'])
+
+    if 'uv' in buffers:
+        uv_layer = add_uv_layer(mesh, "UVs")
+        uv_layer.data.foreach_set("uv", buffers['uv'])
+
+    if 'lightmap_uv' in buffers:
+        uv_layer = add_uv_layer(mesh, "LightmapUVs")
+        uv_layer.data.foreach_set("uv", buffers['lightmap_uv'])
+
+    mesh.update(calc_edges=True)
+
+    if 'normal' in buffers:
+        apply_custom_normals(mesh, buffers['normal'])
+
+    if 'color' in buffers:
+        apply_vertex_colors(mesh, "Col", buffers['color'])
+
+
+def apply_custom_normals(mesh, loop_normals):
+    """
+        Store the BSP normals as custom split normals so Blender keeps them
+        rather than recomputing smooth normals.
+    """
+    if hasattr(mesh, "create_normals_split"):
+        mesh.create_normals_split()
+
+    if hasattr(mesh, "use_auto_smooth"):
+        mesh.use_auto_smooth = True
+
+    mesh.normals_split_custom_set(loop_normals)
+
+
+def apply_vertex_colors(mesh, name, loop_colors):
+    """
+        Add a vertex colour layer from per loop RGBA colours. Older Blenders
+        only store RGB per loop, the alpha is dropped there.
+    """
+    color_layer = mesh.vertex_colors.new(name=name)
+
+    color_size = len(color_layer.data[0].color) if len(color_layer.data) else 4
+    color_layer.data.foreach_set("color", np.ascontiguousarray(loop_colors[:, :color_size]).ravel())
+
+
+def create_mesh_object(object_name, mesh_name, bsp_verts, faces, materials,
+                       import_normals=False, import_colors=False, lightmap=None):
+    """
+        Creates and links a mesh object from BSP vertices and triangles
+    """
+
+    # Create mesh and object
+    me = bpy.data.meshes.new(mesh_name+'Mesh')
+    ob = bpy.data.objects.new(object_name, me)
+    ob.show_name = True
+
+    # Link object to scene
+    bpy.context.scene.objects.link(ob)
+    
+    # Add materials to mesh
+    for cmaterial in materials:
+        me.materials.append(cmaterial)
+
+    # Create the vertex, face, material index and UV data in bulk
+    buffers = build_mesh_buffers(bsp_verts['position'], faces['triangles'], faces['texture'], bsp_verts['uv'],
+                                 normals=bsp_verts['normal'] if import_normals else None,
+                                 colors=bsp_verts['color'] if import_colors else None,
+                                 lightmap_uvs=bsp_verts['lightmap_uv'] if lightmap is not None else None)
+    fill_mesh(me, buffers)
+
+    if lightmap is not None:
+        ob['lightmap'] = lightmap.name
+
+    # Triangles batched by material - one range, and draw call, per material
+    ranges = material_ranges(faces['texture'])
+    if ranges is not None:
+        ob['material_ranges'] = ranges.ravel().tolist()
+
+    return ob
+
+
+def create_mesh_from_data(mesh_name, bsp_verts, faces, materials, scale_factor,
+                          import_normals=False, import_colors=False, lightmap=None):
+    """
+        Creates a blender mesh from the raw data loaded from a BSP - and the materials
+        created from the BSP.
+    """
+    ob = create_mesh_object("LEVEL" + mesh_name, mesh_name, bsp_verts, faces, materials,
+                            import_normals, import_colors, lightmap)
+
+    # Add additional properties to the new object
+    ob['scale_factor'] = scale_factor
+
+    return ob
+
+
+def create_cluster_objects(mesh_name, bsp_verts, faces, face_cluster, visdata, group_size,
+                           materials, scale_factor, import_normals=False, import_colors=False,
+                           lightmap=None):
+    """
+        Split the level into one object per group of group_size visibility
+        clusters. A face in clusters from several groups goes in each of
+        them, so every group object is whole. The LEVEL object keeps the
+        materials and properties the scene exporter reads, the cluster
+        objects are parented to it. The group visibility table is stored on
+        the LEVEL object still packed, as the bytes 'pvs' with rows of
+        'pvs_row_bytes' - see group_visibility.
+    """
+    empty_verts = dict((stream, bsp_verts[stream][:0]) for stream in bsp_verts)
+    empty_faces = dict((stream, faces[stream][:0]) for stream in faces)
+    level = create_mesh_from_data(mesh_name, empty_verts, empty_faces, materials, scale_factor)
+
+    if visdata is not None:
+        pvs = group_visibility(visdata, group_size)
+        level['pvs'] = pvs.tobytes()
+        level['pvs_row_bytes'] = pvs.shape[1]
+    level['cluster_group_size'] = group_size
+
+    # (face, group) pairs, a face once per group
+    face_group = np.column_stack((face_cluster[:, 0], face_cluster[:, 1] // group_size))
+    if len(face_group):
+        unique = np.ones(len(face_group), dtype=bool)
+        unique[1:] = (face_group[1:] != face_group[:-1]).any(axis=1)
+        face_group = face_group[unique]
+
+    face_count = max(int(faces['face'].max()) + 1 if len(faces['face']) else 0,
+                     int(face_group[:, 0].max()) + 1 if len(face_group) else 0)
+
+    def triangle_mask(face_index):
+        in_faces = np.zeros(face_count, dtype=bool)
+        in_faces[face_index] = True
+        return in_faces[faces['face']]
+
+    groups = np.unique(face_group[:, 1])
+    unclustered = ~triangle_mask(face_group[:, 0])
+
+    group_masks = [(group, triangle_mask(face_group[face_group[:, 1] == group, 0]))
+                   for group in groups.tolist()]
+    if unclustered.any():
+        group_masks.insert(0, (-1, unclustered))
+
+    for group, mask in group_masks:
+        group_verts, group_faces = split_mesh(bsp_verts, faces, mask)
+
+        if group < 0:
+            object_name = "CLUSTER{}.Unclustered".format(mesh_name)
+        else:
+            object_name = "CLUSTER{}.{}".format(mesh_name, group)
+
+        ob = create_mesh_object(object_name, "{}Cluster{}".format(mesh_name, group),
+                                group_verts, group_faces, materials,
+                                import_normals, import_colors, lightmap)
+        ob.show_name = False
+        ob.parent = level
+        ob['cluster_group'] = group
+
+    return level
+
+
+def split_by_model(bsp_verts, faces, face_model):
+    """
+        Separate the worldspawn from the inline brush models. Returns the
+        worldspawn's verts and faces - including any faces no model claims -
+        and a (model, verts, faces) tuple for each inline model.
+    """
+    triangle_model = face_model[faces['face']]
+    world = triangle_model <= 0
+    if world.all():
+        return bsp_verts, faces, []
+
+    world_verts, world_faces = split_mesh(bsp_verts, faces, world)
+
+    model_parts = []
+    for model in np.unique(triangle_model[~world]).tolist():
+        model_verts, model_faces = split_mesh(bsp_verts, faces, triangle_model == model)
+        model_parts.append((model, model_verts, model_faces))
+
+    return world_verts, world_faces, model_parts
+
+
+def create_model_objects(mesh_name, level, model_parts, model_bounds, materials,
+                         import_normals=False, import_colors=False, lightmap=None):
+    """
+        One object per inline brush model, parented to the LEVEL object. The
+        geometry stays in world space, the model's bounds are stored on it.
+    """
+    objects = []
+
+    for model, model_verts, model_faces in model_parts:
+        ob = create_mesh_object("MODEL{}.{}".format(mesh_name, model), "{}Model{}".format(mesh_name, model),
+                                model_verts, model_faces, materials,
+                                import_normals, import_colors, lightmap)
+        ob.show_name = False
+        ob.parent = level
+        ob['model_index'] = model
+        ob['bounds_min'] = model_bounds[model, 0].tolist()
+        ob['bounds_max'] = model_bounds[model, 1].tolist()
+        objects.append(ob)
+
+    return objects
+
+
+def create_collision_object(mesh_name, level, hulls, materials):
+    """
+        One low poly object holding every collision hull polygon, parented
+        to the LEVEL object. Each polygon's material is its brush side's.
+    """
+    me = bpy.data.meshes.new(mesh_name + 'CollisionMesh')
+    ob = bpy.data.objects.new("COLLISION" + mesh_name, me)
+
+    bpy.context.scene.objects.link(ob)
+
+    for cmaterial in materials:
+        me.materials.append(cmaterial)
+
+    fill_mesh(me, {
+        "co": np.ascontiguousarray(hulls['position'], dtype=np.float32).ravel(),
+        "vertex_index": hulls['vertex_index'],
+        "loop_start": hulls['loop_start'],
+        "loop_total": hulls['loop_total'],
+        "material_index": np.clip(hulls['texture'], 0, max(len(materials) - 1, 0)).astype(np.int32),
+    })
+
+    # Blender 2.8 renamed draw_type
+    if hasattr(ob, "draw_type"):
+        ob.draw_type = 'WIRE'
+    else:
+        ob.display_type = 'WIRE'
+
+    ob.parent = level
+    ob['brush_count'] = len(np.unique(hulls['brush']))
+
+    return ob
+
+
+# Entities exported as cameras by the scene exporter, everything else with an origin is a prop
+camera_classnames = (
+    "info_player_start",
+    "info_player_deathmatch",
+    "info_player_intermission",
+    "team_CTF_redplayer",
+    "team_CTF_blueplayer",
+    "team_CTF_redspawn",
+    "team_CTF_bluespawn",
+)
+
+
+def entity_light_color(value):
+    """
+        _color as an RGB tuple in 0 - 1, whichever range the map used
+    """
+    if not isinstance(value, tuple) or len(value) != 3:
+        return (1.0, 1.0, 1.0)
+
+    brightest = max(value)
+    if brightest > 1.0:
+        return tuple(component / brightest for component in value)
+    return tuple(value)
+
+
+def create_entity_objects(entities, scale_factor, level, model_objects=(), region=None):
+    """
+        Spawn points become CAMERA empties, lights become PROP lamps and the
+        other point entities PROP empties, all parented to the LEVEL object
+        with their typed key / values as custom properties - vectors become
+        float arrays, which jm_scene_export writes as lists. The key / values
+        of brush entities are copied onto their MODEL object. With a region
+        only the point entities inside it are spawned.
+
+        Returns the number of objects created.
+    """
+    table = entity_table(entities)
+    origins = table['origin'] * scale_factor
+
+    has_origin = np.isfinite(origins).all(axis=1)
+    if region is not None:
+        corners = np.asarray(region, dtype=np.float64)
+        has_origin &= boxes_intersect(origins, origins, corners.min(axis=0), corners.max(axis=0))
+
+    locations = origins.tolist()
+    has_origin = has_origin.tolist()
+    rotations = np.radians(table['angle']).tolist()
+
+    models_by_name = dict(("*{}".format(ob['model_index']), ob) for ob in model_objects)
+
+    # Blender 2.8 renamed lamps to lights
+    lamps = bpy.data.lamps if hasattr(bpy.data, "lamps") else bpy.data.lights
+    lamp_data = {}
+
+    created = 0
+
+    for index, classname in enumerate(table['classname']):
+        properties = table['properties'][index]
+
+        model = properties.get('model')
+        if model in models_by_name:
+            for key, value in properties.items():
+                models_by_name[model][key] = value
+            continue
+
+        if not has_origin[index]:
+            continue
+
+        if classname in camera_classnames:
+            object_name = "CAMERA{}.{}".format(classname, index)
+            data = None
+        elif classname == "light":
+            object_name = "PROP{}.{}".format(classname, index)
+
+            # Lights with the same settings share their lamp
+            intensity = properties.get('light', 300)
+            if not isinstance(intensity, (int, float)):
+                intensity = 300
+            color = entity_light_color(properties.get('_color'))
+
+            data = lamp_data.get((intensity, color))
+            if data is None:
+                data = lamps.new("EntityLight", 'POINT')
+                data.energy = intensity / 300.0
+                data.distance = intensity * scale_factor
+                data.color = color
+                lamp_data[(intensity, color)] = data
+        else:
+            object_name = "PROP{}.{}".format(classname, index)
+            data = None
+
+        ob = bpy.data.objects.new(object_name, data)
+        bpy.context.scene.objects.link(ob)
+
+        ob.location = locations[index]
+        ob.rotation_euler = (0.0, 0.0, rotations[index])
+        ob.parent = level
+
+        for key, value in properties.items():
+            ob[key] = value
+
+        created += 1
+
+    return created
+
+
+class TextureCache(object):
+    """
+        Finds the image for each shader name and hands out Blender textures
+        for them. Files are located and read on a thread pool ahead of time,
+        found files are remembered across imports and a texture is only
+        created once per image file. Call begin_import at the start of each
+        import - misses are looked for again then.
+    """
+    extensions = (".jpg", ".tga")
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._executor = None
+        self._paths = {}
+        self._textures = {}
+        self._images = None
+
+    def begin_import(self):
+        """
+            Forget the textures that weren't found, they may be on disk by
+            now, and the image datablocks, which may have changed since the
+            last import
+        """
+        for key, lookup in list(self._paths.items()):
+            if lookup.done() and (lookup.exception() is not None or lookup.result() is None):
+                del self._paths[key]
+
+        self._images = None
+
+    def _find(self, base_path, texture_name):
+        for extension in self.extensions:
+            filename = os.path.join(base_path, texture_name + extension)
+            try:
+                with open(filename, 'rb') as f:
+                    # Pull it into the OS cache, Blender reads it again on load
+                    while f.read(1 << 20):
+                        pass
+            except (IOError, OSError):
+                continue
+            return os.path.normcase(os.path.abspath(filename))
+        return None
+
+    def prefetch(self, base_path, texture_names):
+        """
+            Start finding and reading the image files for texture_names
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+
+        for texture_name in texture_names:
+            key = (base_path, texture_name)
+            if key not in self._paths:
+                self._paths[key] = self._executor.submit(self._find, base_path, texture_name)
+
+    def resolve(self, base_path, texture_name):
+        """
+            Path of the image file for texture_name, or None if there isn't one
+        """
+        self.prefetch(base_path, (texture_name,))
+        return self._paths[(base_path, texture_name)].result()
+
+    def _image(self, filename):
+        # Index the loaded images by file once per import, not once per texture
+        if self._images is None:
+            self._images = {}
+            for image in bpy.data.images:
+                path = os.path.normcase(os.path.abspath(bpy.path.abspath(image.filepath)))
+                self._images.setdefault(path, image)
+
+        image = self._images.get(filename)
+        if image is None:
+            image = bpy.data.images.load(filename)
+            self._images[filename] = image
+        return image
+
+    def texture(self, base_path, texture_name):
+        """
+            Blender texture for texture_name - None when no image can be loaded
+        """
+        filename = self.resolve(base_path, texture_name)
+        if filename is None:
+            return None
+
+        texture = bpy.data.textures.get(self._textures.get(filename, ""))
+        if texture is not None and texture.image is not None:
+            return texture
+
+        try:
+            image = self._image(filename)
+        except RuntimeError:
+            print ("Cannot load image {}".format(filename))
+            return None
+
+        texture = bpy.data.textures.new('ColorTex', type = 'IMAGE')
+        texture.image = image
+        self._textures[filename] = texture.name
+
+        return texture
+
+    def clear(self):
+        """
+            Forget every lookup, including the files that were found
+        """
+        self._paths.clear()
+        self._textures.clear()
+        self._images = None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+# Lives for the whole session so repeated imports reuse lookups and datablocks
+texture_cache = TextureCache()
+
+
+def create_materials_from_data(textures, base_path, cache):
+    """
+        Create all of the materials used by the BSP level. Materials already
+        in the blend file under the shader name are used as they are.
+    """
+
+    materials = []
+    missing = []
+
+    #Set colour to incremenet from 0 - 8
+    colour_inc = 1.0 / max(len(textures), 1)
+    colour = 0
+
+    for current_material in textures:
+        mat = bpy.data.materials.get(current_material[0])
+
+        if mat is None:
+            texture = cache.texture(base_path, current_material[0])
+            if texture is None:
+                missing.append(current_material[0])
+
+            mat = bpy.data.materials.new(current_material[0])
+            mat.diffuse_color = (0, colour, 0,)
+            mat.diffuse_shader = 'LAMBERT' 
+            mat.diffuse_intensity = 1.0 
+            mat.specular_color = (1, 1, 1,)
+            mat.specular_shader = 'COOKTORR'
+            mat.specular_intensity = 0.5
+            mat.alpha = 1
+            mat.ambient = 1
+            mat.use_shadeless = True
+
+            mtex = mat.texture_slots.add()
+            mtex.texture = texture
+            mtex.texture_coords = 'UV'
+            mtex.use_map_color_diffuse = True 
+
+        materials.append(mat)
+        colour += colour_inc
+
+    if missing:
+        print ("Missing {} textures (tried {}) in {}:\n    {}".format(
+            len(missing), "/".join(cache.extensions), base_path, "\n    ".join(missing)))
+
+    return materials
+
+
+def detached(value):
+    """
+        value with any array in it that still views a buffer - the BSP's
+        memory map - copied out. Dicts, lists and tuples are walked.
+    """
+    if isinstance(value, np.ndarray):
+        base = value
+        while isinstance(base, np.ndarray) and base.base is not None:
+            base = base.base
+        if isinstance(base, np.ndarray):
+            return value
+        return value.copy()
+    if isinstance(value, dict):
+        return dict((key, detached(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(detached(item) for item in value)
+    return value
+
+
+class BspFile(object):
+    """
+        A memory mapped BSP. The header and lump directory are parsed up front,
+        lumps are only touched - and decoded - when something asks for them.
+        Decoded results are detached from the map, so once the views lump()
+        handed out are gone, close() unmaps the file.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+        with open(filepath, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Loaders slice this, which never copies the underlying file data
+        self.data = memoryview(self._map)
+        self.header, file_position = load_bsp_header(self.data, 0)
+        self.headers, file_position = load_headers(self.data, file_position)
+
+        self._decoded = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lump(self, lump_index):
+        """
+            Zero copy view of a single lump
+        """
+        lump_offset, lump_length = self.headers[lump_index]
+        return self.data[lump_offset:lump_offset + lump_length]
+
+    def decoded(self, key, loader, *args):
+        """
+            Run loader(data, headers, *args) the first time key is asked for
+            and hand back the cached result after that.
+        """
+        if key not in self._decoded:
+            self._decoded[key] = detached(loader(self.data, self.headers, *args))
+        return self._decoded[key]
+
+    def close(self):
+        """
+            Release the view of the map and unmap it. Raises BufferError while
+            an array from lump(), or from a loader called on data directly,
+            still views the map - on Windows the file would stay locked.
+        """
+        self._decoded.clear()
+        self.data.release()
+        self._map.close()
+
+
+# Bump whenever decode_bsp output changes, it invalidates cached geometry
+parser_version = 6
+
+
+def decode_bsp(filepath, patch_lod=4, swap_winding=False,
+               import_lightmaps=True, lightmap_overbright_bits=1, lightmap_gamma=1.0,
+               split_clusters=False, region=None, collision_contents=0, texture_cache=None, profiler=None):
+    """
+        Everything an import needs that doesn't involve bpy, in unscaled map
+        units. Returns a dict of the decoded level - vertex columns,
+        triangles, shaders, the lightmap atlas, the model of each face, the
+        entities and, when splitting, the cluster of each face.
+
+        With a region - a (mins, maxs) pair of corners - only the faces and
+        inline models touching it are triangulated and kept.
+
+        A non zero collision_contents also builds the convex hulls of the
+        worldspawn brushes with any of those content flags.
+    """
+    if profiler is None:
+        profiler = jm_profile.Profiler("decode_bsp", 'OFF')
+
+    start_time = time.time()
+
+    with BspFile(filepath) as bsp:
+        with profiler.stage("load_materials"):
+            textures = bsp.decoded('textures', load_materials)
+
+        with profiler.stage("load_entities"):
+            entities = parse_entities(bsp.decoded('entities', load_entities))
+
+        # Start on the image files while the geometry is parsed
+        if texture_cache is not None:
+            texture_cache.prefetch(os.path.dirname(filepath), [texture[0] for texture in textures])
+
+        # Load all the data from the BSP file
+        with profiler.stage("load_verts"):
+            verts = bsp.decoded('verts', load_verts, 1.0)
+        with profiler.stage("load_indices"):
+            indices = bsp.decoded('indices', load_indices)
+        with profiler.stage("load_models"):
+            face_data = bsp.decoded('face_data', load_faces_data)
+            models = bsp.decoded('models', load_models)
+            face_model = face_models(models, len(face_data))
+
+        if region is not None:
+            with profiler.stage("region"):
+                selected = faces_in_region(face_data, verts['position'], face_model, models, region)
+
+                # Unselected faces become type 0, which nothing below builds
+                face_data = face_data.copy()
+                face_data['type'][~selected] = 0
+            profiler.count("region_faces", int(selected.sum()))
+
+        with profiler.stage("load_faces"):
+            faces = assemble_triangles(face_data, indices, swap_winding)
+
+        lightmap_count = 0
+        lightmap_atlas = None
+        if import_lightmaps:
+            with profiler.stage("lightmaps"):
+                lightmaps = bsp.decoded('lightmaps', load_lightmaps)
+                lightmap_count = len(lightmaps)
+
+                if lightmap_count:
+                    corrected = correct_lightmaps(lightmaps, lightmap_overbright_bits, lightmap_gamma)
+                    lightmap_atlas, columns, rows = pack_lightmap_atlas(corrected)
+
+                    verts = dict(verts)
+                    verts['lightmap_uv'] = remap_lightmap_uvs(verts['lightmap_uv'], face_data,
+                                                              lightmap_count, columns, rows)
+
+        with profiler.stage("tessellate_patches"):
+            patches = tessellate_patches(face_data, verts, patch_lod, swap_winding)
+            verts, faces = merge_patches(verts, faces, patches)
+        profiler.count("patch_tris", len(patches['triangles']))
+
+        if region is not None:
+            # Drop the vertices only the unselected faces used
+            with profiler.stage("region"):
+                verts, faces = split_mesh(verts, faces, np.ones(len(faces['triangles']), dtype=bool))
+
+        collision = None
+        if collision_contents:
+            with profiler.stage("collision"):
+                brushes = bsp.decoded('brushes', load_brushes)
+                brush_index = collision_brushes(brushes, textures, models, collision_contents)
+
+                collision = brush_hulls(bsp.decoded('planes', load_planes), brushes,
+                                        bsp.decoded('brushsides', load_brushsides), brush_index)
+                if region is not None:
+                    collision = hulls_in_region(collision, region)
+            profiler.count("collision_brushes", len(brush_index))
+
+        face_cluster = None
+        visdata = None
+        if split_clusters:
+            with profiler.stage("clusters"):
+                leafs = bsp.decoded('leafs', load_leafs)
+                leaffaces = bsp.decoded('leaffaces', load_leaffaces)
+                visdata = bsp.decoded('visdata', load_visdata)
+
+                face_cluster = face_clusters(leafs, leaffaces, len(face_data))
+
+        profiler.count("bytes_read", len(bsp.data))
+
+    return {
+        "header": bsp.header,
+        "textures": textures,
+        "verts": verts,
+        "faces": faces,
+        "lightmap_atlas": lightmap_atlas,
+        "face_model": face_model,
+        "model_bounds": np.concatenate((models['mins'][:, None], models['maxs'][:, None]), axis=1).astype(np.float64),
+        "entities": entities,
+        "collision": collision,
+        "face_cluster": face_cluster,
+        "visdata": visdata,
+        "stats": {
+            "vertices": len(verts['position']),
+            "triangles": len(faces['triangles']),
+            "faces": len(face_data),
+            "models": len(models),
+            "entities": len(entities),
+            "patches": int((face_data['type'] == 2).sum()),
+            "textures": len(textures),
+            "lightmaps": lightmap_count,
+            "parse_seconds": time.time() - start_time,
+        },
+    }
+
+
+def scale_level(level, scale_factor):
+    """
+        Copy of a decoded level with its positions, model bounds and
+        collision hulls scaled
+    """
+    verts = dict(level['verts'])
+    verts['position'] = verts['position'].astype(np.float64) * scale_factor
+
+    scaled = dict(level)
+    scaled['verts'] = verts
+    scaled['model_bounds'] = level['model_bounds'].astype(np.float64) * scale_factor
+
+    if level['collision'] is not None:
+        collision = dict(level['collision'])
+        collision['position'] = collision['position'].astype(np.float64) * scale_factor
+        scaled['collision'] = collision
+
+    return scaled
+
+
+def parse_bsp(filepath, scale_factor=0.02, patch_lod=4, swap_winding=False,
+              import_lightmaps=True, lightmap_overbright_bits=1, lightmap_gamma=1.0,
+              split_clusters=False, texture_cache=None, geometry_cache=None, profiler=None,
+              region=None, collision_contents=0, weld_tolerance=None):
+    """
+        decode_bsp, served from geometry_cache when the same map was decoded
+        with the same options before. The scale is applied afterwards so it
+        never invalidates the cache. region is given in scaled units, like
+        the positions returned.
+
+        With a weld_tolerance, in scaled units, the vertices are welded and
+        the triangles batched by material after scaling, see weld_level.
+    """
+    if profiler is None:
+        profiler = jm_profile.Profiler("parse_bsp", 'OFF')
+
+    if region is not None:
+        region = [[float(value) / scale_factor for value in corner] for corner in region]
+
+    options = {
+        "patch_lod": patch_lod,
+        "swap_winding": swap_winding,
+        "import_lightmaps": import_lightmaps,
+        "lightmap_overbright_bits": lightmap_overbright_bits,
+        "lightmap_gamma": lightmap_gamma,
+        "split_clusters": split_clusters,
+        "region": region,
+        "collision_contents": collision_contents,
+    }
+
+    level = None
+    if geometry_cache is not None:
+        with profiler.stage("cache_load"):
+            cache_key = geometry_cache.key(filepath, options)
+            level = geometry_cache.load(cache_key)
+
+    if level is None:
+        level = decode_bsp(filepath, texture_cache=texture_cache, profiler=profiler, **options)
+        if geometry_cache is not None:
+            with profiler.stage("cache_store"):
+                geometry_cache.store(cache_key, level)
+    else:
+        profiler.count("cache_hits")
+        if texture_cache is not None:
+            texture_cache.prefetch(os.path.dirname(filepath), [texture[0] for texture in level['textures']])
+
+    with profiler.stage("scale"):
+        level = scale_level(level, scale_factor)
+
+    if weld_tolerance:
+        vertex_count = len(level['verts']['position'])
+        with profiler.stage("weld"):
+            level = weld_level(level, weld_tolerance)
+        profiler.count("welded_verts", vertex_count - len(level['verts']['position']))
+
+    profiler.count("verts", level['stats']['vertices'])
+    profiler.count("tris", level['stats']['triangles'])
+    profiler.count("patches", level['stats']['patches'])
+    profiler.count("lightmaps", level['stats']['lightmaps'])
+
+    return level
+
+
+def import_settings(scale_factor=0.02, patch_lod=4, swap_winding=False,
+                    import_normals=False, import_colors=False, import_lightmaps=True,
+                    lightmap_overbright_bits=1, lightmap_gamma=1.0,
+                    split_clusters=False, cluster_group_size=1, split_models=True, import_entities=True,
+                    import_collision=False, collision_contents=CONTENTS_SOLID,
+                    weld_vertices=False, weld_tolerance=0.001,
+                    use_region=False, region_min=(-10.0, -10.0, -10.0), region_max=(10.0, 10.0, 10.0),
+                    use_cache=True):
+    """
+        Split the importer's options into the keyword arguments of parse_bsp,
+        which needs no bpy and can run anywhere, and those of build_level.
+    """
+    region = None
+    if use_region:
+        region = (tuple(region_min), tuple(region_max))
+
+    parse_options = {
+        "scale_factor": scale_factor,
+        "patch_lod": patch_lod,
+        "swap_winding": swap_winding,
+        "import_lightmaps": import_lightmaps,
+        "lightmap_overbright_bits": lightmap_overbright_bits,
+        "lightmap_gamma": lightmap_gamma,
+        "split_clusters": split_clusters,
+        "geometry_cache": GeometryCache() if use_cache else None,
+        "region": region,
+        "collision_contents": collision_contents if import_collision else 0,
+        "weld_tolerance": weld_tolerance if weld_vertices else None,
+    }
+
+    build_options = {
+        "scale_factor": scale_factor,
+        "import_normals": import_normals,
+        "import_colors": import_colors,
+        "split_clusters": split_clusters,
+        "cluster_group_size": cluster_group_size,
+        "split_models": split_models,
+        "import_entities": import_entities,
+        "region": region,
+    }
+
+    return parse_options, build_options
+
+
+def build_level(context, filepath, level, scale_factor=0.02, import_normals=False, import_colors=False,
+                split_clusters=False, cluster_group_size=1, split_models=True, import_entities=True,
+                region=None, profiler=None):
+    """
+        Create the Blender datablocks for a parse_bsp result. Touches bpy
+        throughout, so it has to run on the main thread.
+    """
+    if profiler is None:
+        profiler = jm_profile.Profiler("build_level", 'OFF')
+
+    base_path = os.path.dirname(filepath)
+
+    objects_before = len(bpy.data.objects)
+
+    # Create our blender objects
+    with profiler.stage("materials"):
+        materials = create_materials_from_data (level['textures'], base_path, texture_cache)
+    profiler.count("textures", len(level['textures']))
+
+    lightmap = None
+    if level['lightmap_atlas'] is not None:
+        with profiler.stage("lightmap_image"):
+            lightmap = create_lightmap_image("NewLevelLightmap", level['lightmap_atlas'])
+
+    world_verts = level['verts']
+    world_faces = level['faces']
+    model_parts = []
+    if split_models:
+        with profiler.stage("split_models"):
+            world_verts, world_faces, model_parts = split_by_model(world_verts, world_faces,
+                                                                   level['face_model'])
+        profiler.count("models", len(model_parts))
+
+    with profiler.stage("mesh_objects"):
+        if split_clusters:
+            level_object = create_cluster_objects("NewLevel", world_verts, world_faces, level['face_cluster'],
+                                                  level['visdata'], cluster_group_size, materials, scale_factor,
+                                                  import_normals, import_colors, lightmap)
+            profiler.count("cluster_groups", len(level_object.children))
+        else:
+            level_object = create_mesh_from_data("NewLevel", world_verts, world_faces, materials, scale_factor,
+                                                 import_normals, import_colors, lightmap)
+
+        model_objects = create_model_objects("NewLevel", level_object, model_parts, level['model_bounds'],
+                                             materials, import_normals, import_colors, lightmap)
+
+    if level['collision'] is not None:
+        with profiler.stage("collision_object"):
+            create_collision_object("NewLevel", level_object, level['collision'], materials)
+        profiler.count("collision_polygons", len(level['collision']['loop_total']))
+
+    if import_entities:
+        with profiler.stage("entities"):
+            spawned = create_entity_objects(level['entities'], scale_factor, level_object, model_objects, region)
+        profiler.count("entities", len(level['entities']))
+        profiler.count("entities_spawned", spawned)
+
+    if region is not None:
+        level_object['region_min'] = [float(value) for value in region[0]]
+        level_object['region_max'] = [float(value) for value in region[1]]
+
+    profiler.count("objects", len(bpy.data.objects) - objects_before)
+
+    return level_object
+
+
+def read_some_data(context, filepath, profiler=None, **options):
+    """
+        Parse and build in one blocking call. options are the importer's,
+        see import_settings.
+    """
+    owns_profiler = profiler is None
+    if owns_profiler:
+        profiler = jm_profile.Profiler("bsp_import")
+
+    parse_options, build_options = import_settings(**options)
+
+    texture_cache.begin_import()
+    level = parse_bsp(filepath, texture_cache=texture_cache, profiler=profiler, **parse_options)
+    build_level(context, filepath, level, profiler=profiler, **build_options)
+
+    if owns_profiler:
+        profiler.finish(filepath)
+
+    return {'FINISHED'}
+
+
+class ImportCancelled(Exception):
+    """
+        Raised on the parsing thread at the next stage after a cancel
+    """
+
+
+# parse_bsp stages in the order they run, the progress estimate goes by these
+parse_stages = ("cache_load", "load_materials", "load_entities", "load_verts", "load_indices",
+                "load_models", "region", "load_faces", "lightmaps", "tessellate_patches",
+                "collision", "clusters", "cache_store", "scale", "weld", "textures")
+
+
+class BackgroundImport(object):
+    """
+        Runs parse_bsp, and the image file lookups, on a worker thread. The
+        main thread polls progress and done(), then hands level to
+        build_level. Nothing here touches bpy.
+
+        Progress and cancelling ride on the profiler's stage listener - a
+        cancel takes effect when the next stage starts.
+    """
+
+    def __init__(self, filepath, parse_options, texture_cache=None, profiler=None):
+        self.filepath = filepath
+        self.parse_options = parse_options
+        self.texture_cache = texture_cache
+
+        self.profiler = profiler if profiler is not None else jm_profile.Profiler("bsp_import", 'OFF')
+        self.profiler.listener = self._stage_started
+
+        self.stage = None
+        self.progress = 0.0
+        self.level = None
+        self.error = None
+
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bsp3_import")
+        self._thread.daemon = True
+
+    def start(self):
+        if self.texture_cache is not None:
+            self.texture_cache.begin_import()
+
+        self._thread.start()
+        return self
+
+    def _stage_started(self, name):
+        if self._cancel.is_set():
+            raise ImportCancelled()
+
+        self.stage = name
+        if name in parse_stages:
+            self.progress = max(self.progress, parse_stages.index(name) / float(len(parse_stages)))
+
+    def _run(self):
+        try:
+            level = parse_bsp(self.filepath, texture_cache=self.texture_cache, profiler=self.profiler,
+                              **self.parse_options)
+
+            # Wait for the image files here rather than on the main thread
+            if self.texture_cache is not None:
+                with self.profiler.stage("textures"):
+                    base_path = os.path.dirname(self.filepath)
+                    for texture in level['textures']:
+                        self.texture_cache.resolve(base_path, texture[0])
+
+            self.level = level
+            self.progress = 1.0
+        except ImportCancelled:
+            pass
+        except Exception as error:
+            self.error = error
+        finally:
+            self.profiler.listener = None
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def wait(self, timeout=None):
+        """
+            Block until the worker stops, returns done()
+        """
+        self._thread.join(timeout)
+        return self.done()
+
+
+# Intermediate format written by the command line converter - a JSON
+# header describing the arrays, then the raw array data 16 byte aligned
+intermediate_magic = b"BSPI"
+intermediate_version = 1
+intermediate_header = Struct("<4sII") # Magic Version Header length
+
+
+def write_intermediate(filepath, arrays, meta):
+    """
+        Write a dict of numpy arrays plus JSON-able meta data in one pass
+    """
+    def aligned(position):
+        return (position + 15) & ~15
+
+    layout = {}
+    array_data = []
+    data_position = 0
+
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        data_position = aligned(data_position)
+        layout[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": data_position,
+        }
+        array_data.append((data_position, array))
+        data_position += array.nbytes
+
+    header = json.dumps({"meta": meta, "arrays": layout}, sort_keys=True).encode("utf-8")
+    data_start = aligned(intermediate_header.size + len(header))
+
+    with open(filepath, 'wb') as f:
+        f.write(intermediate_header.pack(intermediate_magic, intermediate_version, len(header)))
+        f.write(header)
+        f.write(b"\0" * (data_start - intermediate_header.size - len(header)))
+
+        written = 0
+        for array_position, array in array_data:
+            f.write(b"\0" * (array_position - written))
+            f.write(array.data if array.nbytes else b"")
+            written = array_position + array.nbytes
+
+
+def read_intermediate(filepath):
+    """
+        Read back write_intermediate output. The arrays are views into a
+        memory map of the file, nothing is copied until used.
+    """
+    with open(filepath, 'rb') as f:
+        magic, version, header_length = intermediate_header.unpack(f.read(intermediate_header.size))
+        if magic != intermediate_magic or version != intermediate_version:
+            raise ValueError("{} is not a version {} intermediate file".format(filepath, intermediate_version))
+
+        header = json.loads(f.read(header_length).decode("utf-8"))
+        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data_start = (intermediate_header.size + header_length + 15) & ~15
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        shape = tuple(layout['shape'])
+        count = int(np.prod(shape)) if shape else 1
+        arrays[name] = np.frombuffer(file_map, dtype=dtype, count=count,
+                                     offset=data_start + layout['offset']).reshape(shape)
+
+    return arrays, header['meta']
+
+
+def level_arrays(level):
+    """
+        Flatten a parse_bsp result into named arrays for write_intermediate
+    """
+    arrays = {}
+
+    for stream, values in level['verts'].items():
+        arrays['verts.' + stream] = values
+    for stream, values in level['faces'].items():
+        arrays['faces.' + stream] = values
+
+    if level['lightmap_atlas'] is not None:
+        arrays['lightmap_atlas'] = (level['lightmap_atlas'] * 255.0 + 0.5).astype(np.uint8)
+    arrays['face_model'] = level['face_model']
+    arrays['model_bounds'] = level['model_bounds']
+    if level.get('material_ranges') is not None:
+        arrays['material_ranges'] = level['material_ranges']
+    if level['collision'] is not None:
+        for stream, values in level['collision'].items():
+            arrays['collision.' + stream] = values
+    if level['face_cluster'] is not None:
+        arrays['face_cluster'] = level['face_cluster']
+    if level['visdata'] is not None:
+        arrays['visdata'] = level['visdata']
+
+    return arrays
+
+
+def level_from_arrays(arrays, meta):
+    """
+        Rebuild a decode_bsp result from level_arrays output and its meta data
+    """
+    verts = {}
+    faces = {}
+    collision = {}
+    for name, values in arrays.items():
+        group, _, stream = name.partition('.')
+        if group == 'verts':
+            verts[stream] = values
+        elif group == 'faces':
+            faces[stream] = values
+        elif group == 'collision':
+            collision[stream] = values
+
+    lightmap_atlas = arrays.get('lightmap_atlas')
+    if lightmap_atlas is not None:
+        lightmap_atlas = lightmap_atlas / np.float32(255.0)
+
+    return {
+        "header": (meta['bsp_header'][0].encode("ascii"), meta['bsp_header'][1]),
+        "textures": [tuple(texture) for texture in meta['textures']],
+        "verts": verts,
+        "faces": faces,
+        "lightmap_atlas": lightmap_atlas,
+        "face_model": arrays['face_model'],
+        "model_bounds": arrays['model_bounds'],
+        "entities": meta['entities'],
+        "collision": collision or None,
+        "material_ranges": arrays.get('material_ranges'),
+        "face_cluster": arrays.get('face_cluster'),
+        "visdata": arrays.get('visdata'),
+        "stats": meta['stats'],
+    }
+
+
+class GeometryCache(object):
+    """
+        Decoded levels on disk, keyed by a hash of the map's content, the
+        parser version and the decode options. Entries are intermediate files
+        read back through a memory map. Once the cache grows past max_bytes
+        the least recently used entries are removed.
+
+        The location and size default to $BSP3_CACHE_DIR (~/.cache/bsp3_import)
+        and $BSP3_CACHE_MB (2048).
+    """
+    extension = ".bspi"
+
+    def __init__(self, directory=None, max_bytes=None):
+        if directory is None:
+            directory = os.environ.get("BSP3_CACHE_DIR",
+                                       os.path.join(os.path.expanduser("~"), ".cache", "bsp3_import"))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("BSP3_CACHE_MB", 2048)) * 1024 * 1024)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    # Content hashes by (path, size, mtime), shared by every cache so a map
+    # is only read through once per session until it changes
+    content_hashes = {}
+
+    def content_hash(self, filepath):
+        stat = os.stat(filepath)
+        file_id = (os.path.normcase(os.path.abspath(filepath)), stat.st_size, stat.st_mtime_ns)
+
+        digest = self.content_hashes.get(file_id)
+        if digest is None:
+            content_hash = hashlib.sha1()
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    content_hash.update(block)
+            digest = self.content_hashes[file_id] = content_hash.hexdigest()
+
+        return digest
+
+    def key(self, filepath, options):
+        content_hash = hashlib.sha1(self.content_hash(filepath).encode("ascii"))
+        content_hash.update(json.dumps([parser_version, options], sort_keys=True).encode("utf-8"))
+        return content_hash.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.extension)
+
+    def load(self, key):
+        """
+            The cached level for key, or None
+        """
+        entry_path = self.path(key)
+        try:
+            arrays, meta = read_intermediate(entry_path)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Touch it, eviction goes by modification time
+        os.utime(entry_path, None)
+
+        level = level_from_arrays(arrays, meta)
+        level['stats'] = dict(level['stats'], cached=True)
+        return level
+
+    def store(self, key, level):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        meta = {
+            "bsp_header": [level['header'][0].decode("ascii", "replace"), level['header'][1]],
+            "textures": level['textures'],
+            "entities": level['entities'],
+            "stats": level['stats'],
+        }
+
+        # Write under a temporary name so a reader never sees half a file
+        entry_path = self.path(key)
+        temp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        write_intermediate(temp_path, level_arrays(level), meta)
+        os.replace(temp_path, entry_path)
+
+        self.evict()
+
+    def entries(self):
+        """
+            (path, bytes, last used) of every entry, least recently used first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.extension):
+                continue
+            entry_path = os.path.join(self.directory, filename)
+            entry_stat = os.stat(entry_path)
+            entries.append((entry_path, entry_stat.st_size, entry_stat.st_mtime))
+
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def info(self):
+        entries = self.entries()
+        return {
+            "directory": self.directory,
+            "entries": len(entries),
+            "bytes": sum(entry[1] for entry in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+
+        for entry_path, entry_size, last_used in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(entry_path)
+            total -= entry_size
+
+    def clear(self):
+        for entry in self.entries():
+            os.remove(entry[0])
+
+
+def convert_bsp(filepath, output_dir, options):
+    """
+        Parse one map and write it as an intermediate file into output_dir.
+        Runs in a worker process, so only plain values go in and out.
+    """
+    level = parse_bsp(filepath, **options)
+
+    base_path = os.path.dirname(filepath)
+    resolver = TextureCache(max_workers=1)
+    materials = [{
+        "name": name,
+        "flags": flags,
+        "contents": contents,
+        "image": resolver.resolve(base_path, name),
+    } for name, flags, contents in level['textures']]
+    resolver.shutdown()
+
+    meta = {
+        "source": os.path.abspath(filepath),
+        "bsp_header": [level['header'][0].decode("ascii", "replace"), level['header'][1]],
+        "options": options,
+        "materials": materials,
+        "entities": level['entities'],
+        "stats": level['stats'],
+    }
+
+    output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(filepath))[0] + ".bspi")
+    write_intermediate(output_path, level_arrays(level), meta)
+
+    stats = dict(level['stats'])
+    stats['output'] = output_path
+    stats['bytes'] = os.path.getsize(output_path)
+    return stats
+
+
+def convert_command(arguments):
+    import glob
+
+    map_paths = []
+    for pattern in arguments.maps:
+        # Shells that don't expand globs themselves
+        map_paths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    if not os.path.isdir(arguments.output):
+        os.makedirs(arguments.output)
+
+    options = {
+        "scale_factor": arguments.scale_factor,
+        "patch_lod": arguments.patch_lod,
+        "swap_winding": arguments.swap_winding,
+        "import_lightmaps": not arguments.no_lightmaps,
+        "split_clusters": arguments.clusters,
+        "region": None,
+        "collision_contents": arguments.collision,
+        "weld_tolerance": arguments.weld,
+    }
+
+    if arguments.region:
+        options['region'] = (arguments.region[:3], arguments.region[3:])
+
+    start_time = time.time()
+    failed = 0
+
+    with ProcessPoolExecutor(arguments.jobs) as executor:
+        futures = [(map_path, executor.submit(convert_bsp, map_path, arguments.output, options))
+                   for map_path in map_paths]
+
+        for map_path, future in futures:
+            try:
+                stats = future.result()
+            except Exception as error:
+                failed += 1
+                print ("FAILED {}: {}".format(map_path, error))
+                continue
+
+            print ("{} -> {} ({} verts, {} tris, {:.2f}s)".format(
+                map_path, stats['output'], stats['vertices'], stats['triangles'], stats['parse_seconds']))
+
+    print ("Converted {} of {} maps in {:.1f}s".format(
+        len(map_paths) - failed, len(map_paths), time.time() - start_time))
+
+    return 1 if failed else 0
+
+
+def cache_command(arguments):
+    cache = GeometryCache()
+
+    if arguments.action == "clear":
+        cache.clear()
+
+    if arguments.action == "list":
+        for entry_path, entry_size, last_used in cache.entries():
+            print ("{}  {:10.1f} KB  {}".format(
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(last_used)), entry_size / 1024.0, entry_path))
+
+    info = cache.info()
+    print ("{} entries, {:.1f} of {:.1f} MB in {}".format(
+        info['entries'], info['bytes'] / (1024.0 * 1024.0), info['max_bytes'] / (1024.0 * 1024.0),
+        info['directory']))
+
+    return 0
+
+
+def main(argv=None):
+    """
+        Command line entry point, works without Blender:
+            python -m bsp3_import convert maps/*.bsp -o out/
+            python -m bsp3_import cache info|list|clear
+        Synthetic maps and stage timings are in tools/bsp3_bench.py.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m bsp3_import",
+                                     description="Quake 3 BSP tools that don't need Blender")
+    commands = parser.add_subparsers(dest="command")
+
+    convert = commands.add_parser("convert", help="Parse maps into intermediate .bspi files")
+    convert.add_argument("maps", nargs="+", help="BSP files or glob patterns")
+    convert.add_argument("-o", "--output", default=".", help="Output directory")
+    convert.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes (default: CPU count)")
+    convert.add_argument("--scale-factor", type=float, default=0.02)
+    convert.add_argument("--patch-lod", type=int, default=4)
+    convert.add_argument("--swap-winding", action="store_true")
+    convert.add_argument("--no-lightmaps", action="store_true")
+    convert.add_argument("--clusters", action="store_true", help="Store the cluster of each face and the PVS")
+    convert.add_argument("--collision", type=lambda value: int(value, 0), default=0, metavar="CONTENTS",
+                         help="Build collision hulls of the brushes with these content flags, e.g. 0x10001")
+    convert.add_argument("--weld", type=float, default=None, metavar="TOLERANCE",
+                         help="Weld vertices within this distance, in scaled units, and batch triangles by material")
+    convert.add_argument("--region", type=float, nargs=6, metavar=("MIN_X", "MIN_Y", "MIN_Z", "MAX_X", "MAX_Y", "MAX_Z"),
+                         help="Only keep faces and inline models touching this box, in scaled units")
+    convert.set_defaults(run=convert_command)
+
+    cache = commands.add_parser("cache", help="Inspect or clear the decoded geometry cache")
+    cache.add_argument("action", choices=("info", "list", "clear"))
+    cache.set_defaults(run=cache_command)
+
+    arguments = parser.parse_args(argv)
+    if not hasattr(arguments, "run"):
+        parser.print_help()
+        return 1
+
+    return arguments.run(arguments)
+
+
+# ImportHelper is a helper class, defines filename and
+# invoke() function which calls the file selector.
+if bpy is not None:
+    from bpy_extras.io_utils import ImportHelper
+    from bpy.props import BoolProperty, EnumProperty, FloatProperty, FloatVectorProperty, IntProperty, StringProperty
+    from bpy.types import Operator
+
+
+    class ImportSomeData(Operator, ImportHelper):
+        """Import a Quake 3 BSP level"""
+        bl_idname = "import_test.some_data"  # important since its how bpy.ops.import_test.some_data is constructed
+        bl_label = "Import a Quake3 BSP"
+
+        # ImportHelper mixin class uses this
+        filename_ext = ".bsp"
+
+        filter_glob = StringProperty(
+                default="*.bsp",
+                options={'HIDDEN'},
+                )
+
+        # List of operator properties, the attributes will be assigned
+        # to the class instance from the operator settings before calling.
+        scale_factor = FloatProperty(
+                name="Scale factor",
+                description="Scale Factor ",
+                default=0.02,
+                )
+
+        patch_lod = IntProperty(
+                name="Patch detail",
+                description="Segments along each edge of a curved patch",
+                default=4,
+                min=1,
+                max=16,
+                )
+
+        swap_winding = BoolProperty(
+                name="Swap winding",
+                description="Reverse the winding of every triangle",
+                default=False,
+                )
+
+        import_normals = BoolProperty(
+                name="Import normals",
+                description="Use the BSP vertex normals as custom split normals",
+                default=False,
+                )
+
+        import_colors = BoolProperty(
+                name="Import vertex colors",
+                description="Add the BSP vertex colors as a color layer",
+                default=False,
+                )
+
+        import_lightmaps = BoolProperty(
+                name="Import lightmaps",
+                description="Pack the lightmaps into one image with its own UV layer",
+                default=True,
+                )
+
+        lightmap_overbright_bits = IntProperty(
+                name="Lightmap overbright bits",
+                description="Brighten the lightmaps by 2 to the power of this",
+                default=1,
+                min=0,
+                max=4,
+                )
+
+        lightmap_gamma = FloatProperty(
+                name="Lightmap gamma",
+                description="Gamma correction applied to the lightmaps",
+                default=1.0,
+                min=0.1,
+                max=4.0,
+                )
+
+        split_clusters = BoolProperty(
+                name="Split by visibility cluster",
+                description="One object per group of PVS clusters, with the visibility table stored on the level",
+                default=False,
+                )
+
+        cluster_group_size = IntProperty(
+                name="Clusters per object",
+                description="Number of consecutive visibility clusters merged into each object",
+                default=1,
+                min=1,
+                )
+
+        split_models = BoolProperty(
+                name="Split brush models",
+                description="Import each inline brush model (doors, platforms) as its own object",
+                default=True,
+                )
+
+        import_entities = BoolProperty(
+                name="Import entities",
+                description="Spawn points as CAMERA empties, lights and other point entities as PROP objects",
+                default=True,
+                )
+
+        import_collision = BoolProperty(
+                name="Import collision",
+                description="Build a low poly COLLISION object from the convex hulls of the level's brushes",
+                default=False,
+                )
+
+        collision_contents = IntProperty(
+                name="Collision contents",
+                description="Only brushes whose texture has one of these content flags (1 solid, 65536 player clip)",
+                default=CONTENTS_SOLID,
+                min=0,
+                )
+
+        weld_vertices = BoolProperty(
+                name="Weld and batch",
+                description="Merge coincident vertices with matching UVs and normals, and group triangles by material",
+                default=False,
+                )
+
+        weld_tolerance = FloatProperty(
+                name="Weld distance",
+                description="Vertices closer than this, in scaled units, are merged",
+                default=0.001,
+                min=0.0,
+                precision=4,
+                )
+
+        use_region = BoolProperty(
+                name="Import region only",
+                description="Only import the faces and brush models touching the box below",
+                default=False,
+                )
+
+        region_min = FloatVectorProperty(
+                name="Region min",
+                description="Corner of the region to import, in scaled units",
+                default=(-10.0, -10.0, -10.0),
+                subtype='XYZ',
+                )
+
+        region_max = FloatVectorProperty(
+                name="Region max",
+                description="Opposite corner of the region to import, in scaled units",
+                default=(10.0, 10.0, 10.0),
+                subtype='XYZ',
+                )
+
+        use_cache = BoolProperty(
+                name="Use geometry cache",
+                description="Reuse the decoded geometry of maps imported before with the same options",
+                default=True,
+                )
+
+        profile = EnumProperty(
+                name="Profile",
+                description="Report stage timings, counters and peak memory",
+                items=jm_profile.profile_modes,
+                default='OFF',
+                )
+
+
+        def execute(self, context):
+            keywords = self.as_keywords(ignore=("filepath", "filter_glob", "profile"))
+            profiler = jm_profile.Profiler("bsp_import", jm_profile.resolve_mode(self.profile))
+
+            result = read_some_data(context, self.filepath, profiler=profiler, **keywords)
+
+            profiler.finish(self.filepath, self)
+            return result
+
+
+    class ImportSomeDataBackground(ImportSomeData):
+        """Import a Quake 3 BSP level, parsing it in the background. ESC cancels"""
+        bl_idname = "import_test.some_data_background"
+        bl_label = "Import a Quake3 BSP (background)"
+
+        def execute(self, context):
+            keywords = self.as_keywords(ignore=("filepath", "filter_glob", "profile"))
+            parse_options, self._build_options = import_settings(**keywords)
+
+            self._profiler = jm_profile.Profiler("bsp_import", jm_profile.resolve_mode(self.profile))
+            self._job = BackgroundImport(self.filepath, parse_options, texture_cache, self._profiler).start()
+
+            wm = context.window_manager
+            self._timer = wm.event_timer_add(0.1, window=context.window)
+            wm.progress_begin(0, 100)
+            wm.modal_handler_add(self)
+
+            return {'RUNNING_MODAL'}
+
+        def _end(self, context):
+            wm = context.window_manager
+            wm.event_timer_remove(self._timer)
+            wm.progress_end()
+
+        def modal(self, context, event):
+            if event.type == 'ESC':
+                # Don't join the worker, that would hang Blender until the
+                # stage it is in finishes - the daemon thread stops itself
+                # when the next stage starts and its result is dropped
+                self._job.cancel()
+                self._end(context)
+                self.report({'WARNING'}, "Import of {} cancelled".format(self.filepath))
+                return {'CANCELLED'}
+
+            if event.type != 'TIMER':
+                return {'PASS_THROUGH'}
+
+            context.window_manager.progress_update(int(self._job.progress * 100))
+            if not self._job.done():
+                return {'RUNNING_MODAL'}
+
+            self._end(context)
+
+            if self._job.error is not None:
+                self.report({'ERROR'}, "Cannot import {}: {}".format(self.filepath, self._job.error))
+                return {'CANCELLED'}
+
+            # Only the datablock creation runs on the main thread
+            build_level(context, self.filepath, self._job.level, profiler=self._profiler, **self._build_options)
+
+            self._profiler.finish(self.filepath, self)
+            return {'FINISHED'}
+
+
+    # Only needed if you want to add into a dynamic menu
+    def menu_func_import(self, context):
+        self.layout.operator(ImportSomeData.bl_idname, text="Quake 3 BSP Import")
+        self.layout.operator(ImportSomeDataBackground.bl_idname, text="Quake 3 BSP Import (background)")
+
+
+def register():
+    bpy.utils.register_class(ImportSomeData)
+    bpy.utils.register_class(ImportSomeDataBackground)
+    bpy.types.INFO_MT_file_import.append(menu_func_import)
+
+
+def unregister():
+    bpy.utils.unregister_class(ImportSomeDataBackground)
+    bpy.utils.unregister_class(ImportSomeData)
+    bpy.types.INFO_MT_file_import.remove(menu_func_import)
+
+    texture_cache.shutdown()
+
+
+if __name__ == "__main__":
+    if bpy is None:
+        sys.exit(main())
+
     register()
 
     # test call
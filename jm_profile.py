@@ -0,0 +1,181 @@
+"""
+    Stage timers, counters and peak memory for the import / export add-ons.
+
+    Turned on by an operator option or by setting JM_PROFILE in the
+    environment (JM_PROFILE=json also writes the report to disk). A disabled
+    profiler does nothing but return early, so instrumented code can call it
+    unconditionally.
+"""
+import json
+import os
+import sys
+import time
+
+profile_env_var = "JM_PROFILE"
+
+# Items for the operators' profile EnumProperty
+profile_modes = (
+    ('OFF', "Off", "No profiling (unless JM_PROFILE is set)"),
+    ('REPORT', "Report", "Show stage timings and counters in the info report"),
+    ('JSON', "Report and JSON", "Also write the report as JSON next to the output file"),
+)
+
+
+def env_mode():
+    """
+        'OFF', 'REPORT' or 'JSON' from the environment
+    """
+    value = os.environ.get(profile_env_var, "").strip().lower()
+
+    if value in ("", "0", "off", "false", "no"):
+        return 'OFF'
+    if value == "json":
+        return 'JSON'
+    return 'REPORT'
+
+
+def resolve_mode(option):
+    """
+        The operator option wins, the environment decides when it is left off
+    """
+    if option and option != 'OFF':
+        return option
+    return env_mode()
+
+
+def peak_rss():
+    """
+        Peak resident set size of this process in bytes, or None where the
+        platform can't tell us.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler(object):
+    """
+        Collects named stage timings and counters for one run:
+
+            profiler = Profiler("bsp_import", resolve_mode(operator.profile))
+            with profiler.stage("load_verts"):
+                ...
+            profiler.count("verts", vertex_count)
+    """
+
+    def __init__(self, name, mode=None):
+        if mode is None:
+            mode = env_mode()
+
+        self.name = name
+        self.mode = mode
+        self.enabled = mode != 'OFF'
+
+        self.stages = {}
+        self.stage_order = []
+        self.counters = {}
+        self.start = time.perf_counter()
+
+        # Called with each stage name as it starts, even when disabled - for progress reporting
+        self.listener = None
+
+    def stage(self, name):
+        """
+            Context manager timing the block as stage name. Repeated stages add up.
+        """
+        if self.listener is not None:
+            self.listener(name)
+
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        if name not in self.stages:
+            self.stage_order.append(name)
+            self.stages[name] = 0.0
+        self.stages[name] += seconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """
+            The whole run as a JSON-able dict
+        """
+        return {
+            "name": self.name,
+            "total_seconds": time.perf_counter() - self.start,
+            "stages": [{"name": name, "seconds": self.stages[name]} for name in self.stage_order],
+            "counters": dict(self.counters),
+            "peak_rss": peak_rss(),
+        }
+
+    def summary(self):
+        """
+            One line version of the report, for an operator's info report
+        """
+        report = self.report()
+
+        parts = ["{} {:.3f}s".format(self.name, report['total_seconds'])]
+        parts.extend("{} {:.3f}s".format(stage['name'], stage['seconds']) for stage in report['stages'])
+        parts.extend("{} {}".format(name, value) for name, value in sorted(report['counters'].items()))
+        if report['peak_rss'] is not None:
+            parts.append("peak {:.1f} MB".format(report['peak_rss'] / (1024.0 * 1024.0)))
+
+        return ", ".join(parts)
+
+    def finish(self, output_path=None, operator=None):
+        """
+            Show the report on operator (if given) and, in JSON mode, write it
+            to output_path + '.profile.json'. Returns the path written, if any.
+        """
+        if not self.enabled:
+            return None
+
+        summary = self.summary()
+        print (summary)
+        if operator is not None:
+            operator.report({'INFO'}, summary)
+
+        if self.mode != 'JSON' or output_path is None:
+            return None
+
+        report_path = output_path + ".profile.json"
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, sort_keys=True, indent=4)
+
+        return report_path
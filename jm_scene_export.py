@@ -4,7 +4,12 @@
 """
 
 import bpy
+import base64
+import hashlib
 import json
+import os
+
+import jm_profile
 
 bl_info = {
     "name": "Export JM's scene",
@@ -34,12 +39,72 @@ def scale_location(obj, scale_factor):
     obj['location'] = list(map(lambda x: x / scale_factor, obj['location']))
     return obj
 
-def get_custom_properties(obj):
-    return dict([(K, obj[K]) for K in obj.keys() if K not in '_RNA_UI' and not K in reserved_properties])
-
+def get_property_value(value):
+    """
+        A custom property as something json can write - ID property groups
+        and arrays as dicts and lists, bytes as base64 text
+    """
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    if hasattr(value, 'to_list'):
+        return value.to_list()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
 
-def get_tagged_objects(object_tag):
-    return [obj for obj in bpy.data.objects if obj.name.find(object_tag) == 0]
+def get_custom_properties(obj):
+    return dict([(K, get_property_value(obj[K])) for K in obj.keys() if K not in '_RNA_UI' and not K in reserved_properties])
+
+
+class TagIndex(object):
+    """
+        Objects by the tags their names start with, built in one pass over
+        objects. Names are walked through a trie of the tags, so each object
+        costs the length of the longest tag however many tags there are.
+        Each tag's objects are kept in name order, like bpy.data.objects.
+    """
+
+    def __init__(self, objects, tags):
+        # Nested dicts, one level per character; None marks the end of a tag
+        self.trie = {}
+        for tag in tags:
+            node = self.trie
+            for char in tag:
+                node = node.setdefault(char, {})
+            node[None] = tag
+
+        self.objects = dict((tag, []) for tag in tags)
+        for obj in objects:
+            for tag in self.match(obj.name):
+                self.objects[tag].append(obj)
+
+        for tagged in self.objects.values():
+            tagged.sort(key=lambda obj: obj.name)
+
+    def match(self, name):
+        """
+            The tags name starts with
+        """
+        node = self.trie
+        matches = [node[None]] if None in node else []
+
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matches.append(node[None])
+
+        return matches
+
+    def get(self, tag):
+        return self.objects.get(tag, [])
+
+
+def get_tagged_objects(object_tag, tag_index=None):
+    if tag_index is not None:
+        return tag_index.get(object_tag)
+    return [obj for obj in bpy.context.scene.objects if obj.name.find(object_tag) == 0]
 
 def process_material(material):
     return {
@@ -49,8 +114,14 @@ def get_material_info(obj):
     materials = [process_material(current_material) for current_material in obj.data.materials]
     return materials
 
-def get_tagged_object_data(object_tag):
-    objects = get_tagged_objects(object_tag)
+def get_object_materials(obj):
+    """
+        Names of the materials in obj's slots, None for an empty slot
+    """
+    return [slot.material.name if slot.material else None for slot in obj.material_slots]
+
+def get_tagged_object_data(object_tag, tag_index=None):
+    objects = get_tagged_objects(object_tag, tag_index)
 
     object_data = [{"name": current_object.name,
                     "location": current_object.location[:], 
@@ -58,46 +129,229 @@ def get_tagged_object_data(object_tag):
                     "properties": get_custom_properties(current_object)
                     } for current_object in objects]
 
-    return object_data  
+    return object_data, [get_object_materials(current_object) for current_object in objects]
 
-def get_level_scale_factor():
-    level_objects = get_tagged_objects("LEVEL")
+def get_level_scale_factor(tag_index=None):
+    level_objects = get_tagged_objects("LEVEL", tag_index)
     if len(level_objects) > 0 and 'scale_factor' in level_objects[0]:
         return level_objects[0]['scale_factor']
     else:
         return 1
 
-def write_some_data(context, filepath, use_some_setting):
-    # Write this as meta data
-    level_scale_factor = get_level_scale_factor()
-    
-    object_data = {}
+# Incremental export keeps <output>.fingerprints.json next to the output:
+#   version, revision        bumped on every export that changes something
+#   output_revision          the revision the output file itself is at
+#   meta                     fingerprint of the scales and level materials
+#   objects                  {section: {object name: fingerprint}}
+# and 'PATCH' writes <output>.patch.json, taking a client at base_revision
+# to revision. Any other export removes it - once the output is rewritten, or
+# nothing changed, there's no patch to apply:
+#   base_revision, revision
+#   changed                  {section: [object]} added or changed objects, as in the output
+#   removed                  {section: [object name]}
+#   scales, materials        only when they changed
+fingerprint_version = 1
+
+# incremental modes for write_some_data
+incremental_modes = (
+    ('FULL', "Full", "Write the whole scene, and fingerprints for later incremental exports"),
+    ('UPDATE', "Update In Place", "Only reprocess changed objects, patching them into the existing output"),
+    ('PATCH', "Patch File", "Only write the changes since the last export, to .patch.json"),
+)
+
+
+def fingerprint_path(filepath):
+    return filepath + ".fingerprints.json"
+
+
+def patch_path(filepath):
+    return filepath + ".patch.json"
+
+
+def remove_patch(filepath):
+    try:
+        os.remove(patch_path(filepath))
+    except OSError:
+        pass
+
+
+def get_fingerprint(data):
+    """
+        Digest of data as it would be serialized - location, rotation,
+        custom properties and slot materials (and for the meta, the level
+        materials)
+    """
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_fingerprints(filepath):
+    """
+        The fingerprints left by the last export to filepath, or None
+    """
+    try:
+        with open(fingerprint_path(filepath), 'r', encoding='utf-8') as f:
+            fingerprints = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(fingerprints, dict) or fingerprints.get("version") != fingerprint_version:
+        return None
+    return fingerprints
+
+
+def load_output(filepath):
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(filepath, data, **options):
+    """
+        Returns the number of bytes written
+    """
+    text = json.dumps(data, sort_keys=True, **options)
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return len(text.encode('utf-8'))
+
+
+def write_some_data(context, filepath, use_some_setting, profiler=None, incremental='FULL'):
+    owns_profiler = profiler is None
+    if owns_profiler:
+        profiler = jm_profile.Profiler("scene_export")
 
-    for current_object_type in output_objects:
-        scale = lambda x: swizzle(scale_location(x, blender_scale_factor))
-        objects = get_tagged_object_data(current_object_type[1])
+    # Every tag lookup below comes from this one pass over the scene
+    with profiler.stage("index"):
+        tag_index = TagIndex(context.scene.objects, [object_type[1] for object_type in output_objects])
+    profiler.count("scene_objects", len(context.scene.objects))
 
-        object_data[current_object_type[0]] = list(map(scale, objects))
+    # Write this as meta data
+    level_scale_factor = get_level_scale_factor(tag_index)
+    
+    tagged_data = {}
+    fingerprints = {}
+
+    # Only read and fingerprinted here - scaling and serializing waits until
+    # we know what changed
+    with profiler.stage("objects"):
+        for current_object_type in output_objects:
+            objects, object_materials = get_tagged_object_data(current_object_type[1], tag_index)
+
+            # Materials aren't written per object, but a change to them still
+            # has to reach the output
+            tagged_data[current_object_type[0]] = objects
+            fingerprints[current_object_type[0]] = dict((obj['name'], get_fingerprint([obj, obj_materials]))
+                                                       for obj, obj_materials in zip(objects, object_materials))
+            profiler.count("objects", len(objects))
 
     # Export the material data associated with the level - order is maintained
-    levels = get_tagged_objects('LEVEL')
+    levels = get_tagged_objects('LEVEL', tag_index)
     if len(levels) != 1:
         raise Exception("Cannot handle more than 1 level in a scene")
     
-    materials = get_material_info (levels[0])
-
-    level_meta_data = {
-        "scales": {
-            "import_scale": level_scale_factor,
-            #Used for validating - or possibly rescaling (Although the file should be exported correctly)
-            "blender_scale": blender_scale_factor   
-        },
-        "objects": object_data,
-        "materials": materials
+    with profiler.stage("materials"):
+        materials = get_material_info (levels[0])
+    profiler.count("materials", len(materials))
+
+    scales = {
+        "import_scale": level_scale_factor,
+        #Used for validating - or possibly rescaling (Although the file should be exported correctly)
+        "blender_scale": blender_scale_factor   
     }
-
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump( level_meta_data, f, sort_keys=True, indent=4, )
+    meta_fingerprint = get_fingerprint({"scales": scales, "materials": materials})
+
+    # Fall back to a full export whenever there's nothing trustworthy to build on
+    previous = None
+    previous_output = None
+    if incremental != 'FULL':
+        previous = load_fingerprints(filepath)
+    if previous is not None and incremental == 'UPDATE':
+        if previous.get("output_revision") == previous.get("revision"):
+            previous_output = load_output(filepath)
+        if previous_output is None:
+            previous = None
+    if previous is None:
+        incremental = 'FULL'
+
+    scale = lambda x: swizzle(scale_location(x, blender_scale_factor))
+
+    with profiler.stage("diff"):
+        changed = {}
+        removed = {}
+        for section, objects in tagged_data.items():
+            if incremental == 'FULL':
+                changed[section] = objects
+                removed[section] = []
+                continue
+
+            old = previous["objects"].get(section, {})
+            new = fingerprints[section]
+            changed[section] = [obj for obj in objects if old.get(obj['name']) != new[obj['name']]]
+            removed[section] = [name for name in sorted(old) if name not in new]
+
+    changed_count = sum(len(objects) for objects in changed.values())
+    removed_count = sum(len(names) for names in removed.values())
+    meta_changed = previous is None or previous.get("meta") != meta_fingerprint
+    profiler.count("changed_objects", changed_count)
+    profiler.count("removed_objects", removed_count)
+
+    if incremental != 'FULL' and not changed_count and not removed_count and not meta_changed:
+        remove_patch(filepath)
+        if owns_profiler:
+            profiler.finish(filepath)
+        return {'FINISHED'}
+
+    revision = (previous or load_fingerprints(filepath) or {}).get("revision", 0) + 1
+    output_revision = revision
+
+    with profiler.stage("write"):
+        if incremental == 'PATCH':
+            output_revision = previous.get("output_revision")
+            patch = {
+                "base_revision": previous["revision"],
+                "revision": revision,
+                "changed": dict((section, list(map(scale, objects))) for section, objects in changed.items() if objects),
+                "removed": dict((section, names) for section, names in removed.items() if names),
+            }
+            if meta_changed:
+                patch["scales"] = scales
+                patch["materials"] = materials
+            written = write_json(patch_path(filepath), patch, indent=4)
+        else:
+            object_data = {}
+            for section, objects in tagged_data.items():
+                if incremental == 'FULL':
+                    object_data[section] = list(map(scale, objects))
+                    continue
+
+                # Unchanged objects are taken as they are from the last output
+                reused = dict((obj['name'], obj) for obj in previous_output.get("objects", {}).get(section, []))
+                changed_names = set(obj['name'] for obj in changed[section])
+                object_data[section] = [scale(obj) if obj['name'] in changed_names or obj['name'] not in reused
+                                        else reused[obj['name']]
+                                        for obj in objects]
+
+            level_meta_data = {
+                "scales": scales,
+                "objects": object_data,
+                "materials": materials
+            }
+            written = write_json(filepath, level_meta_data, indent=4)
+            remove_patch(filepath)
+
+        write_json(fingerprint_path(filepath), {
+            "version": fingerprint_version,
+            "revision": revision,
+            "output_revision": output_revision,
+            "meta": meta_fingerprint,
+            "objects": fingerprints,
+        })
+    profiler.count("bytes_written", written)
+
+    if owns_profiler:
+        profiler.finish(filepath)
     
     return {'FINISHED'}
 
@@ -138,8 +392,27 @@ class ExportSomeData(Operator, ExportHelper):
             default='OPT_A',
             )
 
+    incremental = EnumProperty(
+            name="Incremental",
+            description="Re-export only the objects that changed since the last export to this file",
+            items=incremental_modes,
+            default='FULL',
+            )
+
+    profile = EnumProperty(
+            name="Profile",
+            description="Report stage timings, counters and peak memory",
+            items=jm_profile.profile_modes,
+            default='OFF',
+            )
+
     def execute(self, context):
-        return write_some_data(context, self.filepath, self.use_setting)
+        profiler = jm_profile.Profiler("scene_export", jm_profile.resolve_mode(self.profile))
+
+        result = write_some_data(context, self.filepath, self.use_setting, profiler, self.incremental)
+
+        profiler.finish(self.filepath, self)
+        return result
 
 
 # Only needed if you want to add into a dynamic menu
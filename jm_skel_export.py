@@ -1,7 +1,13 @@
 import bpy
+import io
 import math
-import mathutils
-from bpy_extras.io_utils import axis_conversion
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from struct import Struct
+import numpy as np
+
+import jm_profile
 
 bl_info = {
     "name": "Export JM's Skeleton",
@@ -16,75 +22,142 @@ reserved_properties = (
         'cycles_visibility'
     )
 
-def ProcessBone(armature, bone, bone_array, parent_id, depth = 0):
-    my_id = len(bone_array)
+# Dump each bone's matrices to the console while processing. Slow on big rigs.
+print_bone_matrices = False
 
-    # bone_matrix = bone.matrix_local.inverted()
-    # change_base = axis_conversion(
-    #     from_forward = '-Y', 
-    #     from_up='Z', 
-    #     to_forward='Z', 
-    #     to_up='Y').to_4x4()
+# Blender to device axes, applied to the matrices in the debug print
+change_base = np.array([
+    [1, 0, 0, 0],
+    [0, 0, 1, 0],
+    [0, -1, 0, 0],
+    [0, 0, 0, 1]], dtype=np.float64)
 
-    # print (str(change_base))
 
-    change_base = mathutils.Matrix([
-        [1, 0, 0, 0],
-        [0, 0, 1, 0],
-        [0, -1, 0, 0],
-        [0, 0, 0, 1]])
+def skeleton_order(roots, children):
+    """
+        Depth first order, parents before children and siblings in order -
+        the order the bones have always been exported in. Iterative, so deep
+        chains don't hit the recursion limit.
+    """
+    order = []
+    stack = roots[::-1]
+    while stack:
+        index = stack.pop()
+        order.append(index)
+        stack.extend(children[index][::-1])
 
-    transform = bone.matrix_local.copy() 
-    parentBone = bone.parent
+    return np.array(order, dtype=np.int64)
 
-    if parentBone:
-        transform =  parentBone.matrix_local.inverted() * transform
 
-    # test = parentBone.matrix_local * bone.matrix_local
-    # test = bone.matrix_local.copy()
-    print (bone.name)
-    print (str(transform.transposed()))
-    print (str((change_base * transform).transposed()))
-    # print ("LocalToParent: \n" + str(transform.transposed()))
-    # print ("LocalToWorld: \n" + str(bone.matrix_local.transposed()))
-    # print (str(transform * mathutils.Vector([0, 0, 0, 1])))
-    # if parentBone:
-    #    print (str(parentBone.matrix_local * transform * mathutils.Vector([0, 0, 0, 1])))
-    print('------------------------------------------------------\n')
+def matrix_to_quat(rot):
+    """
+        (N, 3, 3) rotation matrices to (N, 4) w x y z quaternions, the same
+        branches as Blender's mat3_to_quat
+    """
+    m00, m01, m02 = rot[:, 0, 0], rot[:, 1, 0], rot[:, 2, 0]
+    m10, m11, m12 = rot[:, 0, 1], rot[:, 1, 1], rot[:, 2, 1]
+    m20, m21, m22 = rot[:, 0, 2], rot[:, 1, 2], rot[:, 2, 2]
+    # m<column><row>, as in Blender's float[4][4]
 
+    trace = 0.25 * (1.0 + m00 + m11 + m22)
+    use_trace = trace > 1e-4
+    use_x = ~use_trace & (m00 > m11) & (m00 > m22)
+    use_y = ~use_trace & ~use_x & (m11 > m22)
+    use_z = ~use_trace & ~use_x & ~use_y
 
-    # transform = change_base * transform 
+    q = np.empty((len(rot), 4))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(trace)
+        q_trace = np.column_stack((s, (m12 - m21) / (4 * s), (m20 - m02) / (4 * s), (m01 - m10) / (4 * s)))
 
-    # transform = transform.transposed()
+        s = 2.0 * np.sqrt(1.0 + m00 - m11 - m22)
+        q_x = np.column_stack(((m12 - m21) / s, 0.25 * s, (m10 + m01) / s, (m20 + m02) / s))
 
-    loc, quat, sca = transform.decompose()
+        s = 2.0 * np.sqrt(1.0 + m11 - m00 - m22)
+        q_y = np.column_stack(((m20 - m02) / s, (m10 + m01) / s, 0.25 * s, (m21 + m12) / s))
 
-    bone_data = {
-        "parent": parent_id,
-        "loc": loc,
-        "rot": quat,
-        "mat": transform,
-        "name": bone.name
-    }
+        s = 2.0 * np.sqrt(1.0 + m22 - m00 - m11)
+        q_z = np.column_stack(((m01 - m10) / s, (m20 + m02) / s, (m21 + m12) / s, 0.25 * s))
+
+    q[use_trace] = q_trace[use_trace]
+    q[use_x] = q_x[use_x]
+    q[use_y] = q_y[use_y]
+    q[use_z] = q_z[use_z]
+
+    return q / np.sqrt((q * q).sum(axis=-1, keepdims=True))
+
+
+def decompose(mat):
+    """
+        (N, 4, 4) matrices to (N, 3) locations and (N, 4) quaternions, scale
+        divided out like Matrix.decompose
+    """
+    loc = mat[:, :3, 3]
+    rot = mat[:, :3, :3]
+
+    size = np.sqrt((rot * rot).sum(axis=1))
+    size = np.where(np.linalg.det(rot)[:, None] < 0.0, -size, size)
+    rot = rot / np.where(size == 0.0, 1.0, size)[:, None, :]
+
+    return loc, matrix_to_quat(rot)
 
-    bone_array.append(bone_data)
 
+def BuildSkeleton(armature):
+    """
+        The armature's rest pose as arrays, bones in skeleton order:
+            names       bone names
+            parents     int32 index of each bone's parent, -1 for roots
+            mat         float32 (bones, 4, 4) transform relative to the parent
+            loc, rot    float32 (bones, 3) / (bones, 4) decomposed mat, rot as w x y z
+            inverse_bind    float32 (bones, 4, 4) armature space rest matrix, inverted
+    """
+    bones = armature.bones
+    bone_count = len(bones)
 
-    # print ("{:<32} ID: {:>4}  Parent: {:>4}  Mat: \n{} ".format(
-    #         '-' * depth + bone.name,
-    #         my_id,
-    #         parent_id,
-    #         str(transform.transposed())))
+    names = [bone.name for bone in bones]
+    bone_index = dict((name, index) for index, name in enumerate(names))
+    parents = [bone_index[bone.parent.name] if bone.parent else -1 for bone in bones]
+    children = [[bone_index[child.name] for child in bone.children] for bone in bones]
+    roots = [index for index, parent in enumerate(parents) if parent < 0]
 
-    # print ("{:<32} ID: {:>4}  Parent: {:>4}  Tran: {:40}  Rot: {:32}".format(
-    #         '-' * depth + bone.name,
-    #         my_id,
-    #         parent_id,
-    #         str(loc),
-    #         str(quat)))
+    # foreach_get hands matrices over column by column
+    matrix_local = np.empty(bone_count * 16, dtype=np.float32)
+    bones.foreach_get("matrix_local", matrix_local)
+    matrix_local = matrix_local.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+
+    order = skeleton_order(roots, children)
+    remap = np.empty(bone_count, dtype=np.int64)
+    remap[order] = np.arange(bone_count)
+    parents = np.array(parents, dtype=np.int64)[order]
+    parents = np.where(parents < 0, -1, remap[np.maximum(parents, 0)])
+
+    matrix_local = matrix_local[order]
+    inverse_bind = np.linalg.inv(matrix_local)
+    mat = matrix_local.copy()
+    has_parent = parents >= 0
+    if has_parent.any():
+        mat[has_parent] = np.einsum('nij,njk->nik', inverse_bind[parents[has_parent]], matrix_local[has_parent])
+
+    loc, rot = decompose(mat)
+    names = [names[index] for index in order]
+
+    if print_bone_matrices:
+        converted = np.einsum('ij,njk->nik', change_base, mat)
+        for index, name in enumerate(names):
+            print (name)
+            print (str(mat[index].T))
+            print (str(converted[index].T))
+            print('------------------------------------------------------\n')
+
+    return {
+        "names": names,
+        "parents": parents.astype(np.int32),
+        "mat": mat.astype(np.float32),
+        "loc": loc.astype(np.float32),
+        "rot": rot.astype(np.float32),
+        "inverse_bind": inverse_bind.astype(np.float32),
+    }
 
-    for subnode in bone.children:
-        ProcessBone(armature, subnode, bone_array, my_id, depth + 1)
 
 def ProcessArmature(context, node):
     if (node.type != "ARMATURE"):
@@ -95,23 +168,13 @@ def ProcessArmature(context, node):
     if armature is None:
         return False
 
-    pose_position = armature.pose_position
-    armature.pose_position = 'REST'
-    context.scene.update()
+    # matrix_local is the rest pose whatever pose_position says, so there's
+    # no need to switch to REST and re-evaluate the scene
+    skeleton = BuildSkeleton(armature)
 
-    bone_array = []
-    for bone in armature.bones:
-        if (not bone.parent):
-            ProcessBone(armature, bone, bone_array, -1)
-
-    armature.pose_position = pose_position
-    context.scene.update()
-
-    return {
-        "name": node.name,
-        "count": len(bone_array),
-        "bones": bone_array
-    }
+    skeleton["name"] = node.name
+    skeleton["count"] = len(skeleton["names"])
+    return skeleton
     
 
 def check_valid_selection(selection):
@@ -145,55 +208,752 @@ def FormatText(text, *args):
 def FormatQuat(quat, prefix=''):
     return FormatText('{0}w="{1}" {0}x="{2}" {0}y="{3}" {0}z="{4}"',
         prefix,
-        quat.w,
-        quat.x,
-        quat.y,
-        quat.z)
+        quat[0],
+        quat[1],
+        quat[2],
+        quat[3])
 
 def FormatVec3(vec3, prefix=''):
     return FormatText('{0}x="{1}" {0}y="{2}" {0}z="{3}"',
         prefix,
-        vec3.x,
-        vec3.y,
-        vec3.z)
+        vec3[0],
+        vec3[1],
+        vec3[2])
 
 def FormatMat4(mat4, prefix=''):
-    attr_str = ''
-    for i in range(4):
-        for j in range(4):
-            attr_str += ' {}{}{}="{}" '.format(
-                prefix, 
-                i, j, 
-                FormatArg(mat4[j][i]))
-
-    return attr_str
-
-def Write(file, text, *args):
-    formatted_text = FormatText(text, *args)
-
-    file.write(bytes(str(formatted_text), "UTF-8"))
+    return ''.join([' {}{}{}="{}" '.format(prefix, i, j, FormatArg(mat4[j][i]))
+                    for i in range(4)
+                    for j in range(4)])
 
 
 def skeleton_write(file, skeleton):
-    Write(file, 
-        '<skeleton bone_count="{}" name="{}">\n',
+    """
+        Build the whole document in one buffer and write it in one go.
+        Returns the number of bytes written.
+    """
+    lines = [FormatText('<skeleton bone_count="{}" name="{}">\n',
         skeleton['count'],
-        skeleton['name'])
-
-    for bone in skeleton['bones']:
-        Write(file, '    <bone {} {} {} parent="{}" name="{}"/>\n',
-                FormatQuat(bone['rot'], 'rot_'),
-                FormatVec3(bone['loc'], 'loc_'),
-                FormatMat4(bone['mat'], 'mat_'),
-                bone['parent'],
-                bone['name'])
+        skeleton['name'])]
+
+    bones = zip(skeleton['rot'].tolist(),
+                skeleton['loc'].tolist(),
+                skeleton['mat'].tolist(),
+                skeleton['parents'].tolist(),
+                skeleton['names'])
+
+    for rot, loc, mat, parent, name in bones:
+        lines.append(FormatText('    <bone {} {} {} parent="{}" name="{}"/>\n',
+                FormatQuat(rot, 'rot_'),
+                FormatVec3(loc, 'loc_'),
+                FormatMat4(mat, 'mat_'),
+                parent,
+                name))
     
-    Write(file, '</skeleton>\n')
+    lines.append('</skeleton>\n')
+
+    return file.write(''.join(lines).encode("UTF-8"))
+
+
+# Binary skeleton layout, little endian, every section 4 byte aligned:
+#   header          magic, version, bone count, string table bytes
+#   string table    skeleton name then each bone name, utf-8, zero terminated
+#   parents         int16 per bone, -1 for roots
+#   loc             float32[3] per bone
+#   rot             float32[4] per bone, w x y z
+#   mat             float32[16] per bone, column major like the XML mat_ij
+skeleton_magic = b"JMSK"
+skeleton_version = 1
+skeleton_header = Struct("<4sIII")
+
+
+def pad4(data):
+    return data + b"\0" * (-len(data) & 3)
+
+
+def string_table(names):
+    """
+        Zero terminated utf-8 names, padded to 4 bytes
+    """
+    return pad4(b"".join(name.encode("UTF-8") + b"\0" for name in names))
+
+
+def skeleton_write_binary(file, skeleton):
+    """
+        Packed binary version of skeleton_write, see skeleton_header. Built
+        in one buffer and written in one go, returns the number of bytes
+        written.
+    """
+    names = string_table([skeleton['name']] + skeleton['names'])
+
+    buffer = b"".join((
+        skeleton_header.pack(skeleton_magic, skeleton_version, skeleton['count'], len(names)),
+        names,
+        pad4(skeleton['parents'].astype('<i2').tobytes()),
+        skeleton['loc'].astype('<f4').tobytes(),
+        skeleton['rot'].astype('<f4').tobytes(),
+        np.ascontiguousarray(skeleton['mat'].transpose(0, 2, 1), dtype='<f4').tobytes(),
+    ))
+
+    return file.write(buffer)
+
+
+# Skinned meshes, little endian, every section 4 byte aligned:
+#   header          magic, version, bone count, mesh count, string table bytes, weight bytes (1 or 2)
+#   string table    mesh names, as above
+#   inverse bind    float32[16] per bone in skeleton order, column major
+# then for each mesh:
+#   mesh header     vertex count, triangle count
+#   position        float32[3] per vertex, armature space
+#   normal          float32[3] per vertex, armature space
+#   bones           uint8[4] per vertex (uint16[4] with more than 256 bones), skeleton indices
+#   weights         uint8[4] or uint16[4] per vertex, largest first, summing to 255 / 65535
+#                   (all zero for vertices in no bone's group)
+#   triangles       uint32[3] per triangle
+skin_magic = b"JMSN"
+skin_version = 1
+skin_header = Struct("<4sIIIII")
+skin_mesh_header = Struct("<II")
+skin_influences = 4
+
+# Weight type: (dtype, quantised total)
+skin_weight_types = {
+    'UINT8': ('<u1', 255),
+    'UINT16': ('<u2', 65535),
+}
+
+
+def matrix_array(matrix):
+    return np.array([row[:] for row in matrix], dtype=np.float64)
+
+
+def skinned_meshes(context, node):
+    """
+        Mesh objects in the scene deformed by the armature node
+    """
+    meshes = []
+    for obj in context.scene.objects:
+        if obj.type != 'MESH':
+            continue
+
+        bound = obj.parent == node and obj.parent_type == 'ARMATURE'
+        bound = bound or any(modifier.type == 'ARMATURE' and modifier.object == node for modifier in obj.modifiers)
+        if bound:
+            meshes.append(obj)
+
+    return meshes
+
+
+def vertex_weights(obj, bone_names):
+    """
+        Every vertex group weight of obj's mesh as flat arrays (vertex, bone,
+        weight), bone being the skeleton index of the group's bone. Groups
+        that don't name a bone are dropped.
+
+        Blender has no bulk access to group weights, so this is the one pass
+        over the elements; everything after it works on the arrays.
+    """
+    bone_index = dict((name, index) for index, name in enumerate(bone_names))
+    group_bone = np.array([bone_index.get(group.name, -1) for group in obj.vertex_groups] + [-1], dtype=np.int64)
+
+    elements = [(index, element.group, element.weight)
+                for index, vertex in enumerate(obj.data.vertices)
+                for element in vertex.groups]
+    if not elements:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    elements = np.array(elements, dtype=np.float64)
+    vertex = elements[:, 0].astype(np.int64)
+    group = elements[:, 1].astype(np.int64)
+    bone = group_bone[np.where((group >= 0) & (group < len(group_bone) - 1), group, -1)]
+
+    keep = (bone >= 0) & (elements[:, 2] > 0.0)
+    return vertex[keep], bone[keep], elements[keep, 2]
+
+
+def top_weights(vertex, bone, weight, vertex_count, influences=skin_influences):
+    """
+        The largest influences per vertex as (vertex_count, influences) bone
+        indices and weights, largest first and renormalised to sum to 1.
+        Vertices with no weight are left all zero.
+    """
+    order = np.lexsort((-weight, vertex))
+    vertex = vertex[order]
+    bone = bone[order]
+    weight = weight[order]
+
+    rank = np.arange(len(vertex)) - np.searchsorted(vertex, vertex)
+    keep = rank < influences
+
+    bones = np.zeros((vertex_count, influences), dtype=np.int64)
+    weights = np.zeros((vertex_count, influences))
+    bones[vertex[keep], rank[keep]] = bone[keep]
+    weights[vertex[keep], rank[keep]] = weight[keep]
+
+    total = weights.sum(axis=1, keepdims=True)
+    weights = np.divide(weights, total, out=np.zeros_like(weights), where=total > 0.0)
+
+    return bones, weights
+
+
+def quantize_weights(weights, total):
+    """
+        Normalised weights to integers summing to exactly total (the rounding
+        error goes on the largest weight, first), or to 0 for unweighted vertices
+    """
+    quantized = np.floor(weights * total + 0.5).astype(np.int64)
+
+    weighted = weights.sum(axis=1) > 0.0
+    quantized[weighted, 0] += total - quantized[weighted].sum(axis=1)
+
+    return quantized
+
+
+def mesh_triangles(mesh):
+    """
+        (triangles, 3) vertex indices. Blender 2.8+ loop triangles, otherwise
+        a fan over each polygon.
+    """
+    if hasattr(mesh, "loop_triangles"):
+        mesh.calc_loop_triangles()
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+        return triangles.reshape(-1, 3)
+
+    polygon_count = len(mesh.polygons)
+    loop_start = np.empty(polygon_count, dtype=np.int32)
+    loop_total = np.empty(polygon_count, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    mesh.polygons.foreach_get("loop_total", loop_total)
+
+    loop_vertex = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertex)
+
+    fan_count = np.maximum(loop_total - 2, 0)
+    polygon = np.repeat(np.arange(polygon_count), fan_count)
+    corner = np.arange(len(polygon)) - np.repeat(np.cumsum(fan_count) - fan_count, fan_count)
+    first = loop_start[polygon]
+
+    return np.column_stack((
+        loop_vertex[first],
+        loop_vertex[first + corner + 1],
+        loop_vertex[first + corner + 2]))
+
+
+def skin_mesh(obj, node, skeleton, weight_type):
+    """
+        One skinned mesh for skin_write:
+            name
+            position, normal    float32 (vertices, 3) in the armature's space
+            bones, weights      (vertices, 4) see skin_header
+            triangles           uint32 (triangles, 3)
+            unweighted          number of vertices with no bone weight
+    """
+    mesh = obj.data
+    vertex_count = len(mesh.vertices)
+
+    co = np.empty(vertex_count * 3, dtype=np.float32)
+    normal = np.empty(vertex_count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    mesh.vertices.foreach_get("normal", normal)
+
+    # Into armature space, where the inverse bind matrices apply
+    to_armature = np.dot(np.linalg.inv(matrix_array(node.matrix_world)), matrix_array(obj.matrix_world))
+    position = np.dot(co.reshape(-1, 3), to_armature[:3, :3].T) + to_armature[:3, 3]
+    normal = np.dot(normal.reshape(-1, 3), np.linalg.inv(to_armature[:3, :3]))
+    length = np.sqrt((normal * normal).sum(axis=1, keepdims=True))
+    normal = np.divide(normal, length, out=np.zeros_like(normal), where=length > 0.0)
+
+    vertex, bone, weight = vertex_weights(obj, skeleton['names'])
+    bones, weights = top_weights(vertex, bone, weight, vertex_count)
+
+    weight_dtype, weight_total = skin_weight_types[weight_type]
+    bone_dtype = '<u1' if skeleton['count'] <= 256 else '<u2'
+
+    return {
+        "name": obj.name,
+        "position": position.astype('<f4'),
+        "normal": normal.astype('<f4'),
+        "bones": bones.astype(bone_dtype),
+        "weights": quantize_weights(weights, weight_total).astype(weight_dtype),
+        "triangles": mesh_triangles(mesh).astype('<u4'),
+        "unweighted": int(vertex_count - np.count_nonzero(weights[:, 0])),
+    }
+
+
+def skin_write(file, skeleton, meshes, weight_type):
+    """
+        Skinned meshes bound to skeleton, see skin_header. Built in one buffer
+        and written in one go, returns the number of bytes written.
+    """
+    names = string_table([mesh['name'] for mesh in meshes])
+    weight_bytes = np.dtype(skin_weight_types[weight_type][0]).itemsize
+
+    parts = [
+        skin_header.pack(skin_magic, skin_version, skeleton['count'], len(meshes), len(names), weight_bytes),
+        names,
+        np.ascontiguousarray(skeleton['inverse_bind'].transpose(0, 2, 1), dtype='<f4').tobytes(),
+    ]
+
+    for mesh in meshes:
+        parts.extend((
+            skin_mesh_header.pack(len(mesh['position']), len(mesh['triangles'])),
+            mesh['position'].tobytes(),
+            mesh['normal'].tobytes(),
+            mesh['bones'].tobytes(),
+            mesh['weights'].tobytes(),
+            mesh['triangles'].tobytes(),
+        ))
+
+    return file.write(b"".join(parts))
+
+
+def sibling_path(filepath, suffix):
+    """
+        sibling_path("hero.skel.xml", ".skin.bin") -> hero.skin.bin
+    """
+    root = os.path.splitext(filepath)[0]
+    if root.endswith(".skel"):
+        root = root[:-len(".skel")]
+    return root + suffix
+
+
+skeleton_extensions = {
+    'XML': ".skel.xml",
+    'BINARY': ".skel.bin",
+}
+
+skeleton_writers = {
+    'XML': skeleton_write,
+    'BINARY': skeleton_write_binary,
+}
+
+
+def batch_armatures(context, scope, tag=""):
+    """
+        Armatures to export: 'SELECTED' ones, or 'TAGGED' - every armature in
+        the scene whose name starts with tag
+    """
+    if scope == 'SELECTED':
+        objects = context.selected_objects
+    else:
+        objects = [obj for obj in context.scene.objects if obj.name.find(tag) == 0]
+
+    return [obj for obj in objects if obj.type == "ARMATURE" and obj.data is not None]
+
+
+def armature_files(skeleton, file_format, meshes=None, weight_type='UINT8'):
+    """
+        One armature's output as (suffix, writer, writer args), meshes only
+        when skinned meshes are exported
+    """
+    files = [(skeleton_extensions[file_format], skeleton_writers[file_format], (skeleton,))]
+    if meshes is not None:
+        files.append((".skin.bin", skin_write, (skeleton, meshes, weight_type)))
+    return files
+
+
+def encode(writer, *args):
+    """
+        What writer would write to a file, as bytes
+    """
+    buffer = io.BytesIO()
+    writer(buffer, *args)
+    return buffer.getvalue()
+
+
+def write_file(filepath, writer, *args):
+    with open(filepath, "wb") as file:
+        return writer(file, *args)
+
+
+def run_jobs(function, jobs, parallel):
+    """
+        function(*job) for each job, in order, on a thread pool if parallel.
+        The writers only touch arrays already read out of Blender, so they're
+        safe off the main thread.
+    """
+    if not parallel or len(jobs) < 2:
+        return [function(*job) for job in jobs]
+
+    with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+        return list(pool.map(lambda job: function(*job), jobs))
+
+
+# Skeleton archive, little endian, every section 4 byte aligned:
+#   header          magic, version, entry count, string table bytes
+#   string table    entry file names, as above
+#   entries         uint32[2] per entry: offset from the start of the file, size in bytes
+#   data            each entry exactly as it would be written on its own, padded to 4 bytes
+archive_magic = b"JMSA"
+archive_version = 1
+archive_header = Struct("<4sIII")
+
+
+def archive_write(file, entries):
+    """
+        entries as (file name, bytes). Returns the number of bytes written.
+    """
+    names = string_table([name for name, data in entries])
+
+    offset = archive_header.size + len(names) + 8 * len(entries)
+    table = np.zeros((len(entries), 2), dtype='<u4')
+    for index, (name, data) in enumerate(entries):
+        table[index] = (offset, len(data))
+        offset += len(pad4(data))
+
+    parts = [
+        archive_header.pack(archive_magic, archive_version, len(entries), len(names)),
+        names,
+        table.tobytes(),
+    ]
+    parts.extend(pad4(data) for name, data in entries)
+
+    return file.write(b"".join(parts))
+
+
+# Baked animation clips, little endian, every section 4 byte aligned:
+#   header          magic, version, bone count, clip count, string table bytes
+#   string table    bone names in skeleton order then clip names, as above
+# then for each clip:
+#   clip header     frame count, frames per second, loc / rot / scale key totals
+#   key counts      uint32[3][bone count], loc then rot then scale keys per bone
+#   key frames      uint16 per key, frame from the clip start. Keys run loc bone
+#                   by bone, then rot, then scale, matching the counts
+#   loc             float32[3] per loc key
+#   rot             int16[4] per rot key, w x y z scaled by anim_quat_scale
+#   scale           float32[3] per scale key
+# Transforms are local to the parent bone like the skeleton's loc / rot. Frames
+# between keys are linear (rot: normalised lerp, neighbouring keys never flip sign).
+anim_magic = b"JMAN"
+anim_version = 1
+anim_header = Struct("<4sIIII")
+anim_clip_header = Struct("<IfIII")
+anim_quat_scale = 32767
+anim_max_frames = 1 << 16
+
+pose_channel_path = re.compile(r'^pose\.bones\["(.*)"\]\.(location|rotation_quaternion|rotation_euler|rotation_axis_angle|scale)$')
+
+# Pose channel values used where an action has no curve
+pose_channel_defaults = {
+    "location": (0.0, 0.0, 0.0),
+    "rotation_quaternion": (1.0, 0.0, 0.0, 0.0),
+    "rotation_euler": (0.0, 0.0, 0.0),
+    "rotation_axis_angle": (0.0, 0.0, 1.0, 0.0),
+    "scale": (1.0, 1.0, 1.0),
+}
+
+
+def pose_channel(fcurve):
+    """
+        (bone name, property) an fcurve animates, or None if it isn't a pose channel
+    """
+    match = pose_channel_path.match(fcurve.data_path)
+    if match is None:
+        return None
+
+    bone_name = match.group(1).replace('\\"', '"').replace('\\\\', '\\')
+    return bone_name, match.group(2)
+
+
+def armature_actions(node):
+    """
+        The actions assigned to node - its active action, then those of its
+        NLA strips, in track order - that animate one of its bones. Actions
+        of other armatures sharing bone names are left alone.
+    """
+    animation_data = node.animation_data
+    if animation_data is None:
+        return []
+
+    assigned = []
+    if animation_data.action is not None:
+        assigned.append(animation_data.action)
+    for track in animation_data.nla_tracks:
+        for strip in track.strips:
+            if strip.action is not None:
+                assigned.append(strip.action)
+
+    bone_names = set(bone.name for bone in node.data.bones)
+
+    actions = []
+    for action in assigned:
+        if action in actions:
+            continue
+        channels = [pose_channel(fcurve) for fcurve in action.fcurves]
+        if any(channel is not None and channel[0] in bone_names for channel in channels):
+            actions.append(action)
+
+    return actions
+
+
+def action_frames(action):
+    """
+        Every whole frame in the action's range
+    """
+    start, end = action.frame_range[:]
+    return np.arange(int(math.floor(start)), int(math.ceil(end)) + 1, dtype=np.float64)
+
+
+def fcurve_samples(fcurve, frames):
+    """
+        fcurve evaluated at frames. Baked and mocap curves have a key on every
+        frame, which are read straight off the keys; anything else goes
+        through fcurve.evaluate one frame at a time.
+    """
+    keyframes = fcurve.keyframe_points
+    count = len(keyframes)
+
+    if count > 0 and len(fcurve.modifiers) == 0:
+        co = np.empty(count * 2, dtype=np.float32)
+        keyframes.foreach_get("co", co)
+        key_frames = co[0::2].astype(np.float64)
+        key_values = co[1::2].astype(np.float64)
+
+        inside = (frames >= key_frames[0]) & (frames <= key_frames[-1])
+        extrapolated = not inside.all()
+
+        # Keys are in frame order, so every frame inside has a key if the
+        # key found for it by bisection is on that frame
+        on_key = key_frames[np.searchsorted(key_frames, frames[inside])] == frames[inside]
+        if (not extrapolated or fcurve.extrapolation == 'CONSTANT') and on_key.all():
+            return np.interp(frames, key_frames, key_values)
+
+    return np.array([fcurve.evaluate(frame) for frame in frames], dtype=np.float64)
+
+
+def quat_multiply(a, b):
+    aw, ax, ay, az = (a[..., axis] for axis in range(4))
+    bw, bx, by, bz = (b[..., axis] for axis in range(4))
+
+    q = np.empty(np.broadcast(a, b).shape)
+    q[..., 0] = aw * bw - ax * bx - ay * by - az * bz
+    q[..., 1] = aw * bx + ax * bw + ay * bz - az * by
+    q[..., 2] = aw * by - ax * bz + ay * bw + az * bx
+    q[..., 3] = aw * bz + ax * by - ay * bx + az * bw
+    return q
+
+
+def quat_rotate(q, v):
+    w = q[..., :1]
+    u = q[..., 1:]
+    t = 2.0 * np.cross(u, v)
+    return v + w * t + np.cross(u, t)
+
+
+def quat_normalize(q):
+    length = np.sqrt((q * q).sum(axis=-1, keepdims=True))
+    return np.where(length > 0.0, q / np.where(length > 0.0, length, 1.0), (1.0, 0.0, 0.0, 0.0))
+
+
+def euler_to_quat(euler, order):
+    """
+        Blender eulers: 'XYZ' applies X first, so q = qz * qy * qx
+    """
+    half = euler * 0.5
+    axis_quats = {}
+    for axis_index, axis in enumerate("XYZ"):
+        q = np.zeros(euler.shape[:-1] + (4,))
+        q[..., 0] = np.cos(half[..., axis_index])
+        q[..., 1 + axis_index] = np.sin(half[..., axis_index])
+        axis_quats[axis] = q
+
+    return quat_multiply(quat_multiply(axis_quats[order[2]], axis_quats[order[1]]), axis_quats[order[0]])
+
+
+def axis_angle_to_quat(axis_angle):
+    angle = axis_angle[..., :1]
+    axis = axis_angle[..., 1:]
+    length = np.sqrt((axis * axis).sum(axis=-1, keepdims=True))
+    axis = np.where(length > 0.0, axis / np.where(length > 0.0, length, 1.0), (0.0, 1.0, 0.0))
+
+    return np.concatenate((np.cos(angle * 0.5), axis * np.sin(angle * 0.5)), axis=-1)
+
+
+def sample_action(action, bone_names, rotation_modes, frames):
+    """
+        The action's pose channels at every frame, as arrays over (frame, bone):
+            loc     (frames, bones, 3)
+            rot     (frames, bones, 4) unit quaternions, whatever the bones' rotation mode
+            scale   (frames, bones, 3)
+        Channels the action doesn't key stay at their rest values.
+    """
+    bone_index = dict((name, index) for index, name in enumerate(bone_names))
+    frame_count = len(frames)
+    bone_count = len(bone_names)
+
+    channels = {}
+    for name, default in pose_channel_defaults.items():
+        channels[name] = np.empty((frame_count, bone_count, len(default)))
+        channels[name][:] = default
+
+    for fcurve in action.fcurves:
+        channel = pose_channel(fcurve)
+        if channel is None or fcurve.mute or channel[0] not in bone_index:
+            continue
+
+        name = channel[1]
+        if fcurve.array_index >= channels[name].shape[2]:
+            continue
+
+        channels[name][:, bone_index[channel[0]], fcurve.array_index] = fcurve_samples(fcurve, frames)
+
+    rot = channels["rotation_quaternion"]
+    for index, mode in enumerate(rotation_modes):
+        if mode == 'AXIS_ANGLE':
+            rot[:, index] = axis_angle_to_quat(channels["rotation_axis_angle"][:, index])
+        elif mode != 'QUATERNION':
+            rot[:, index] = euler_to_quat(channels["rotation_euler"][:, index], mode)
+
+    return {
+        "loc": channels["location"],
+        "rot": quat_normalize(rot),
+        "scale": channels["scale"],
+    }
+
+
+def continuous_quats(rot):
+    """
+        Flip signs along the frame axis so neighbouring quaternions never
+        point into opposite hemispheres - keeps lerp between keys short
+    """
+    if len(rot) < 2:
+        return rot
+
+    dots = (rot[1:] * rot[:-1]).sum(axis=-1)
+    signs = np.cumprod(np.where(dots < 0.0, -1.0, 1.0), axis=0)
+    rot = rot.copy()
+    rot[1:] *= signs[..., None]
+    return rot
+
+
+def reduce_keys(values, tolerance):
+    """
+        Which samples to keep as keys, (frames, tracks) bool, for values
+        (frames, tracks, components) and a tolerance per track. Dropped samples
+        are within tolerance, per component, of the line between the kept keys
+        either side of them.
+
+        Greedy and all tracks at once: each track has an anchor key and the
+        range of slopes a line out of it can take and still pass within
+        tolerance of every sample since. A sample whose own slope falls outside
+        that range ends the segment, and the sample before it becomes the key.
+    """
+    frame_count, track_count = values.shape[:2]
+    keep = np.zeros((frame_count, track_count), dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+
+    tolerance = np.asarray(tolerance, dtype=np.float64).reshape(-1, 1)
+    anchor_frame = np.zeros((track_count, 1))
+    anchor = values[0].copy()
+    low = np.full(values.shape[1:], -np.inf)
+    high = np.full(values.shape[1:], np.inf)
+
+    for frame in range(1, frame_count):
+        sample = values[frame]
+        span = frame - anchor_frame
+        slope = (sample - anchor) / span
+
+        broken = ((slope < low) | (slope > high)).any(axis=1)
+        if broken.any():
+            keep[frame - 1, broken] = True
+            restart = broken[:, None]
+            anchor_frame = np.where(restart, frame - 1, anchor_frame)
+            anchor = np.where(restart, values[frame - 1], anchor)
+            low = np.where(restart, -np.inf, low)
+            high = np.where(restart, np.inf, high)
+            span = frame - anchor_frame
+
+        low = np.maximum(low, (sample - tolerance - anchor) / span)
+        high = np.minimum(high, (sample + tolerance - anchor) / span)
+
+    return keep
+
+
+def bake_clip(action, skeleton, rotation_modes, fps, tolerances, profiler):
+    """
+        Sample, reduce and quantise one action for anim_write:
+            name, frame_count, fps
+            counts      uint32 (3, bones) loc / rot / scale keys per bone
+            frames      uint16 per key
+            loc, rot, scale     key values, rot as int16 w x y z
+        tolerances is (loc, rot, scale).
+    """
+    bone_names = skeleton['names']
+    bone_count = skeleton['count']
+
+    frames = action_frames(action)
+    if len(frames) > anim_max_frames:
+        raise ValueError("Action {} is {} frames long, clips are limited to {}".format(
+            action.name, len(frames), anim_max_frames))
+
+    with profiler.stage("sample"):
+        samples = sample_action(action, bone_names, rotation_modes, frames)
+
+        # Pose channels are relative to the rest pose: local = rest * basis.
+        # Bone rest matrices carry no scale.
+        rest_loc = skeleton['loc'].astype(np.float64)
+        rest_rot = skeleton['rot'].astype(np.float64)
+        loc = rest_loc + quat_rotate(rest_rot, samples['loc'])
+        rot = continuous_quats(quat_normalize(quat_multiply(rest_rot, samples['rot'])))
+
+    with profiler.stage("reduce"):
+        tracks = np.zeros((len(frames), 3 * bone_count, 4))
+        tracks[:, :bone_count, :3] = loc
+        tracks[:, bone_count:2 * bone_count] = rot
+        tracks[:, 2 * bone_count:, :3] = samples['scale']
+
+        keep = reduce_keys(tracks, np.repeat(tolerances, bone_count))
+        track_index, frame_index = np.nonzero(keep.T)
+
+        kind = track_index // max(bone_count, 1)
+        values = tracks[frame_index, track_index]
+        counts = np.bincount(track_index, minlength=3 * bone_count).reshape(3, bone_count)
+
+    profiler.count("frames", len(frames))
+    profiler.count("samples", 3 * bone_count * len(frames))
+    profiler.count("keys", len(track_index))
+
+    return {
+        "name": action.name,
+        "frame_count": len(frames),
+        "fps": fps,
+        "counts": counts.astype('<u4'),
+        "frames": frame_index.astype('<u2'),
+        "loc": values[kind == 0, :3].astype('<f4'),
+        "rot": np.clip(np.round(values[kind == 1] * anim_quat_scale), -anim_quat_scale, anim_quat_scale).astype('<i2'),
+        "scale": values[kind == 2, :3].astype('<f4'),
+    }
+
+
+def anim_write(file, skeleton, clips):
+    """
+        Packed animation clips, see anim_header. Built in one buffer and
+        written in one go, returns the number of bytes written.
+    """
+    names = string_table(skeleton['names'] + [clip['name'] for clip in clips])
+
+    parts = [
+        anim_header.pack(anim_magic, anim_version, skeleton['count'], len(clips), len(names)),
+        names,
+    ]
+
+    for clip in clips:
+        parts.extend((
+            anim_clip_header.pack(clip['frame_count'], clip['fps'], len(clip['loc']), len(clip['rot']), len(clip['scale'])),
+            clip['counts'].tobytes(),
+            pad4(clip['frames'].tobytes()),
+            clip['loc'].tobytes(),
+            clip['rot'].tobytes(),
+            clip['scale'].tobytes(),
+        ))
+
+    return file.write(b"".join(parts))
 
 # ExportHelper is a helper class, defines filename and
 # invoke() function which calls the file selector.
 from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
+from bpy.props import StringProperty, BoolProperty, EnumProperty, FloatProperty
 from bpy.types import Operator
 
 
@@ -206,37 +966,228 @@ class ExportSkelData(Operator, ExportHelper):
     filename_ext = ".skel.xml"
 
     filter_glob = StringProperty(
-            default="*.skel.xml",
+            default="*.skel.xml;*.skel.bin",
+            options={'HIDDEN'},
+            )
+
+    format = EnumProperty(
+            name="Format",
+            description="File format to write",
+            items=(('XML', "XML", "Readable XML, one element per bone"),
+                   ('BINARY', "Binary", "Packed little endian arrays, .skel.bin")),
+            default='XML',
+            )
+
+    export_skins = BoolProperty(
+            name="Export Skinned Meshes",
+            description="Also write the meshes deformed by the armature, with bone weights and inverse bind matrices, to .skin.bin",
+            default=False,
+            )
+
+    weight_precision = EnumProperty(
+            name="Weight Precision",
+            description="Bits per quantised bone weight",
+            items=(('UINT8', "8 bit", "Weights as uint8, summing to 255"),
+                   ('UINT16', "16 bit", "Weights as uint16, summing to 65535")),
+            default='UINT8',
+            )
+
+    scope = EnumProperty(
+            name="Armatures",
+            description="Which armatures to export",
+            items=(('ACTIVE', "Selected Armature", "The one selected armature, to the chosen file"),
+                   ('SELECTED', "All Selected", "Every selected armature, named after the armature"),
+                   ('TAGGED', "Tagged", "Every armature in the scene whose name starts with the tag")),
+            default='ACTIVE',
+            )
+
+    tag = StringProperty(
+            name="Tag",
+            description="Name prefix for tagged armatures, empty for all of them",
+            default="",
+            )
+
+    output = EnumProperty(
+            name="Output",
+            description="How to lay out the exported files",
+            items=(('FILES', "Separate Files", "A file per skeleton (and skin) beside the chosen file"),
+                   ('ARCHIVE', "Archive", "Everything in one .skel.pack archive at the chosen file")),
+            default='FILES',
+            )
+
+    parallel_writes = BoolProperty(
+            name="Parallel Writes",
+            description="Encode and write the files on a thread pool",
+            default=False,
+            )
+
+    profile = EnumProperty(
+            name="Profile",
+            description="Report stage timings, counters and peak memory",
+            items=jm_profile.profile_modes,
+            default='OFF',
+            )
+
+    def execute(self, context):
+        if self.scope == 'ACTIVE':
+            armatures = bpy.context.selected_objects
+
+            if not check_valid_selection(armatures):
+                self.report({'ERROR'}, "Must have an armature selected to export a skeleton")
+                return {'CANCELLED'}
+        else:
+            armatures = batch_armatures(context, self.scope, self.tag)
+
+            if not armatures:
+                self.report({'ERROR'}, "No armatures to export")
+                return {'CANCELLED'}
+
+        profiler = jm_profile.Profiler("skel_export", jm_profile.resolve_mode(self.profile))
+
+        # Everything is read out of Blender here, on the main thread, before any writing
+        jobs = []
+        unweighted = 0
+        for node in armatures:
+            with profiler.stage("process"):
+                skeleton = ProcessArmature(context, node)
+            profiler.count("armatures")
+            profiler.count("bones", skeleton['count'])
+
+            meshes = None
+            if self.export_skins:
+                with profiler.stage("skins"):
+                    meshes = [skin_mesh(obj, node, skeleton, self.weight_precision)
+                              for obj in skinned_meshes(context, node)]
+                profiler.count("skinned_meshes", len(meshes))
+                profiler.count("skinned_vertices", sum(len(mesh['position']) for mesh in meshes))
+                unweighted += sum(mesh['unweighted'] for mesh in meshes)
+
+            if self.scope == 'ACTIVE':
+                root = sibling_path(self.filepath, "")
+            else:
+                root = os.path.join(os.path.dirname(self.filepath), bpy.path.clean_name(node.name))
+
+            for suffix, writer, args in armature_files(skeleton, self.format, meshes, self.weight_precision):
+                jobs.append((root + suffix, writer) + args)
+
+        with profiler.stage("write"):
+            if self.output == 'ARCHIVE':
+                filepath = sibling_path(self.filepath, ".skel.pack")
+                data = run_jobs(encode, [job[1:] for job in jobs], self.parallel_writes)
+                entries = [(os.path.basename(job[0]), entry) for job, entry in zip(jobs, data)]
+                written = write_file(filepath, archive_write, entries)
+            else:
+                filepath = jobs[0][0]
+                written = sum(run_jobs(write_file, jobs, self.parallel_writes))
+        profiler.count("files", len(jobs))
+        profiler.count("bytes_written", written)
+
+        if unweighted:
+            self.report({'WARNING'}, "{} skinned vertices have no bone weights".format(unweighted))
+
+        profiler.finish(filepath, self)
+        return {'FINISHED'}
+
+
+class ExportSkelAnimation(Operator, ExportHelper):
+    """Bake every action on the selected armature to a compact clip file"""
+    bl_idname = "export_test.skel_animation"
+    bl_label = "Export Skeleton Animation"
+
+    filename_ext = ".anim.bin"
+
+    filter_glob = StringProperty(
+            default="*.anim.bin",
             options={'HIDDEN'},
             )
 
+    loc_tolerance = FloatProperty(
+            name="Location Tolerance",
+            description="Drop location keys that linear interpolation reproduces to within this distance",
+            default=0.0001,
+            min=0.0,
+            precision=5,
+            )
+
+    rot_tolerance = FloatProperty(
+            name="Rotation Tolerance",
+            description="Drop rotation keys that interpolation reproduces to within this, per quaternion component",
+            default=0.0005,
+            min=0.0,
+            precision=5,
+            )
+
+    scale_tolerance = FloatProperty(
+            name="Scale Tolerance",
+            description="Drop scale keys that linear interpolation reproduces to within this",
+            default=0.0001,
+            min=0.0,
+            precision=5,
+            )
+
+    profile = EnumProperty(
+            name="Profile",
+            description="Report stage timings, counters and peak memory",
+            items=jm_profile.profile_modes,
+            default='OFF',
+            )
+
     def execute(self, context):
         objects = bpy.context.selected_objects
 
         if not check_valid_selection(objects):
-            self.report({'ERROR'}, "Must have an armature selected to export a skeleton")
+            self.report({'ERROR'}, "Must have an armature selected to export animation")
+            return {'CANCELLED'}
+
+        node = objects[0]
+        actions = armature_actions(node)
+        if not actions:
+            self.report({'ERROR'}, "{} has no action or NLA strip animating its bones".format(node.name))
             return {'CANCELLED'}
-        
-        skeleton = ProcessArmature(context, objects[0])
 
-        file = open(self.filepath, "wb")
-        skeleton_write(file, skeleton)
-        file.close()
+        profiler = jm_profile.Profiler("anim_export", jm_profile.resolve_mode(self.profile))
+
+        with profiler.stage("process"):
+            skeleton = ProcessArmature(context, node)
+        profiler.count("bones", skeleton['count'])
+
+        rotation_modes = [node.pose.bones[name].rotation_mode for name in skeleton['names']]
+        render = context.scene.render
+        fps = render.fps / render.fps_base
+        tolerances = (self.loc_tolerance, self.rot_tolerance, self.scale_tolerance)
+
+        try:
+            clips = [bake_clip(action, skeleton, rotation_modes, fps, tolerances, profiler) for action in actions]
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        profiler.count("clips", len(clips))
+
+        with profiler.stage("write"):
+            file = open(self.filepath, "wb")
+            written = anim_write(file, skeleton, clips)
+            file.close()
+        profiler.count("bytes_written", written)
+
+        profiler.finish(self.filepath, self)
         return {'FINISHED'}
 
 
 # Only needed if you want to add into a dynamic menu
 def menu_func_export(self, context):
     self.layout.operator(ExportSkelData.bl_idname, text="JM Export Skel Operator")
+    self.layout.operator(ExportSkelAnimation.bl_idname, text="JM Export Skel Animation")
 
 
 def register():
     bpy.utils.register_class(ExportSkelData)
+    bpy.utils.register_class(ExportSkelAnimation)
     bpy.types.INFO_MT_file_export.append(menu_func_export)
 
 
 def unregister():
     bpy.utils.unregister_class(ExportSkelData)
+    bpy.utils.unregister_class(ExportSkelAnimation)
     bpy.types.INFO_MT_file_export.remove(menu_func_export)
 
 
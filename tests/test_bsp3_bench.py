@@ -0,0 +1,37 @@
+"""
+    tools/bsp3_bench.py on a small generated map
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+import bsp3_bench
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "synthetic.bsp")
+        self.counts = bsp3_bench.write_synthetic_bsp(self.filepath, 2000, lightmap_count=3, cluster_count=16,
+                                                     brush_count=8, entity_count=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stages(self):
+        for patch_lods in ((), (2, 4)):
+            result = bsp3_bench.benchmark_bsp(self.filepath, repeat=1, patch_lods=patch_lods)
+
+            lod_stages = sorted(name for name in result['stages'] if name.startswith("tessellate_patches"))
+            self.assertEqual(lod_stages, ["tessellate_patches_lod{}".format(lod) for lod in patch_lods])
+            self.assertIn("build_mesh_buffers", result['stages'])
+            self.assertEqual(result['counts']['patches'], self.counts['patches'])
+            self.assertEqual(result['counts']['clusters'], 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,946 @@
+"""
+    bsp3_import's bpy-free half, checked against the per record Struct
+    decoding it replaced. Lumps are built with struct.pack, so no map files
+    are needed.
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from struct import Struct, pack
+
+import numpy as np
+
+import bsp3_import
+import jm_profile
+
+
+vert_chunk = Struct("<3f2f2f3f4B")
+face_chunk = Struct("<iiiiiiii2i2i3f3f3f3f2i")
+
+
+def build_bsp(lumps):
+    """
+        A BSP file image holding lumps, a {lump index: bytes} dict
+    """
+    offset = 8 + 17 * 8
+    directory = []
+    body = []
+    for lump_index in range(17):
+        data = lumps.get(lump_index, b"")
+        directory.append(pack("<ii", offset, len(data)))
+        body.append(data)
+        offset += len(data)
+
+    return pack("<4si", b"IBSP", 46) + b"".join(directory) + b"".join(body)
+
+
+def parse_headers(file_data):
+    header, file_position = bsp3_import.load_bsp_header(file_data, 0)
+    headers, file_position = bsp3_import.load_headers(file_data, file_position)
+    return headers
+
+
+def random_verts(rng, count):
+    records = []
+    for i in range(count):
+        floats = [rng.uniform(-4096.0, 4096.0) for j in range(3)] + [rng.uniform(-8.0, 8.0) for j in range(7)]
+        records.append(vert_chunk.pack(*(floats + [rng.randrange(256) for j in range(4)])))
+    return b"".join(records)
+
+
+def random_faces(rng, face_count, vertex_count, index_count):
+    records = []
+    for i in range(face_count):
+        face_type = rng.choice((1, 1, 2, 3, 3, 4))
+        n_meshverts = rng.randrange(0, 13)
+        meshvert = rng.randrange(0, index_count - n_meshverts)
+        vertex = rng.randrange(0, vertex_count - 16)
+        records.append(face_chunk.pack(
+            rng.randrange(8), -1, face_type, vertex, 16, meshvert, n_meshverts, rng.randrange(4),
+            0, 0, 128, 128,
+            *([rng.uniform(-1.0, 1.0) for j in range(12)] + [3, 3])))
+    return b"".join(records)
+
+
+def reference_verts(file_data, headers, scale_factor):
+    """
+        The original per record decoding
+    """
+    vert_offset, vert_length = headers[bsp3_import.LUMP_VERTEXES]
+    vertices = []
+    for current_vert_idx in range(vert_length // vert_chunk.size):
+        position = vert_offset + current_vert_idx * vert_chunk.size
+        vert_data = vert_chunk.unpack(file_data[position:position + vert_chunk.size])
+        vertices.append((
+            (vert_data[0] * scale_factor, vert_data[1] * scale_factor, vert_data[2] * scale_factor),
+            (vert_data[3], vert_data[4]),
+            (vert_data[5], vert_data[6]),
+            (vert_data[7], vert_data[8], vert_data[9]),
+            (vert_data[10], vert_data[11], vert_data[12], vert_data[13]),
+        ))
+    return vertices
+
+
+def reference_indices(file_data, headers):
+    index_offset, index_length = headers[bsp3_import.LUMP_MESHVERTS]
+    index_count = index_length // 4
+    return Struct("<{}i".format(index_count)).unpack(file_data[index_offset:index_offset + index_length])
+
+
+def reference_triangles(file_data, headers, indices, swap_winding):
+    """
+        (texture, (a, b, c), face index) for every whole triangle of the
+        polygon and mesh faces, one record at a time
+    """
+    face_offset, face_length = headers[bsp3_import.LUMP_FACES]
+    triangles = []
+    for face_index in range(face_length // face_chunk.size):
+        position = face_offset + face_index * face_chunk.size
+        face = face_chunk.unpack(file_data[position:position + face_chunk.size])
+        if face[2] not in (1, 3):
+            continue
+
+        base_vertex, base_index, index_count = face[3], face[5], face[6]
+        face_indices = [base_vertex + indices[base_index + i] for i in range(index_count // 3 * 3)]
+        for first in range(0, len(face_indices), 3):
+            a, b, c = face_indices[first:first + 3]
+            triangles.append((face[0], (a, c, b) if swap_winding else (a, b, c), face_index))
+    return triangles
+
+
+def small_bsp(rng, vertex_count=500, index_count=300, face_count=60):
+    """
+        A map of random polygons, patches and meshes, geometry lumps only
+    """
+    return build_bsp({
+        bsp3_import.LUMP_VERTEXES: random_verts(rng, vertex_count),
+        bsp3_import.LUMP_MESHVERTS: pack("<{}i".format(index_count),
+                                         *[rng.randrange(16) for i in range(index_count)]),
+        bsp3_import.LUMP_FACES: random_faces(rng, face_count, vertex_count, index_count),
+    })
+
+
+class DecodeParityTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        self.vertex_count = 500
+        index_count = 300
+
+        self.file_data = build_bsp({
+            bsp3_import.LUMP_VERTEXES: random_verts(rng, self.vertex_count),
+            bsp3_import.LUMP_MESHVERTS: pack("<{}i".format(index_count),
+                                             *[rng.randrange(16) for i in range(index_count)]),
+            bsp3_import.LUMP_FACES: random_faces(rng, 80, self.vertex_count, index_count),
+        })
+        self.headers = parse_headers(self.file_data)
+
+    def test_verts(self):
+        for scale_factor in (1.0, 0.02, 1.0 / 3.0):
+            verts = bsp3_import.load_verts(self.file_data, self.headers, scale_factor)
+            reference = reference_verts(self.file_data, self.headers, scale_factor)
+
+            self.assertEqual(len(verts['position']), self.vertex_count)
+            # tolist gives the same Python floats the tuples held, so == is bit exact
+            self.assertEqual(verts['position'].tolist(), [list(vert[0]) for vert in reference])
+            self.assertEqual(verts['uv'].tolist(), [list(vert[1]) for vert in reference])
+            self.assertEqual(verts['lightmap_uv'].tolist(), [list(vert[2]) for vert in reference])
+            self.assertEqual(verts['normal'].tolist(), [list(vert[3]) for vert in reference])
+            self.assertEqual(verts['color'].tolist(), [list(vert[4]) for vert in reference])
+
+    def test_indices(self):
+        indices = bsp3_import.load_indices(self.file_data, self.headers)
+        self.assertEqual(tuple(indices.tolist()), reference_indices(self.file_data, self.headers))
+
+    def test_triangles(self):
+        indices = bsp3_import.load_indices(self.file_data, self.headers)
+        reference_index = reference_indices(self.file_data, self.headers)
+
+        for swap_winding in (False, True):
+            faces = bsp3_import.load_faces(self.file_data, self.headers, indices, swap_winding)
+            reference = reference_triangles(self.file_data, self.headers, reference_index, swap_winding)
+
+            self.assertEqual(faces['triangles'].dtype, np.int32)
+            self.assertEqual(faces['triangles'].tolist(), [list(triangle[1]) for triangle in reference])
+            self.assertEqual(faces['texture'].tolist(), [triangle[0] for triangle in reference])
+            self.assertEqual(faces['face'].tolist(), [triangle[2] for triangle in reference])
+
+    def test_empty_lumps(self):
+        file_data = build_bsp({})
+        headers = parse_headers(file_data)
+
+        verts = bsp3_import.load_verts(file_data, headers, 1.0)
+        self.assertEqual(verts['position'].shape, (0, 3))
+
+        indices = bsp3_import.load_indices(file_data, headers)
+        faces = bsp3_import.load_faces(file_data, headers, indices)
+        self.assertEqual(faces['triangles'].shape, (0, 3))
+
+
+class RecordingCollection(object):
+    """
+        Stand-in for a bpy collection that logs add / foreach_set calls
+    """
+
+    def __init__(self, name, calls, items=()):
+        self.name = name
+        self.calls = calls
+        self.items = list(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def add(self, count):
+        self.calls.append((self.name, "add", count))
+
+    def foreach_set(self, attribute, values):
+        self.calls.append((self.name, "foreach_set", attribute, len(values)))
+
+
+class RecordingLayer(object):
+    def __init__(self, name, calls, items=()):
+        self.data = RecordingCollection(name, calls, items)
+
+
+class RecordingLayers(object):
+    def __init__(self, name, calls, loop_count=0):
+        self.name = name
+        self.calls = calls
+        self.layers = {}
+        self.loop_count = loop_count
+
+    def new(self, name):
+        self.calls.append((self.name, "new", name))
+        element = type("Element", (object,), {"color": (0.0, 0.0, 0.0, 0.0)})()
+        self.layers[name] = RecordingLayer("{}[{}].data".format(self.name, name), self.calls,
+                                           [element] * self.loop_count)
+        return self.layers[name]
+
+    def __getitem__(self, name):
+        return self.layers[name]
+
+
+class RecordingMesh(object):
+    """
+        Stand-in for a bpy Mesh (2.8+ API) that records what fill_mesh does to it
+    """
+
+    def __init__(self, loop_count=0):
+        self.calls = []
+        self.vertices = RecordingCollection("vertices", self.calls)
+        self.loops = RecordingCollection("loops", self.calls)
+        self.polygons = RecordingCollection("polygons", self.calls)
+        self.uv_layers = RecordingLayers("uv_layers", self.calls)
+        self.vertex_colors = RecordingLayers("vertex_colors", self.calls, loop_count)
+
+    def update(self, calc_edges=False):
+        self.calls.append(("mesh", "update", calc_edges))
+
+    def normals_split_custom_set(self, normals):
+        self.calls.append(("mesh", "normals_split_custom_set", len(normals)))
+
+
+def grid_mesh(rows=4, columns=5):
+    """
+        Vertex columns and triangles of a flat rows x columns grid
+    """
+    rng = np.random.RandomState(3)
+    vertex_count = rows * columns
+
+    corner = (np.arange(rows - 1)[:, None] * columns + np.arange(columns - 1)[None, :]).ravel()
+    triangles = np.concatenate((
+        np.stack((corner, corner + 1, corner + columns), axis=1),
+        np.stack((corner + 1, corner + columns + 1, corner + columns), axis=1),
+    )).astype(np.int32)
+
+    verts = {
+        "position": rng.uniform(-10.0, 10.0, (vertex_count, 3)),
+        "uv": rng.uniform(0.0, 1.0, (vertex_count, 2)).astype(np.float32),
+        "lightmap_uv": rng.uniform(0.0, 1.0, (vertex_count, 2)).astype(np.float32),
+        "normal": rng.uniform(-1.0, 1.0, (vertex_count, 3)).astype(np.float32),
+        "color": rng.randint(0, 256, (vertex_count, 4)).astype(np.uint8),
+    }
+    texture = rng.randint(0, 4, len(triangles)).astype(np.int32)
+
+    return verts, triangles, texture
+
+
+class MeshBuffersTest(unittest.TestCase):
+    def test_per_loop_expansion(self):
+        verts, triangles, texture = grid_mesh()
+        buffers = bsp3_import.build_mesh_buffers(verts['position'], triangles, texture, verts['uv'],
+                                                 normals=verts['normal'], colors=verts['color'],
+                                                 lightmap_uvs=verts['lightmap_uv'])
+
+        # One loop per triangle corner, looked up one at a time
+        normals = []
+        colors = []
+        uvs = []
+        lightmap_uvs = []
+        for triangle in triangles.tolist():
+            for vertex in triangle:
+                normals.append([float(value) for value in verts['normal'][vertex]])
+                colors.append([np.float32(value) / np.float32(255.0) for value in verts['color'][vertex]])
+                uvs.extend(float(value) for value in verts['uv'][vertex])
+                lightmap_uvs.extend(float(value) for value in verts['lightmap_uv'][vertex])
+
+        self.assertEqual(buffers['normal'].shape, (len(triangles) * 3, 3))
+        self.assertEqual(buffers['normal'].tolist(), normals)
+        self.assertEqual(buffers['color'].dtype, np.float32)
+        self.assertEqual(buffers['color'].tolist(), [[float(value) for value in color] for color in colors])
+        self.assertEqual(buffers['uv'].tolist(), uvs)
+        self.assertEqual(buffers['lightmap_uv'].tolist(), lightmap_uvs)
+        self.assertEqual(buffers['vertex_index'].tolist(), triangles.ravel().tolist())
+
+    def test_optional_streams_left_out(self):
+        verts, triangles, texture = grid_mesh()
+        buffers = bsp3_import.build_mesh_buffers(verts['position'], triangles, texture, verts['uv'])
+
+        self.assertNotIn('normal', buffers)
+        self.assertNotIn('color', buffers)
+        self.assertNotIn('lightmap_uv', buffers)
+
+
+class FillMeshTest(unittest.TestCase):
+    def test_bulk_calls_only(self):
+        verts, triangles, texture = grid_mesh()
+        buffers = bsp3_import.build_mesh_buffers(verts['position'], triangles, texture, verts['uv'])
+
+        mesh = RecordingMesh()
+        bsp3_import.fill_mesh(mesh, buffers)
+
+        vertex_count = len(verts['position'])
+        loop_count = len(triangles) * 3
+        polygon_count = len(triangles)
+
+        self.assertEqual(mesh.calls, [
+            ("vertices", "add", vertex_count),
+            ("vertices", "foreach_set", "co", vertex_count * 3),
+            ("loops", "add", loop_count),
+            ("loops", "foreach_set", "vertex_index", loop_count),
+            ("polygons", "add", polygon_count),
+            ("polygons", "foreach_set", "loop_start", polygon_count),
+            ("polygons", "foreach_set", "loop_total", polygon_count),
+            ("polygons", "foreach_set", "material_index", polygon_count),
+            ("uv_layers", "new", "UVs"),
+            ("uv_layers[UVs].data", "foreach_set", "uv", loop_count * 2),
+            ("mesh", "update", True),
+        ])
+
+    def test_optional_layers(self):
+        verts, triangles, texture = grid_mesh()
+        buffers = bsp3_import.build_mesh_buffers(verts['position'], triangles, texture, verts['uv'],
+                                                 normals=verts['normal'], colors=verts['color'],
+                                                 lightmap_uvs=verts['lightmap_uv'])
+
+        loop_count = len(triangles) * 3
+        mesh = RecordingMesh(loop_count)
+        bsp3_import.fill_mesh(mesh, buffers)
+
+        self.assertEqual(mesh.calls[8:], [
+            ("uv_layers", "new", "UVs"),
+            ("uv_layers[UVs].data", "foreach_set", "uv", loop_count * 2),
+            ("uv_layers", "new", "LightmapUVs"),
+            ("uv_layers[LightmapUVs].data", "foreach_set", "uv", loop_count * 2),
+            ("mesh", "update", True),
+            ("mesh", "normals_split_custom_set", loop_count),
+            ("vertex_colors", "new", "Col"),
+            ("vertex_colors[Col].data", "foreach_set", "color", loop_count * 4),
+        ])
+
+
+class LightmapAtlasTest(unittest.TestCase):
+    size = bsp3_import.lightmap_size
+
+    def lightmaps(self, count):
+        """
+            A lightmap lump of count flat lightmaps, lightmap n at 10 * (n + 1)
+            with its first texel marked
+        """
+        lightmaps = np.zeros((count, self.size, self.size, 3), dtype=np.uint8)
+        for index in range(count):
+            lightmaps[index] = 10 * (index + 1)
+            lightmaps[index, 0, 0] = (200, 100, 50)
+
+        file_data = build_bsp({bsp3_import.LUMP_LIGHTMAPS: lightmaps.tobytes()})
+        return bsp3_import.load_lightmaps(file_data, parse_headers(file_data))
+
+    def faces(self, lm_indices):
+        """
+            One quad per lightmap index, vertices 4 * n to 4 * n + 3
+        """
+        face_data = np.zeros(len(lm_indices), dtype=bsp3_import.face_dtype)
+        face_data['type'] = 1
+        face_data['vertex'] = np.arange(len(lm_indices)) * 4
+        face_data['n_vertexes'] = 4
+        face_data['lm_index'] = lm_indices
+        return face_data
+
+    def test_atlas_tiles(self):
+        for count, columns, rows in ((2, 2, 1), (3, 2, 2)):
+            lightmaps = self.lightmaps(count)
+            self.assertEqual(lightmaps.shape, (count, self.size, self.size, 3))
+
+            corrected = bsp3_import.correct_lightmaps(lightmaps)
+            atlas, atlas_columns, atlas_rows = bsp3_import.pack_lightmap_atlas(corrected)
+
+            self.assertEqual((atlas_columns, atlas_rows), (columns, rows))
+            self.assertEqual(atlas.shape, (rows * self.size, columns * self.size, 3))
+
+            for index in range(columns * rows):
+                row, column = divmod(index, columns)
+                tile = atlas[row * self.size:(row + 1) * self.size, column * self.size:(column + 1) * self.size]
+                if index < count:
+                    self.assertTrue(np.array_equal(tile, corrected[index]))
+                    # Over bright 200 doubles past 255 and is scaled back, keeping the hue
+                    self.assertTrue(np.allclose(tile[0, 0], (1.0, 0.5, 0.25)))
+                else:
+                    self.assertFalse(tile.any())
+
+    def test_uvs_in_their_tile(self):
+        lm_indices = [0, 1, 2, -1, 7]
+        face_data = self.faces(lm_indices)
+
+        corners = np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]], dtype=np.float32)
+        lightmap_uv = np.tile(corners, (len(lm_indices), 1))
+
+        remapped = bsp3_import.remap_lightmap_uvs(lightmap_uv, face_data, 3, 2, 2)
+
+        for face, lm_index in enumerate(lm_indices):
+            uv = remapped[face * 4:face * 4 + 4]
+            if 0 <= lm_index < 3:
+                row, column = divmod(lm_index, 2)
+                self.assertTrue(np.allclose(uv.min(axis=0), (column / 2.0, row / 2.0)))
+                self.assertTrue(np.allclose(uv.max(axis=0), ((column + 1) / 2.0, (row + 1) / 2.0)))
+            else:
+                # No lightmap, or one past the end of the lump - left alone
+                self.assertTrue(np.array_equal(uv, corners))
+
+
+class ClusterTest(unittest.TestCase):
+    def test_face_in_every_cluster(self):
+        leafs = np.zeros(4, dtype=bsp3_import.leaf_dtype)
+        leafs['cluster'] = [0, 3, -1, 3]
+        leafs['leafface'] = [0, 2, 4, 5]
+        leafs['n_leaffaces'] = [2, 2, 1, 2]
+        # Face 1 spans clusters 0 and 3, face 2 is twice in cluster 3, face
+        # 4 is only in the cluster-less leaf and 9 is out of range
+        leaffaces = np.array([0, 1, 1, 2, 4, 2, 9], dtype=np.int32)
+
+        pairs = bsp3_import.face_clusters(leafs, leaffaces, 5)
+        self.assertEqual(pairs.tolist(), [[0, 0], [1, 0], [1, 3], [2, 3]])
+
+    def test_visdata_lump_round_trip(self):
+        rng = random.Random(10)
+        cluster_count = 13
+        row_bytes = 4               # Wider than the 2 bytes 13 clusters need
+
+        rows = [bytes(rng.randrange(256) for i in range(row_bytes)) for cluster in range(cluster_count)]
+        lump = pack("<ii", cluster_count, row_bytes) + b"".join(rows)
+        file_data = build_bsp({bsp3_import.LUMP_VISDATA: lump})
+
+        visdata = bsp3_import.load_visdata(file_data, parse_headers(file_data))
+        self.assertEqual(visdata.shape, (cluster_count, row_bytes))
+
+        bits = bsp3_import.unpack_visibility(visdata, cluster_count)
+        for cluster, row in enumerate(rows):
+            # Bit c & 7 of byte c >> 3, as the engine reads it
+            expected = [bool(row[other >> 3] & (1 << (other & 7))) for other in range(cluster_count)]
+            self.assertEqual(bits[cluster].tolist(), expected)
+
+        packed = bsp3_import.pack_visibility(bits)
+        self.assertEqual(packed.shape, (cluster_count, 2))
+        # The padding bits past the last cluster are dropped
+        expected = np.array(visdata[:, :2])
+        expected[:, 1] &= 0x1f
+        self.assertTrue(np.array_equal(packed, expected))
+
+    def test_grouped_visibility_packed(self):
+        rng = np.random.RandomState(9)
+        cluster_count = 21
+        seen = rng.rand(cluster_count, cluster_count) < 0.2
+        visdata = bsp3_import.pack_visibility(seen)
+
+        for group_size in (1, 2, 5):
+            group_count = -(-cluster_count // group_size)
+            reference = np.zeros((group_count, group_count), dtype=bool)
+            for row, column in zip(*np.nonzero(seen)):
+                reference[row // group_size, column // group_size] = True
+
+            packed = bsp3_import.group_visibility(visdata, group_size, chunk_size=2)
+            self.assertEqual(packed.dtype, np.uint8)
+            self.assertEqual(packed.shape, (group_count, (group_count + 7) // 8))
+            self.assertTrue(np.array_equal(
+                bsp3_import.unpack_visibility(packed, group_count), reference))
+
+
+class BrushHullTest(unittest.TestCase):
+    def setUp(self):
+        # The box from (-16, -8, 0) to (16, 8, 32), as its six outward
+        # planes, then again with its +x +y edge bevelled off
+        bevel = np.array([1.0, 1.0, 0.0]) / np.sqrt(2.0)
+        self.normals = np.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1), bevel])
+        dists = [16, 16, 8, 8, 32, 0, 20 / np.sqrt(2.0)]
+
+        self.planes = np.zeros(len(dists), dtype=bsp3_import.plane_dtype)
+        self.planes['normal'] = self.normals
+        self.planes['dist'] = dists
+
+        self.brushsides = np.zeros(13, dtype=bsp3_import.brushside_dtype)
+        self.brushsides['plane'] = list(range(6)) + list(range(7))
+        self.brushsides['texture'] = np.arange(13) + 100
+
+        self.brushes = np.zeros(2, dtype=bsp3_import.brush_dtype)
+        self.brushes['brushside'] = [0, 6]
+        self.brushes['n_brushsides'] = [6, 7]
+
+    def polygons(self, hulls):
+        for start, total in zip(hulls['loop_start'], hulls['loop_total']):
+            yield hulls['position'][hulls['vertex_index'][start:start + total]]
+
+    def test_box(self):
+        hulls = bsp3_import.brush_hulls(self.planes, self.brushes, self.brushsides, [0])
+
+        self.assertEqual(len(hulls['position']), 8)
+        self.assertEqual(hulls['loop_total'].tolist(), [4] * 6)
+        self.assertEqual(hulls['brush'].tolist(), [0] * 6)
+        self.assertEqual(sorted(hulls['texture'].tolist()), list(range(100, 106)))
+        self.assertTrue(np.allclose(hulls['position'].min(axis=0), (-16, -8, 0)))
+        self.assertTrue(np.allclose(hulls['position'].max(axis=0), (16, 8, 32)))
+
+    def test_outward_normals(self):
+        hulls = bsp3_import.brush_hulls(self.planes, self.brushes, self.brushsides, [0, 1])
+        self.assertEqual(hulls['brush'].tolist().count(1), 7)
+
+        for polygon, texture in zip(self.polygons(hulls), hulls['texture']):
+            side_normal = self.normals[self.brushsides['plane'][texture - 100]]
+
+            # Newell's normal follows the winding
+            following = np.roll(polygon, -1, axis=0)
+            winding = np.cross(polygon, following).sum(axis=0)
+            winding /= np.linalg.norm(winding)
+            self.assertTrue(np.allclose(winding, side_normal), (texture, winding))
+
+    def test_bevel_cut(self):
+        hulls = bsp3_import.brush_hulls(self.planes, self.brushes, self.brushsides, [1])
+
+        self.assertEqual(len(hulls['position']), 10)
+        self.assertEqual(sorted(hulls['loop_total'].tolist()), [4, 4, 4, 4, 4, 5, 5])
+        bevel_corners = hulls['position'][np.abs(hulls['position'].dot(self.normals[6]) - 20 / np.sqrt(2.0)) < 1e-4]
+        self.assertEqual(sorted(map(tuple, np.round(bevel_corners[:, :2], 4).tolist())), [(12.0, 8.0)] * 2 + [(16.0, 4.0)] * 2)
+
+
+class TextureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = bsp3_import.TextureCache(max_workers=2)
+
+    def tearDown(self):
+        self.cache.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_misses_retried_each_import(self):
+        self.assertEqual(self.cache.resolve(self.directory, "textures/wall"), None)
+
+        os.makedirs(os.path.join(self.directory, "textures"))
+        filename = os.path.join(self.directory, "textures", "wall.tga")
+        with open(filename, 'wb') as f:
+            f.write(b"\0" * 18)
+
+        # Same import - the miss is remembered
+        self.assertEqual(self.cache.resolve(self.directory, "textures/wall"), None)
+
+        self.cache.begin_import()
+        self.assertEqual(self.cache.resolve(self.directory, "textures/wall"),
+                         os.path.normcase(os.path.abspath(filename)))
+
+    def test_hits_kept_across_imports(self):
+        filename = os.path.join(self.directory, "floor.jpg")
+        with open(filename, 'wb') as f:
+            f.write(b"\0" * 16)
+
+        found = self.cache.resolve(self.directory, "floor")
+        os.remove(filename)
+
+        self.cache.begin_import()
+        self.assertEqual(self.cache.resolve(self.directory, "floor"), found)
+
+
+class BspFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "mapped.bsp")
+        with open(self.filepath, 'wb') as f:
+            f.write(small_bsp(random.Random(5)))
+
+        self.opened = []
+        self.BspFile = bsp3_import.BspFile
+        opened = self.opened
+
+        class RecordingBspFile(self.BspFile):
+            def __init__(self, filepath):
+                super(RecordingBspFile, self).__init__(filepath)
+                opened.append(self)
+        bsp3_import.BspFile = RecordingBspFile
+
+    def tearDown(self):
+        bsp3_import.BspFile = self.BspFile
+        shutil.rmtree(self.directory)
+
+    def test_decode_unmaps_the_file(self):
+        level = bsp3_import.decode_bsp(self.filepath, split_clusters=True, collision_contents=1)
+
+        bsp, = self.opened
+        self.assertTrue(bsp._map.closed)
+        self.assertGreater(len(level['verts']['position']), 0)
+
+    def test_live_lump_view_blocks_close(self):
+        bsp = bsp3_import.BspFile(self.filepath)
+        faces = bsp.decoded('face_data', bsp3_import.load_faces_data)
+        view = np.frombuffer(bsp.lump(bsp3_import.LUMP_VERTEXES), dtype=np.uint8)
+
+        self.assertRaises(BufferError, bsp.close)
+        self.assertFalse(bsp._map.closed)
+
+        del view
+        bsp.close()
+        self.assertTrue(bsp._map.closed)
+        self.assertGreater(len(faces), 0)
+
+
+class GeometryCacheTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(11)
+
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "cached.bsp")
+        with open(self.filepath, 'wb') as f:
+            f.write(small_bsp(rng))
+
+        self.cache = bsp3_import.GeometryCache(os.path.join(self.directory, "cache"))
+        bsp3_import.GeometryCache.content_hashes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit_matches_miss(self):
+        options = {"import_lightmaps": False, "geometry_cache": self.cache}
+        missed = bsp3_import.parse_bsp(self.filepath, **options)
+        hit = bsp3_import.parse_bsp(self.filepath, **options)
+
+        self.assertTrue(hit['stats'].get('cached'))
+        for stream, values in missed['verts'].items():
+            self.assertEqual(hit['verts'][stream].dtype, values.dtype, stream)
+            self.assertTrue(np.array_equal(hit['verts'][stream], values), stream)
+        self.assertTrue(np.array_equal(hit['model_bounds'], missed['model_bounds']))
+
+    def test_content_hashed_once(self):
+        key = self.cache.key(self.filepath, {})
+        stat = os.stat(self.filepath)
+
+        # Same size and modification time - taken on trust, not read again
+        with open(self.filepath, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"!")
+        os.utime(self.filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(self.cache.key(self.filepath, {}), key)
+        self.assertEqual(len(bsp3_import.GeometryCache.content_hashes), 1)
+
+        with open(self.filepath, 'ab') as f:
+            f.write(b"\0")
+        self.assertNotEqual(self.cache.key(self.filepath, {}), key)
+        self.assertNotEqual(self.cache.key(self.filepath, {"patch_lod": 2}), self.cache.key(self.filepath, {}))
+
+
+class QuietDecodeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "quiet.bsp")
+        with open(self.filepath, 'wb') as f:
+            f.write(small_bsp(random.Random(13)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_script(self, *lines):
+        script = "\n".join((
+            "import sys",
+            "sys.path.insert(0, {!r})".format(os.path.dirname(os.path.abspath(bsp3_import.__file__))),
+        ) + lines)
+        return subprocess.check_output([sys.executable, "-c", script], universal_newlines=True)
+
+    def test_decode_prints_nothing(self):
+        # Counted by the profiler instead, so tools can keep stdout to themselves
+        output = self.run_script(
+            "import bsp3_import",
+            "cache = bsp3_import.GeometryCache({!r})".format(os.path.join(self.directory, "cache")),
+            "for run in range(2):",
+            "    bsp3_import.parse_bsp({!r}, geometry_cache=cache, weld_tolerance=0.01)".format(self.filepath),
+        )
+        self.assertEqual(output, "")
+
+
+def import_with_bpy():
+    """
+        A second copy of bsp3_import that sees stand-in bpy modules, so its
+        operators get defined
+    """
+    import importlib.util
+
+    bpy = types.ModuleType("bpy")
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("BoolProperty", "EnumProperty", "FloatProperty", "FloatVectorProperty",
+                 "IntProperty", "StringProperty"):
+        setattr(bpy.props, name, lambda **options: None)
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.types.Operator = type("Operator", (object,), {})
+    bpy_extras = types.ModuleType("bpy_extras")
+    bpy_extras.io_utils = types.ModuleType("bpy_extras.io_utils")
+    bpy_extras.io_utils.ImportHelper = type("ImportHelper", (object,), {
+        "as_keywords": lambda self, ignore=(): {"use_cache": False},
+    })
+
+    stand_ins = {
+        "bpy": bpy,
+        "bpy.props": bpy.props,
+        "bpy.types": bpy.types,
+        "bpy_extras": bpy_extras,
+        "bpy_extras.io_utils": bpy_extras.io_utils,
+    }
+    saved = dict((name, sys.modules.get(name)) for name in stand_ins)
+    sys.modules.update(stand_ins)
+    try:
+        spec = importlib.util.spec_from_file_location("bsp3_import_in_blender", bsp3_import.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for name, saved_module in saved.items():
+            if saved_module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = saved_module
+
+    return module
+
+
+class StandInWindowManager(object):
+    def __init__(self):
+        self.calls = []
+        self.progress = []
+
+    def event_timer_add(self, interval, window=None):
+        self.calls.append("event_timer_add")
+        return "timer"
+
+    def event_timer_remove(self, timer):
+        self.calls.append("event_timer_remove")
+
+    def progress_begin(self, first, last):
+        self.calls.append("progress_begin")
+
+    def progress_update(self, value):
+        self.calls.append("progress_update")
+        self.progress.append(value)
+
+    def progress_end(self):
+        self.calls.append("progress_end")
+
+    def modal_handler_add(self, operator):
+        self.calls.append("modal_handler_add")
+
+
+class BackgroundCancelTest(unittest.TestCase):
+    """
+        The background import's modal handler, driven by a stand-in event
+        loop while the worker is held in slow stages
+    """
+
+    def setUp(self):
+        self.module = import_with_bpy()
+        self.release = threading.Event()
+        self.entered = threading.Event()
+        self.faces_release = threading.Event()
+        self.faces_entered = threading.Event()
+
+        def slow_parse_bsp(filepath, profiler=None, **options):
+            with profiler.stage("load_verts"):
+                self.entered.set()
+                self.release.wait(10.0)
+            with profiler.stage("load_faces"):
+                self.faces_entered.set()
+                self.faces_release.wait(10.0)
+            return {"textures": []}
+        self.module.parse_bsp = slow_parse_bsp
+
+        self.built = []
+
+        def build_level(context, filepath, level, profiler=None, **options):
+            self.built.append((filepath, level))
+        self.module.build_level = build_level
+
+        self.reports = []
+        self.operator = self.module.ImportSomeDataBackground()
+        self.operator.filepath = "slow.bsp"
+        self.operator.profile = 'OFF'
+        self.operator.report = lambda kind, message: self.reports.append((kind, message))
+
+        self.context = types.SimpleNamespace(window=None, window_manager=StandInWindowManager())
+
+    def tearDown(self):
+        self.release.set()
+        self.faces_release.set()
+        self.module.texture_cache.shutdown()
+
+    def tick(self):
+        return self.operator.modal(self.context, types.SimpleNamespace(type='TIMER'))
+
+    def test_progress_follows_stages(self):
+        self.assertEqual(self.operator.execute(self.context), {'RUNNING_MODAL'})
+        job = self.operator._job
+        wm = self.context.window_manager
+
+        # Progress is the share of parse_stages started before the current one
+        self.assertTrue(self.entered.wait(5.0))
+        self.assertEqual(self.tick(), {'RUNNING_MODAL'})
+        self.release.set()
+        self.assertTrue(self.faces_entered.wait(5.0))
+        self.assertEqual(self.tick(), {'RUNNING_MODAL'})
+        self.assertEqual(wm.progress, [3 * 100 // 16, 7 * 100 // 16])
+        self.assertEqual(job.stage, "load_faces")
+        self.assertEqual(self.built, [])
+
+        self.faces_release.set()
+        self.assertTrue(job.wait(5.0))
+        self.assertEqual(self.tick(), {'FINISHED'})
+
+        self.assertEqual(wm.progress[-1], 100)
+        self.assertEqual(self.built, [("slow.bsp", {"textures": []})])
+        self.assertEqual(wm.calls, ["event_timer_add", "progress_begin", "modal_handler_add"]
+                         + ["progress_update"] * 3 + ["event_timer_remove", "progress_end"])
+        self.assertIsNone(job.profiler.listener)
+
+    def test_escape_returns_without_joining(self):
+        self.assertEqual(self.operator.execute(self.context), {'RUNNING_MODAL'})
+        job = self.operator._job
+        self.assertTrue(self.entered.wait(5.0))
+
+        # A few timer ticks while the worker is busy, then ESC
+        events = ['TIMER', 'MOUSEMOVE', 'TIMER', 'ESC']
+        results = []
+        start = time.perf_counter()
+        for event_type in events:
+            results.append(self.operator.modal(self.context, types.SimpleNamespace(type=event_type)))
+        seconds = time.perf_counter() - start
+
+        self.assertEqual(results, [{'RUNNING_MODAL'}, {'PASS_THROUGH'}, {'RUNNING_MODAL'}, {'CANCELLED'}])
+        self.assertLess(seconds, 1.0)
+        self.assertFalse(job.done())
+        self.assertEqual(self.context.window_manager.calls[-2:], ["event_timer_remove", "progress_end"])
+        self.assertEqual(self.reports[-1][0], {'WARNING'})
+
+        # The worker gives up when its next stage starts
+        self.release.set()
+        self.assertTrue(job.wait(5.0))
+        self.assertEqual(job.level, None)
+        self.assertEqual(job.error, None)
+
+
+class LazyLumpTest(unittest.TestCase):
+    """
+        A geometry only decode of a map with big lightmap and visdata lumps
+        shouldn't decode or page in either of them.
+    """
+    lightmap_count = 512                # 24 MB
+    visdata_bytes = 16 * 1024 * 1024
+
+    def setUp(self):
+        rng = random.Random(2)
+        vertex_count = 2000
+        index_count = 600
+
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "lazy.bsp")
+
+        lightmap_bytes = self.lightmap_count * bsp3_import.lightmap_size * bsp3_import.lightmap_size * 3
+        with open(self.filepath, 'wb') as f:
+            f.write(build_bsp({
+                bsp3_import.LUMP_VERTEXES: random_verts(rng, vertex_count),
+                bsp3_import.LUMP_MESHVERTS: pack("<{}i".format(index_count),
+                                                 *[rng.randrange(16) for i in range(index_count)]),
+                bsp3_import.LUMP_FACES: random_faces(rng, 200, vertex_count, index_count),
+                bsp3_import.LUMP_LIGHTMAPS: b"\x80" * lightmap_bytes,
+                bsp3_import.LUMP_VISDATA: pack("<ii", 4096, self.visdata_bytes // 4096) + b"\xff" * self.visdata_bytes,
+            }))
+
+        self.decoded = []
+        self.originals = {}
+        for name in ("load_lightmaps", "load_visdata"):
+            self.originals[name] = getattr(bsp3_import, name)
+            setattr(bsp3_import, name, self._recording(name, self.originals[name]))
+
+    def tearDown(self):
+        for name, loader in self.originals.items():
+            setattr(bsp3_import, name, loader)
+        shutil.rmtree(self.directory)
+
+    def _recording(self, name, loader):
+        def record(*args):
+            self.decoded.append(name)
+            return loader(*args)
+        return record
+
+    def peak_rss_around_decode(self, **options):
+        """
+            (peak RSS before, after) a decode_bsp call in a fresh interpreter,
+            where nothing else has pushed the peak up yet
+        """
+        script = "\n".join((
+            "import sys",
+            "sys.path.insert(0, {!r})".format(os.path.dirname(os.path.abspath(bsp3_import.__file__))),
+            "import bsp3_import, jm_profile",
+            "before = jm_profile.peak_rss()",
+            "bsp3_import.decode_bsp({!r}, **{!r})".format(self.filepath, options),
+            "print(before, jm_profile.peak_rss())",
+        ))
+        output = subprocess.check_output([sys.executable, "-c", script], universal_newlines=True)
+        before, after = output.split()[-2:]
+        return int(before), int(after)
+
+    def test_geometry_only_decode(self):
+        level = bsp3_import.decode_bsp(self.filepath, import_lightmaps=False, split_clusters=False)
+
+        self.assertEqual(self.decoded, [])
+        self.assertEqual(level['lightmap_atlas'], None)
+        self.assertEqual(level['visdata'], None)
+        self.assertGreater(level['stats']['triangles'], 0)
+
+    @unittest.skipIf(jm_profile.peak_rss() is None, "no peak RSS on this platform")
+    def test_geometry_only_peak_rss(self):
+        before, after = self.peak_rss_around_decode(import_lightmaps=False, split_clusters=False)
+        full_before, full_after = self.peak_rss_around_decode(import_lightmaps=True, split_clusters=True)
+
+        print ("decode_bsp peak RSS growth: geometry only {:.1f} MB, everything {:.1f} MB, file {:.1f} MB".format(
+            (after - before) / 1048576.0, (full_after - full_before) / 1048576.0,
+            os.path.getsize(self.filepath) / 1048576.0))
+
+        # Copying or paging in the unused lumps would add at least their size
+        self.assertLess(after - before, self.visdata_bytes)
+
+    def test_lumps_decoded_on_request(self):
+        level = bsp3_import.decode_bsp(self.filepath, import_lightmaps=True, split_clusters=True)
+
+        self.assertEqual(sorted(self.decoded), ["load_lightmaps", "load_visdata"])
+        self.assertEqual(level['stats']['lightmaps'], self.lightmap_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
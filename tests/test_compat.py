@@ -0,0 +1,90 @@
+"""
+    The add-ons have to load in Blender 2.75, which ships Python 3.4 and
+    numpy 1.9. Both checks are static - the suite itself runs on whatever
+    is installed, so it can't catch a newer call by running it.
+"""
+import ast
+import os
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+addons = ("bsp3_import.py", "jm_profile.py", "jm_scene_export.py", "jm_skel_export.py")
+
+# numpy functions added after 1.9, and the version that added them
+numpy_functions = {
+    "stack": "1.10",
+    "matmul": "1.10",
+    "broadcast_to": "1.10",
+    "moveaxis": "1.11",
+    "flip": "1.12",
+    "isin": "1.13",
+    "block": "1.13",
+    "divmod": "1.13",
+    "heaviside": "1.13",
+    "positive": "1.13",
+    "take_along_axis": "1.15",
+    "put_along_axis": "1.15",
+    "quantile": "1.15",
+    "gcd": "1.15",
+    "lcm": "1.15",
+}
+
+# Keyword arguments added after 1.9 to functions that are older
+numpy_keywords = {
+    ("count_nonzero", "axis"): "1.12",
+    ("unique", "axis"): "1.13",
+    ("packbits", "bitorder"): "1.17",
+    ("unpackbits", "count"): "1.17",
+}
+
+
+def read_addon(addon):
+    with open(os.path.join(root, addon), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def newer_numpy(tree):
+    """
+        (line, description, version) of each use of numpy, imported as np,
+        that needs a numpy newer than 1.9
+    """
+    found = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+                and node.value.id == "np" and node.attr in numpy_functions):
+            found.append((node.lineno, "np." + node.attr, numpy_functions[node.attr]))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            for keyword in node.keywords:
+                version = numpy_keywords.get((node.func.attr, keyword.arg))
+                if version is not None:
+                    found.append((node.lineno, "{}({}=)".format(node.func.attr, keyword.arg), version))
+
+    return sorted(found)
+
+
+class Python34SyntaxTest(unittest.TestCase):
+    def test_addons_parse(self):
+        for addon in addons:
+            try:
+                ast.parse(read_addon(addon), addon, feature_version=(3, 4))
+            except SyntaxError as error:
+                self.fail("{} needs a newer Python than Blender 2.75's: {}".format(addon, error))
+
+
+class Numpy19Test(unittest.TestCase):
+    def test_addons_use_numpy_19(self):
+        for addon in addons:
+            for line, name, version in newer_numpy(ast.parse(read_addon(addon), addon)):
+                self.fail("{}:{} uses {}, which needs numpy {} - Blender 2.75 ships 1.9".format(
+                    addon, line, name, version))
+
+    def test_newer_calls_found(self):
+        source = "a = np.stack((x, y), axis=1)\nb = np.matmul(a, a)\nc = np.unique(a, axis=0)\n"
+        self.assertEqual([name for line, name, version in newer_numpy(ast.parse(source))],
+                         ["np.stack", "np.matmul", "unique(axis=)"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,284 @@
+"""
+    jm_scene_export against stand-in bpy modules, fed the custom properties
+    bsp3_import leaves on the objects it creates.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+import bsp3_import
+
+
+def import_exporter():
+    """
+        Import jm_scene_export with just enough of bpy for its module level
+        code, then take the stand-ins out of sys.modules again
+    """
+    bpy = types.ModuleType("bpy")
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("StringProperty", "BoolProperty", "EnumProperty"):
+        setattr(bpy.props, name, lambda **options: None)
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.types.Operator = type("Operator", (object,), {})
+    bpy_extras = types.ModuleType("bpy_extras")
+    bpy_extras.io_utils = types.ModuleType("bpy_extras.io_utils")
+    bpy_extras.io_utils.ExportHelper = type("ExportHelper", (object,), {})
+
+    stand_ins = {
+        "bpy": bpy,
+        "bpy.props": bpy.props,
+        "bpy.types": bpy.types,
+        "bpy_extras": bpy_extras,
+        "bpy_extras.io_utils": bpy_extras.io_utils,
+    }
+    saved = dict((name, sys.modules.get(name)) for name in list(stand_ins) + ["jm_scene_export"])
+    sys.modules.update(stand_ins)
+    sys.modules.pop("jm_scene_export", None)
+    try:
+        import jm_scene_export
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    return jm_scene_export
+
+
+jm_scene_export = import_exporter()
+
+
+class IDPropertyArray(object):
+    """
+        What Blender hands back for a list or tuple custom property - not
+        something json can write until it goes through to_list()
+    """
+    def __init__(self, values):
+        self.values = list(values)
+
+    def to_list(self):
+        return list(self.values)
+
+
+class StandInObject(object):
+    def __init__(self, name, data=None):
+        self.name = name
+        self.data = data
+        self.parent = None
+        self.location = (0.0, 0.0, 0.0)
+        self.rotation_euler = (0.0, 0.0, 0.0)
+        self.material_slots = []
+        self.properties = {}
+
+    def __setitem__(self, key, value):
+        if isinstance(value, (list, tuple)):
+            value = IDPropertyArray(value)
+        self.properties[key] = value
+
+    def __getitem__(self, key):
+        return self.properties[key]
+
+    def __contains__(self, key):
+        return key in self.properties
+
+    def keys(self):
+        return self.properties.keys()
+
+
+class StandInCollection(object):
+    def __init__(self, factory):
+        self.factory = factory
+        self.items = []
+
+    def new(self, name, *args):
+        item = self.factory(name, *args)
+        self.items.append(item)
+        return item
+
+
+class StandInLamp(object):
+    def __init__(self, name, lamp_type):
+        self.name = name
+        self.type = lamp_type
+
+
+def stand_in_bpy(scene_objects):
+    """
+        The parts of bpy create_entity_objects uses, linking into scene_objects
+    """
+    bpy = types.SimpleNamespace()
+    bpy.data = types.SimpleNamespace(objects=StandInCollection(StandInObject),
+                                     lamps=StandInCollection(StandInLamp))
+    bpy.context = types.SimpleNamespace(scene=types.SimpleNamespace(
+        objects=types.SimpleNamespace(link=scene_objects.append)))
+    return bpy
+
+
+entity_text = """
+{
+"classname" "worldspawn"
+"message" "Stand-in Arena"
+}
+{
+"classname" "info_player_deathmatch"
+"origin" "64 128 24"
+"angles" "0 90 0"
+}
+{
+"classname" "light"
+"origin" "0 0 256"
+"light" "400"
+"_color" "1 0.5 0.25"
+}
+{
+"classname" "misc_model"
+"origin" "-32 16 0"
+"model" "models/mapobjects/tree.md3"
+"modelscale_vec" "1 1 2"
+}
+"""
+
+
+class EntityExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "scene.json.txt")
+
+        self.scene_objects = []
+        self.level = StandInObject("LEVELNewLevel", types.SimpleNamespace(
+            materials=[types.SimpleNamespace(name="textures/base_wall/concrete")]))
+        self.level['scale_factor'] = 0.02
+        self.level['region_min'] = [-10.0, -10.0, -10.0]
+        self.level['pvs'] = b"\x01\x03\x02\xff"
+        self.scene_objects.append(self.level)
+
+        self.bpy = bsp3_import.bpy
+        bsp3_import.bpy = stand_in_bpy(self.scene_objects)
+
+    def tearDown(self):
+        bsp3_import.bpy = self.bpy
+        shutil.rmtree(self.directory)
+
+    def export(self):
+        entities = bsp3_import.parse_entities(entity_text)
+        created = bsp3_import.create_entity_objects(entities, 0.02, self.level)
+        self.assertEqual(created, 3)
+
+        context = types.SimpleNamespace(scene=types.SimpleNamespace(objects=self.scene_objects))
+        jm_scene_export.write_some_data(context, self.filepath, True)
+
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def test_entity_vectors_exported(self):
+        output = self.export()
+
+        camera, = output['objects']['Cameras']
+        self.assertEqual(camera['properties']['angles'], [0.0, 90.0, 0.0])
+        self.assertEqual(camera['properties']['classname'], "info_player_deathmatch")
+
+        props = dict((prop['properties']['classname'], prop['properties']) for prop in output['objects']['Props'])
+        self.assertEqual(props['light']['_color'], [1.0, 0.5, 0.25])
+        self.assertEqual(props['light']['light'], 400)
+        self.assertEqual(props['misc_model']['modelscale_vec'], [1.0, 1.0, 2.0])
+        self.assertNotIn('origin', props['misc_model'])
+
+    def test_level_properties_exported(self):
+        level, = self.export()['objects']['Levels']
+
+        self.assertEqual(level['properties']['region_min'], [-10.0, -10.0, -10.0])
+        self.assertEqual(level['properties']['pvs'], "AQMC/w==")
+
+    def test_id_property_arrays_exported(self):
+        self.level['material_ranges'] = [0, 12, 12, 30]
+
+        level, = self.export()['objects']['Levels']
+        self.assertEqual(level['properties']['material_ranges'], [0, 12, 12, 30])
+
+
+class IncrementalExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "scene.json.txt")
+
+        self.level = StandInObject("LEVELNewLevel", types.SimpleNamespace(
+            materials=[types.SimpleNamespace(name="textures/base_wall/concrete")]))
+        self.crate = StandInObject("PROPCrate")
+        self.crate['health'] = 100
+        self.barrel = StandInObject("PROPBarrel")
+        self.barrel.location = (10.0, 20.0, 30.0)
+        self.context = types.SimpleNamespace(scene=types.SimpleNamespace(
+            objects=[self.level, self.crate, self.barrel]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, incremental):
+        jm_scene_export.write_some_data(self.context, self.filepath, True, incremental=incremental)
+
+    def load(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def props(self, output):
+        return dict((obj['name'], obj) for obj in output['objects']['Props'])
+
+    def test_patch_holds_changed_object(self):
+        self.export('FULL')
+        self.crate['health'] = 50
+        self.export('PATCH')
+
+        patch = self.load(jm_scene_export.patch_path(self.filepath))
+        self.assertEqual(patch['base_revision'], 1)
+        self.assertEqual(patch['revision'], 2)
+        self.assertEqual(list(patch['changed']), ["Props"])
+        crate, = patch['changed']['Props']
+        self.assertEqual(crate['name'], "PROPCrate")
+        self.assertEqual(crate['properties'], {"health": 50})
+        self.assertEqual(patch['removed'], {})
+        self.assertNotIn('materials', patch)
+
+        # The output itself is left at the first revision
+        fingerprints = self.load(jm_scene_export.fingerprint_path(self.filepath))
+        self.assertEqual((fingerprints['revision'], fingerprints['output_revision']), (2, 1))
+        self.assertEqual(self.props(self.load(self.filepath))['PROPCrate']['properties'], {"health": 100})
+
+    def test_unchanged_export_removes_patch(self):
+        self.export('FULL')
+        self.crate['health'] = 50
+        self.export('PATCH')
+        self.assertTrue(os.path.exists(jm_scene_export.patch_path(self.filepath)))
+
+        self.export('PATCH')
+        self.assertFalse(os.path.exists(jm_scene_export.patch_path(self.filepath)))
+        self.assertEqual(self.load(jm_scene_export.fingerprint_path(self.filepath))['revision'], 2)
+
+    def test_update_rewrites_changed_object(self):
+        self.export('FULL')
+        self.barrel.location = (0.0, 0.0, 0.0)
+        self.export('UPDATE')
+
+        props = self.props(self.load(self.filepath))
+        self.assertEqual(props['PROPBarrel']['location'], [0.0, 0.0, 0.0])
+        self.assertEqual(props['PROPCrate']['properties'], {"health": 100})
+        fingerprints = self.load(jm_scene_export.fingerprint_path(self.filepath))
+        self.assertEqual((fingerprints['revision'], fingerprints['output_revision']), (2, 2))
+
+    def test_object_material_change_detected(self):
+        slot = types.SimpleNamespace(material=types.SimpleNamespace(name="wood"))
+        self.crate.material_slots = [slot]
+        self.export('FULL')
+        slot.material = types.SimpleNamespace(name="metal")
+        self.export('PATCH')
+
+        patch = self.load(jm_scene_export.patch_path(self.filepath))
+        self.assertEqual([obj['name'] for obj in patch['changed']['Props']], ["PROPCrate"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,330 @@
+"""
+    jm_skel_export's bpy-free helpers, imported against stand-in bpy modules
+"""
+import io
+import math
+import sys
+import types
+import unittest
+
+import numpy as np
+
+import jm_profile
+
+
+def import_exporter():
+    """
+        Import jm_skel_export with just enough of bpy for its module level
+        code, then take the stand-ins out of sys.modules again
+    """
+    bpy = types.ModuleType("bpy")
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("StringProperty", "BoolProperty", "EnumProperty", "FloatProperty"):
+        setattr(bpy.props, name, lambda **options: None)
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.types.Operator = type("Operator", (object,), {})
+    bpy_extras = types.ModuleType("bpy_extras")
+    bpy_extras.io_utils = types.ModuleType("bpy_extras.io_utils")
+    bpy_extras.io_utils.ExportHelper = type("ExportHelper", (object,), {})
+
+    stand_ins = {
+        "bpy": bpy,
+        "bpy.props": bpy.props,
+        "bpy.types": bpy.types,
+        "bpy_extras": bpy_extras,
+        "bpy_extras.io_utils": bpy_extras.io_utils,
+    }
+    saved = dict((name, sys.modules.get(name)) for name in list(stand_ins) + ["jm_skel_export"])
+    sys.modules.update(stand_ins)
+    sys.modules.pop("jm_skel_export", None)
+    try:
+        import jm_skel_export
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    return jm_skel_export
+
+
+jm_skel_export = import_exporter()
+
+
+def action(name, *bone_names):
+    return types.SimpleNamespace(name=name, fcurves=[
+        types.SimpleNamespace(data_path='pose.bones["{}"].location'.format(bone_name))
+        for bone_name in bone_names])
+
+
+def armature(bone_names, active=None, strip_actions=()):
+    animation_data = types.SimpleNamespace(action=active, nla_tracks=[
+        types.SimpleNamespace(strips=[types.SimpleNamespace(action=strip_action)
+                                      for strip_action in strip_actions])])
+    return types.SimpleNamespace(
+        data=types.SimpleNamespace(bones=[types.SimpleNamespace(name=name) for name in bone_names]),
+        animation_data=animation_data)
+
+
+class ArmatureActionsTest(unittest.TestCase):
+    def setUp(self):
+        self.walk = action("walk", "hip", "knee")
+        self.run = action("run", "hip")
+        self.wave = action("wave", "hand")
+        self.other = action("other_rig_walk", "hip", "knee")
+
+        # Everything in the file, including another rig's action with the same bone names
+        jm_skel_export.bpy.data = types.SimpleNamespace(actions=[self.other, self.walk, self.run, self.wave])
+
+    def tearDown(self):
+        del jm_skel_export.bpy.data
+
+    def test_active_then_strips(self):
+        node = armature(["hip", "knee"], active=self.walk, strip_actions=(self.run, self.walk, self.wave, None))
+        self.assertEqual([found.name for found in jm_skel_export.armature_actions(node)], ["walk", "run"])
+
+    def test_unassigned_actions_ignored(self):
+        node = armature(["hip", "knee"])
+        self.assertEqual(jm_skel_export.armature_actions(node), [])
+
+        node.animation_data = None
+        self.assertEqual(jm_skel_export.armature_actions(node), [])
+
+
+def quat_matrix(q):
+    """
+        Reference rotation matrix of a unit w x y z quaternion, rows by columns
+    """
+    w, x, y, z = q
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+        [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+        [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)]])
+
+
+def axis_angle_quat(axis, degrees):
+    axis = np.array(axis, dtype=np.float64) / np.linalg.norm(axis)
+    half = math.radians(degrees) * 0.5
+    return np.concatenate(([math.cos(half)], axis * math.sin(half)))
+
+
+def transform(loc, q, scale=(1.0, 1.0, 1.0)):
+    mat = np.eye(4)
+    mat[:3, :3] = quat_matrix(q) * scale
+    mat[:3, 3] = loc
+    return mat
+
+
+class MatrixToQuatTest(unittest.TestCase):
+    def assertSameRotation(self, found, expected):
+        # q and -q are the same rotation
+        for q, reference in zip(found, expected):
+            sign = 1.0 if np.dot(q, reference) >= 0.0 else -1.0
+            np.testing.assert_allclose(q * sign, reference, atol=1e-9)
+
+    def test_trace_branch(self):
+        quats = [axis_angle_quat((0, 0, 1), 0), axis_angle_quat((1, 2, 3), 60), axis_angle_quat((-1, 0, 1), 170)]
+        found = jm_skel_export.matrix_to_quat(np.array([quat_matrix(q) for q in quats]))
+
+        np.testing.assert_allclose(found, quats, atol=1e-9)
+
+    def test_half_turn_branches(self):
+        # Near half turns leave trace <= 0, so the largest diagonal picks the branch
+        axes = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 0.3, 0.2), (0.2, -1, 0.3), (0.3, 0.2, -1)]
+        quats = [axis_angle_quat(axis, degrees) for axis in axes for degrees in (180, 179.5)]
+        rot = np.array([quat_matrix(q) for q in quats])
+        self.assertTrue((np.trace(rot, axis1=1, axis2=2) < -0.999).all())
+
+        self.assertSameRotation(jm_skel_export.matrix_to_quat(rot), quats)
+
+    def test_decompose(self):
+        q = axis_angle_quat((1, 1, 0), 45)
+        mats = np.array([transform((1, 2, 3), q, (2, 3, 4)), transform((-4, 0, 5), q, (-1, 1, 1))])
+        loc, rot = jm_skel_export.decompose(mats)
+
+        np.testing.assert_allclose(loc, [(1, 2, 3), (-4, 0, 5)])
+        # A negative scale is divided out of every axis, like Matrix.decompose,
+        # leaving the rotation half a turn about x
+        flipped = jm_skel_export.quat_multiply(q, np.array([0.0, 1.0, 0.0, 0.0]))
+        self.assertSameRotation(rot, [q, flipped])
+
+
+class StandInBones(list):
+    def foreach_get(self, attr, values):
+        # Column by column, like Blender's matrices
+        values[:] = np.concatenate([getattr(bone, attr).T.ravel() for bone in self])
+
+
+class BuildSkeletonTest(unittest.TestCase):
+    def test_rest_pose(self):
+        root_q = axis_angle_quat((0, 0, 1), 90)
+        hand_q = axis_angle_quat((1, 0, 0), -30)
+        root = types.SimpleNamespace(name="root", parent=None, matrix_local=transform((0, 0, 1), root_q))
+        arm = types.SimpleNamespace(name="arm", parent=root)
+        arm.matrix_local = np.dot(root.matrix_local, transform((0, 2, 0), axis_angle_quat((1, 0, 0), 90)))
+        hand = types.SimpleNamespace(name="hand", parent=arm)
+        hand.matrix_local = np.dot(arm.matrix_local, transform((0, 1, 0), hand_q))
+        root.children, arm.children, hand.children = [arm], [hand], []
+
+        # Listed children first, exported parents first
+        skeleton = jm_skel_export.BuildSkeleton(types.SimpleNamespace(bones=StandInBones([hand, root, arm])))
+
+        self.assertEqual(skeleton['names'], ["root", "arm", "hand"])
+        self.assertEqual(skeleton['parents'].tolist(), [-1, 0, 1])
+        np.testing.assert_allclose(skeleton['loc'], [(0, 0, 1), (0, 2, 0), (0, 1, 0)], atol=1e-6)
+        np.testing.assert_allclose(skeleton['rot'], [root_q, axis_angle_quat((1, 0, 0), 90), hand_q], atol=1e-6)
+        np.testing.assert_allclose(skeleton['mat'][2], transform((0, 1, 0), hand_q), atol=1e-6)
+        np.testing.assert_allclose(skeleton['inverse_bind'][2], np.linalg.inv(hand.matrix_local), atol=1e-6)
+
+
+def skeleton(name, bone_names):
+    count = len(bone_names)
+    mat = np.tile(np.eye(4, dtype=np.float32), (count, 1, 1))
+    mat[:, :3, 3] = np.arange(count * 3).reshape(count, 3)
+    return {
+        "name": name,
+        "names": list(bone_names),
+        "count": count,
+        "parents": np.arange(-1, count - 1, dtype=np.int32),
+        "loc": mat[:, :3, 3].copy(),
+        "rot": np.tile(np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32), (count, 1)),
+        "mat": mat,
+    }
+
+
+class ArchiveTest(unittest.TestCase):
+    def test_round_trip(self):
+        jobs = []
+        for name, file_format in (("hero", 'XML'), ("crate", 'BINARY')):
+            rig = skeleton(name, ["root", "spine", "tip"])
+            for suffix, writer, args in jm_skel_export.armature_files(rig, file_format):
+                jobs.append((name + suffix, writer) + args)
+
+        data = jm_skel_export.run_jobs(jm_skel_export.encode, [job[1:] for job in jobs], True)
+        entries = [(job[0], entry) for job, entry in zip(jobs, data)]
+        self.assertNotEqual(len(data[0]) % 4, 0)
+        buffer = io.BytesIO()
+        written = jm_skel_export.archive_write(buffer, entries)
+        archive = buffer.getvalue()
+        self.assertEqual(written, len(archive))
+        self.assertEqual(len(archive) % 4, 0)
+
+        header = jm_skel_export.archive_header
+        magic, version, entry_count, names_size = header.unpack_from(archive)
+        self.assertEqual((magic, version, entry_count), (b"JMSA", 1, 2))
+
+        names = archive[header.size:header.size + names_size].rstrip(b"\0").split(b"\0")
+        self.assertEqual([name.decode("UTF-8") for name in names], ["hero.skel.xml", "crate.skel.bin"])
+
+        table = np.frombuffer(archive, dtype='<u4', count=2 * entry_count, offset=header.size + names_size)
+        table = table.reshape(entry_count, 2)
+        self.assertEqual(table[0, 0], header.size + names_size + 8 * entry_count)
+        self.assertTrue((table[:, 0] % 4 == 0).all())
+
+        # Each entry is exactly what the writer produces for a file of its own
+        for (offset, size), job in zip(table.tolist(), jobs):
+            self.assertEqual(archive[offset:offset + size], jm_skel_export.encode(*job[1:]))
+        self.assertTrue(archive.startswith(b"JMSK", table[1, 0]))
+
+
+class StandInKeyframes(object):
+    def __init__(self, co):
+        self.co = np.array(co, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.co)
+
+    def foreach_get(self, attr, values):
+        values[:] = self.co.ravel()
+
+
+class StandInFCurve(object):
+    """
+        Linear keys; evaluate counts its calls
+    """
+    def __init__(self, data_path, array_index, co, extrapolation='CONSTANT'):
+        self.data_path = data_path
+        self.array_index = array_index
+        self.keyframe_points = StandInKeyframes(co)
+        self.modifiers = []
+        self.extrapolation = extrapolation
+        self.mute = False
+        self.evaluated = 0
+
+    def evaluate(self, frame):
+        self.evaluated += 1
+        co = self.keyframe_points.co.astype(np.float64)
+        return np.interp(frame, co[:, 0], co[:, 1])
+
+
+class FCurveSamplesTest(unittest.TestCase):
+    def test_baked_keys_read_directly(self):
+        fcurve = StandInFCurve('pose.bones["hip"].location', 0, [(frame, frame * 0.5) for frame in range(1, 11)])
+        samples = jm_skel_export.fcurve_samples(fcurve, np.arange(0.0, 13.0))
+
+        self.assertEqual(fcurve.evaluated, 0)
+        np.testing.assert_allclose(samples, [0.5] + [frame * 0.5 for frame in range(1, 11)] + [5.0, 5.0])
+
+    def test_sparse_keys_evaluated(self):
+        fcurve = StandInFCurve('pose.bones["hip"].location', 0, [(1.0, 0.0), (4.0, 3.0), (10.0, 0.0)])
+        samples = jm_skel_export.fcurve_samples(fcurve, np.arange(1.0, 11.0))
+
+        self.assertEqual(fcurve.evaluated, 10)
+        np.testing.assert_allclose(samples, [0, 1, 2, 3, 2.5, 2, 1.5, 1, 0.5, 0])
+
+    def test_linear_extrapolation_evaluated(self):
+        fcurve = StandInFCurve('pose.bones["hip"].location', 0, [(1.0, 0.0), (2.0, 1.0)], extrapolation='LINEAR')
+        jm_skel_export.fcurve_samples(fcurve, np.arange(0.0, 4.0))
+
+        self.assertEqual(fcurve.evaluated, 4)
+
+
+class ReduceKeysTest(unittest.TestCase):
+    def test_corners_kept(self):
+        # Up for ten frames then down for ten, wobbling well inside tolerance
+        frames = np.arange(21)
+        values = np.where(frames <= 10, frames, 20 - frames) + 0.001 * (-1.0) ** frames
+        keep = jm_skel_export.reduce_keys(values.reshape(-1, 1, 1), [0.01])
+
+        self.assertEqual(np.flatnonzero(keep[:, 0]).tolist(), [0, 10, 20])
+
+    def test_error_bound(self):
+        frames = np.arange(120.0)
+        values = np.column_stack((np.sin(frames * 0.1), np.cos(frames * 0.05) * 3.0))
+        tolerances = [0.01, 0.05]
+        keep = jm_skel_export.reduce_keys(values[:, :, None], tolerances)
+
+        for track, tolerance in enumerate(tolerances):
+            keys = np.flatnonzero(keep[:, track])
+            self.assertLess(len(keys), len(frames) // 2)
+
+            rebuilt = np.interp(frames, frames[keys], values[keys, track])
+            self.assertLessEqual(np.abs(rebuilt - values[:, track]).max(), tolerance + 1e-9)
+
+
+class BakeClipTest(unittest.TestCase):
+    def test_clip_keys(self):
+        # One bone sliding along x for ten frames, then holding for ten
+        slide = StandInFCurve('pose.bones["hip"].location', 0, [(1.0, 0.0), (11.0, 10.0), (21.0, 10.0)])
+        action = types.SimpleNamespace(name="slide", fcurves=[slide], frame_range=(1.0, 21.0))
+        skeleton = {
+            "names": ["hip"],
+            "count": 1,
+            "loc": np.array([[0.0, 1.0, 0.0]], dtype=np.float32),
+            "rot": np.array([[1.0, 0.0, 0.0, 0.0]], dtype=np.float32),
+        }
+
+        clip = jm_skel_export.bake_clip(action, skeleton, ['QUATERNION'], 24, np.array([0.001, 0.001, 0.001]),
+                                        jm_profile.Profiler("skel_anim", 'OFF'))
+
+        self.assertEqual(clip['frame_count'], 21)
+        self.assertEqual(clip['counts'].tolist(), [[3], [2], [2]])
+        self.assertEqual(clip['frames'].tolist(), [0, 10, 20, 0, 20, 0, 20])
+        np.testing.assert_allclose(clip['loc'], [[0, 1, 0], [10, 1, 0], [10, 1, 0]])
+        self.assertEqual(clip['rot'].tolist(), [[32767, 0, 0, 0]] * 2)
+        np.testing.assert_allclose(clip['scale'], [[1, 1, 1]] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
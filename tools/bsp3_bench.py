@@ -0,0 +1,387 @@
+"""
+    Synthetic maps and per stage timings for bsp3_import. Nothing here
+    needs Blender:
+        python tools/bsp3_bench.py generate big.bsp --vertices 500000
+        python tools/bsp3_bench.py bench [maps...] --json results.json
+"""
+from struct import Struct
+import os
+import sys
+import json
+import time
+import platform
+import shutil
+import tempfile
+import numpy as np
+
+# The add-ons live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bsp3_import
+import jm_profile
+
+
+def write_synthetic_bsp(filepath, vertex_count=100000, face_mix=(0.7, 0.15, 0.15), texture_count=64,
+                        lightmap_count=32, cluster_count=256, visibility=0.25, brush_count=256,
+                        entity_count=64, seed=0):
+    """
+        Write a valid IBSP version 46 file of roughly vertex_count vertices.
+        face_mix splits the vertices between polygon quads, 3x3 patches and
+        small triangle soup meshes. Every lump the importer reads is filled
+        in, with the faces spread over cluster_count leafs whose PVS rows
+        have about visibility of their bits set.
+    """
+    random = np.random.RandomState(seed)
+
+    polygon_count = int(vertex_count * face_mix[0]) // 4
+    patch_count = int(vertex_count * face_mix[1]) // 9
+    mesh_count = int(vertex_count * face_mix[2]) // 6
+
+    # Vertex layout and meshverts of each kind of face
+    quad_corners = np.array([[0, 0, 0], [64, 0, 0], [64, 64, 0], [0, 64, 0]], dtype=np.float32)
+    quad_meshverts = np.array([0, 1, 2, 0, 2, 3], dtype=np.int32)
+    patch_grid = np.array([[x * 32, y * 32, 0] for y in range(3) for x in range(3)], dtype=np.float32)
+    mesh_meshverts = np.array([0, 1, 2, 2, 1, 3, 2, 3, 4, 4, 3, 5], dtype=np.int32)
+
+    kinds = (
+        (1, polygon_count, quad_corners, quad_meshverts),
+        (2, patch_count, patch_grid, np.zeros(0, dtype=np.int32)),
+        (3, mesh_count, None, mesh_meshverts),
+    )
+
+    positions = []
+    meshverts = []
+    face_records = []
+    vertex_start = 0
+    meshvert_start = 0
+
+    for face_type, count, layout, face_meshverts in kinds:
+        if count == 0:
+            continue
+
+        per_face = len(layout) if layout is not None else 6
+        origins = random.uniform(-4096.0, 4096.0, (count, 1, 3)).astype(np.float32)
+        if layout is None:
+            offsets = random.uniform(-16.0, 16.0, (count, per_face, 3)).astype(np.float32)
+        else:
+            offsets = np.tile(layout, (count, 1, 1))
+            offsets[:, :, 2] += random.uniform(-8.0, 8.0, (count, per_face)).astype(np.float32)
+        positions.append((origins + offsets).reshape(-1, 3))
+
+        meshverts.append(np.tile(face_meshverts, count))
+
+        records = np.zeros(count, dtype=bsp3_import.face_dtype)
+        records['type'] = face_type
+        records['effect'] = -1
+        records['vertex'] = vertex_start + np.arange(count) * per_face
+        records['n_vertexes'] = per_face
+        records['meshvert'] = meshvert_start + np.arange(count) * len(face_meshverts)
+        records['n_meshverts'] = len(face_meshverts)
+        if face_type == 2:
+            records['size'] = 3
+        face_records.append(records)
+
+        vertex_start += count * per_face
+        meshvert_start += count * len(face_meshverts)
+
+    verts = np.zeros(vertex_start, dtype=bsp3_import.vert_dtype)
+    if vertex_start:
+        verts['position'] = np.concatenate(positions)
+    verts['texcoord'] = random.uniform(-4.0, 4.0, (vertex_start, 2))
+    verts['lightmap'] = random.uniform(0.0, 1.0, (vertex_start, 2))
+    verts['normal'] = (0.0, 0.0, 1.0)
+    verts['color'] = random.randint(0, 256, (vertex_start, 4))
+
+    meshverts = np.concatenate(meshverts) if meshverts else np.zeros(0, dtype=np.int32)
+
+    # Shuffle so the face types are interleaved like a real map
+    faces = np.concatenate(face_records) if face_records else np.zeros(0, dtype=bsp3_import.face_dtype)
+    faces = faces[random.permutation(len(faces))]
+    face_count = len(faces)
+
+    faces['texture'] = random.randint(0, max(texture_count, 1), face_count)
+    faces['lm_index'] = random.randint(-1, lightmap_count, face_count) if lightmap_count else -1
+    faces['lm_size'] = bsp3_import.lightmap_size
+    faces['normal'] = (0.0, 0.0, 1.0)
+
+    textures = np.zeros(texture_count, dtype=bsp3_import.texture_dtype)
+    textures['name'] = [("textures/synthetic/tex{}".format(texture)).encode("ascii")
+                        for texture in range(texture_count)]
+    textures['contents'] = 1
+
+    # Axis aligned box brushes, six planes each - the first planes belong to the nodes
+    leaf_count = max(cluster_count, 1)
+    node_count = max(leaf_count - 1, 1)
+
+    planes = np.zeros(node_count + brush_count * 6, dtype=[('normal', '<f4', (3,)), ('dist', '<f4')])
+    planes['normal'][:node_count] = (1.0, 0.0, 0.0)
+    planes['dist'][:node_count] = np.arange(node_count)
+
+    box_mins = random.uniform(-4096.0, 4000.0, (brush_count, 3)).astype(np.float32)
+    box_maxs = box_mins + random.uniform(8.0, 96.0, (brush_count, 3)).astype(np.float32)
+    axes = np.eye(3, dtype=np.float32)
+    brush_planes = planes[node_count:].reshape(brush_count, 6)
+    brush_planes['normal'][:, 0::2] = axes
+    brush_planes['normal'][:, 1::2] = -axes
+    brush_planes['dist'][:, 0::2] = box_maxs
+    brush_planes['dist'][:, 1::2] = -box_mins
+    planes[node_count:] = brush_planes.ravel()
+
+    brushsides = np.zeros(brush_count * 6, dtype=[('plane', '<i4'), ('texture', '<i4')])
+    brushsides['plane'] = node_count + np.arange(brush_count * 6)
+    brushes = np.zeros(brush_count, dtype=[('brushside', '<i4'), ('n_brushsides', '<i4'), ('texture', '<i4')])
+    brushes['brushside'] = np.arange(brush_count) * 6
+    brushes['n_brushsides'] = 6
+    brushes['texture'] = random.randint(0, max(texture_count, 1), brush_count)
+
+    # A chain of nodes, each splitting off one leaf
+    nodes = np.zeros(node_count, dtype=[('plane', '<i4'), ('children', '<i4', (2,)),
+                                        ('mins', '<i4', (3,)), ('maxs', '<i4', (3,))])
+    nodes['plane'] = np.arange(node_count)
+    nodes['children'][:, 0] = -(np.arange(node_count) + 1)
+    nodes['children'][:, 1] = np.arange(node_count) + 1
+    nodes['children'][-1, 1] = -leaf_count
+    nodes['mins'] = -4096
+    nodes['maxs'] = 4096
+
+    # Faces and brushes dealt out to the leafs
+    leaffaces = random.permutation(face_count).astype(np.int32)
+    leafbrushes = np.arange(brush_count, dtype=np.int32)
+    leafs = np.zeros(leaf_count, dtype=bsp3_import.leaf_dtype)
+    leafs['cluster'] = np.arange(leaf_count) if cluster_count else -1
+    leafs['mins'] = -4096
+    leafs['maxs'] = 4096
+    leafs['leafface'] = np.arange(leaf_count) * face_count // leaf_count
+    leafs['n_leaffaces'] = np.diff(np.append(leafs['leafface'], face_count))
+    leafs['leafbrush'] = np.arange(leaf_count) * brush_count // leaf_count
+    leafs['n_leafbrushes'] = np.diff(np.append(leafs['leafbrush'], brush_count))
+
+    models = np.zeros(1, dtype=[('mins', '<f4', (3,)), ('maxs', '<f4', (3,)), ('face', '<i4'),
+                                ('n_faces', '<i4'), ('brush', '<i4'), ('n_brushes', '<i4')])
+    models['mins'] = -4096.0
+    models['maxs'] = 4096.0
+    models['n_faces'] = face_count
+    models['n_brushes'] = brush_count
+
+    lightmap_bytes = lightmap_count * bsp3_import.lightmap_size * bsp3_import.lightmap_size * 3
+    lightmaps = random.randint(0, 256, lightmap_bytes).astype(np.uint8)
+
+    visdata = b""
+    if cluster_count:
+        row_bytes = (cluster_count + 7) // 8
+        bits = random.uniform(0.0, 1.0, (cluster_count, row_bytes * 8)) < visibility
+        bits[np.arange(cluster_count), np.arange(cluster_count)] = True
+        packed = np.packbits(bits.reshape(cluster_count, row_bytes, 8)[:, :, ::-1], axis=2)
+        visdata = Struct("ii").pack(cluster_count, row_bytes) + packed.tobytes()
+
+    classnames = ("info_player_deathmatch", "light", "item_health", "weapon_rocketlauncher")
+    entities = ['{\n"classname" "worldspawn"\n"message" "synthetic"\n}\n']
+    for entity, origin in enumerate(random.randint(-4096, 4096, (entity_count, 3)).tolist()):
+        classname = classnames[entity % len(classnames)]
+        entities.append('{{\n"classname" "{}"\n"origin" "{} {} {}"\n{}}}\n'.format(
+            classname, origin[0], origin[1], origin[2],
+            '"light" "300"\n' if classname == "light" else ''))
+
+    lumps = [b""] * 17
+    lumps[bsp3_import.LUMP_ENTITIES] = "".join(entities).encode("ascii") + b"\0"
+    lumps[bsp3_import.LUMP_TEXTURES] = textures.tobytes()
+    lumps[bsp3_import.LUMP_PLANES] = planes.tobytes()
+    lumps[bsp3_import.LUMP_NODES] = nodes.tobytes()
+    lumps[bsp3_import.LUMP_LEAFS] = leafs.tobytes()
+    lumps[bsp3_import.LUMP_LEAFFACES] = leaffaces.tobytes()
+    lumps[bsp3_import.LUMP_LEAFBRUSHES] = leafbrushes.tobytes()
+    lumps[bsp3_import.LUMP_MODELS] = models.tobytes()
+    lumps[bsp3_import.LUMP_BRUSHES] = brushes.tobytes()
+    lumps[bsp3_import.LUMP_BRUSHSIDES] = brushsides.tobytes()
+    lumps[bsp3_import.LUMP_VERTEXES] = verts.tobytes()
+    lumps[bsp3_import.LUMP_MESHVERTS] = meshverts.astype('<i4').tobytes()
+    lumps[bsp3_import.LUMP_FACES] = faces.tobytes()
+    lumps[bsp3_import.LUMP_LIGHTMAPS] = lightmaps.tobytes()
+    lumps[bsp3_import.LUMP_VISDATA] = visdata
+
+    bsp_header = Struct("<4si")
+    bsp_chunk = Struct("<ii")
+
+    directory = []
+    lump_position = bsp_header.size + bsp_chunk.size * 17
+    for lump in lumps:
+        directory.append(bsp_chunk.pack(lump_position, len(lump)))
+        lump_position += (len(lump) + 3) & ~3
+
+    with open(filepath, 'wb') as f:
+        f.write(bsp_header.pack(b"IBSP", 46))
+        f.write(b"".join(directory))
+        for lump in lumps:
+            f.write(lump)
+            f.write(b"\0" * (-len(lump) & 3))
+
+    return {
+        "vertices": vertex_start,
+        "polygons": polygon_count,
+        "patches": patch_count,
+        "meshes": mesh_count,
+        "textures": texture_count,
+        "lightmaps": lightmap_count,
+        "clusters": cluster_count,
+        "brushes": brush_count,
+        "entities": entity_count,
+    }
+
+
+def benchmark_bsp(filepath, repeat=3, patch_lods=(2, 4, 8)):
+    """
+        Time each parsing stage on its own, best of repeat runs. Nothing here
+        needs Blender. Returns a JSON-able dict.
+    """
+    def best_time(stage, *args):
+        timings = []
+        for run in range(repeat):
+            start = time.perf_counter()
+            result = stage(*args)
+            timings.append(time.perf_counter() - start)
+        # Nothing may still view the map when the BspFile closes
+        return min(timings), bsp3_import.detached(result)
+
+    def load_header_and_directory(data):
+        bsp_header, file_position = bsp3_import.load_bsp_header(data, 0)
+        return bsp3_import.load_headers(data, file_position)[0]
+
+    stages = {}
+
+    with bsp3_import.BspFile(filepath) as bsp:
+        data = bsp.data
+
+        stages['headers'], headers = best_time(load_header_and_directory, data)
+        stages['load_verts'], verts = best_time(bsp3_import.load_verts, data, headers, 0.02)
+        stages['load_indices'], indices = best_time(bsp3_import.load_indices, data, headers)
+        stages['load_faces'], faces = best_time(bsp3_import.load_faces, data, headers, indices)
+        stages['load_materials'], textures = best_time(bsp3_import.load_materials, data, headers)
+
+        face_data = bsp.decoded('face_data', bsp3_import.load_faces_data)
+        lightmaps = bsp.decoded('lightmaps', bsp3_import.load_lightmaps)
+
+        def lightmap_stage():
+            atlas, columns, rows = bsp3_import.pack_lightmap_atlas(bsp3_import.correct_lightmaps(lightmaps))
+            return bsp3_import.remap_lightmap_uvs(verts['lightmap_uv'], face_data, len(lightmaps), columns, rows)
+        stages['lightmaps'], lightmap_uv = best_time(lightmap_stage)
+
+        # The mesh buffers are timed on the last LOD, or without patches if none
+        level_verts, level_faces = verts, faces
+        for lod in patch_lods:
+            stages['tessellate_patches_lod{}'.format(lod)], patches = best_time(
+                bsp3_import.tessellate_patches, face_data, verts, lod)
+            level_verts, level_faces = bsp3_import.merge_patches(verts, faces, patches)
+
+        visdata = bsp.decoded('visdata', bsp3_import.load_visdata)
+        if visdata is not None:
+            def visibility_stage():
+                leafs = bsp3_import.load_leafs(data, headers)
+                leaffaces = bsp3_import.load_leaffaces(data, headers)
+                clusters = bsp3_import.face_clusters(leafs, leaffaces, len(face_data))
+                return clusters, bsp3_import.group_visibility(visdata, 1)
+            stages['visibility'], visibility = best_time(visibility_stage)
+
+        stages['build_mesh_buffers'], buffers = best_time(
+            bsp3_import.build_mesh_buffers, level_verts['position'], level_faces['triangles'],
+            level_faces['texture'], level_verts['uv'])
+
+        counts = {
+            "vertices": len(verts['position']),
+            "triangles": len(faces['triangles']),
+            "faces": len(face_data),
+            "patches": int((face_data['type'] == 2).sum()),
+            "textures": len(textures),
+            "lightmaps": len(lightmaps),
+            "clusters": 0 if visdata is None else len(visdata),
+        }
+
+    return {
+        "file": os.path.abspath(filepath),
+        "bytes": os.path.getsize(filepath),
+        "repeat": repeat,
+        "counts": counts,
+        "stages": stages,
+        "total": sum(stages.values()),
+        "peak_rss": jm_profile.peak_rss(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def generate_command(arguments):
+    face_mix = [float(fraction) for fraction in arguments.face_mix.split(",")]
+    counts = write_synthetic_bsp(arguments.output, arguments.vertices, face_mix, arguments.textures,
+                                 arguments.lightmaps, arguments.clusters, arguments.visibility,
+                                 arguments.brushes, arguments.entities, arguments.seed)
+
+    print ("Wrote {} ({})".format(arguments.output, ", ".join(
+        "{} {}".format(value, name) for name, value in sorted(counts.items()))))
+    return 0
+
+
+def bench_command(arguments):
+    map_paths = list(arguments.maps)
+    temp_dir = None
+
+    if not map_paths:
+        temp_dir = tempfile.mkdtemp()
+        map_paths.append(os.path.join(temp_dir, "synthetic.bsp"))
+        write_synthetic_bsp(map_paths[0], arguments.vertices)
+
+    try:
+        results = [benchmark_bsp(map_path, arguments.repeat) for map_path in map_paths]
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    report = json.dumps(results, indent=4, sort_keys=True)
+    if arguments.json:
+        with open(arguments.json, 'w') as f:
+            f.write(report)
+    else:
+        print (report)
+
+    return 0
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python tools/bsp3_bench.py",
+                                     description="Synthetic Quake 3 maps and bsp3_import stage timings")
+    commands = parser.add_subparsers(dest="command")
+
+    generate = commands.add_parser("generate", help="Write a synthetic map for benchmarking")
+    generate.add_argument("output")
+    generate.add_argument("--vertices", type=int, default=100000)
+    generate.add_argument("--face-mix", default="0.7,0.15,0.15",
+                          help="Share of the vertices in polygon, patch and mesh faces")
+    generate.add_argument("--textures", type=int, default=64)
+    generate.add_argument("--lightmaps", type=int, default=32)
+    generate.add_argument("--clusters", type=int, default=256)
+    generate.add_argument("--visibility", type=float, default=0.25,
+                          help="Fraction of clusters visible from each cluster")
+    generate.add_argument("--brushes", type=int, default=256)
+    generate.add_argument("--entities", type=int, default=64)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.set_defaults(run=generate_command)
+
+    bench = commands.add_parser("bench", help="Time each parsing stage, report as JSON")
+    bench.add_argument("maps", nargs="*", help="Maps to time, a synthetic one is generated if none are given")
+    bench.add_argument("--repeat", type=int, default=3)
+    bench.add_argument("--vertices", type=int, default=100000, help="Size of the generated map")
+    bench.add_argument("--json", help="Write the results here instead of stdout")
+    bench.set_defaults(run=bench_command)
+
+    arguments = parser.parse_args(argv)
+    if not hasattr(arguments, "run"):
+        parser.print_help()
+        return 1
+
+    return arguments.run(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())